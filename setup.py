@@ -30,7 +30,8 @@ kwargs = dict(
     url="https://github.com/BD2KGenomics/toil-scripts",
     install_requires=[
         'toil-lib==1.2.0a1.dev126',
-        'pyyaml==3.11'],
+        'pyyaml==3.11',
+        'numpy==1.16.6'],
     tests_require=[
         'pytest==2.8.3'],
     package_dir={'': 'src'},
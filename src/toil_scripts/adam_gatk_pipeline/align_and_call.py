@@ -87,19 +87,25 @@ GATK haplotype caller
 44  Apply VQSR model to INDELs
 
 
-However, the pipeline in this file is actually just five encapsulated jobs:
+However, the pipeline in this file is actually just five encapsulated jobs per sample:
 
         A
        / \
       B   D
       |   |
       C   E
+       \ /
+        F
 
 A  Run BWA alignment (jobs 0-4)
 B  Run ADAM preprocessing (jobs 5-12)
 C  Run GATK haplotype caller (jobs 13-22)
 D  Run GATK preprocessing (jobs 23-34)
 E  Run GATK haplotype caller (jobs 35-44)
+F  Compare the calls of C and E (see concordance.py)
+
+The shared reference files are staged once before any sample is processed, and the comparisons of all samples are
+summed up once all samples have been processed.
 
 ===================================================================
 :Dependencies:
@@ -130,13 +136,46 @@ from toil_scripts.adam_pipeline.adam_preprocessing import * #static_adam_preproc
 from toil_scripts.bwa_alignment.bwa_alignment import * #download_shared_files
 from toil_scripts.gatk_germline.germline import * #run_gatk_germline_pipeline
 from toil_lib.files import generate_file
+from toil_lib.tools.preprocessing import run_picard_create_sequence_dictionary
+from toil_lib.urls import download_url_job
+
+from toil_scripts.adam_gatk_pipeline.concordance import Concordance, concordance
+from toil_scripts.gatk_germline.common import output_file_job
+
+# Known sites VCFs of the GATK branches, by their names in the germline pipeline and in the config of this pipeline
+KNOWN_SITES = [('g1k_indel', 'phase'), ('mills', 'mills'), ('dbsnp', 'dbsnp'), ('hapmap', 'hapmap'), ('omni', 'omni')]
 
 
-def sample_loop(job, uuid_list, inputs):
+def stage_shared_files(job, inputs):
+  """
+  Stages the files shared by every branch of every sample once: the reference and its indexes, and the known sites
+  VCFs. ADAM preprocessing still reads the known sites from their URL into its Spark cluster.
+
+  :return: FileStoreIDs of the files for the BWA branch, by the names of the BWA alignment pipeline, and of the
+           files for the GATK branches, by the names of the germline pipeline
+  :rtype: tuple(dict, dict)
+  """
+  bwa_ids = stage_reference_files(job, inputs)
+  gatk_ids = {'genome_fasta': bwa_ids['ref'],
+              'genome_fai': bwa_ids['fai'],
+              # Follow-ons run once the reference has been downloaded by the children
+              'genome_dict': job.addFollowOnJobFn(run_picard_create_sequence_dictionary, bwa_ids['ref']).rv()}
+  for name, key in KNOWN_SITES:
+    url = getattr(inputs, key, None)
+    if url:
+      gatk_ids[name] = job.addChildJobFn(download_url_job, url, name=name, s3_key_path=inputs.ssec,
+                                         disk='15G').rv()
+  return bwa_ids, gatk_ids
+
+
+def sample_loop(job, uuid_list, inputs, shared_ids):
   """
   Loops over the sample_ids (uuids) in the manifest, creating child jobs to process each
+
+  shared_ids: FileStoreIDs of the shared files, from stage_shared_files
   """
 
+  concordances = {}
   for uuid_rg in uuid_list:
 
     uuid_items = uuid_rg.split(',')
@@ -145,10 +184,16 @@ def sample_loop(job, uuid_list, inputs):
     if len(uuid_items) > 1:
         rg_line = uuid_items[1]
 
-    job.addChildJobFn(static_dag, uuid, rg_line, inputs)
+    concordances[uuid] = job.addChildJobFn(static_dag, uuid, rg_line, inputs, shared_ids).rv()
+
+  if inputs.pipeline_to_run == "both":
+    job.addFollowOnJobFn(cohort_concordance,
+                         concordances,
+                         's3://{}/analysis{}'.format(inputs.s3_bucket, inputs.dir_suffix),
+                         s3_key_path=inputs.ssec)
 
 
-def static_dag(job, uuid, rg_line, inputs):
+def static_dag(job, uuid, rg_line, inputs, shared_ids):
     """
     Prefer this here as it allows us to pull the job functions from other jobs
     without rewrapping the job functions back together.
@@ -158,7 +203,10 @@ def static_dag(job, uuid, rg_line, inputs):
     gatk_preprocess_inputs: Input arguments to be passed to GATK preprocessing.
     gatk_adam_call_inputs: Input arguments to be passed to GATK haplotype caller for the result of ADAM preprocessing.
     gatk_gatk_call_inputs: Input arguments to be passed to GATK haplotype caller for the result of GATK preprocessing.
+    shared_ids: FileStoreIDs of the shared files, from stage_shared_files. Every branch uses these instead of
+                downloading the shared files again.
     """
+    bwa_ids, gatk_ids = shared_ids
 
     # get work directory
     work_dir = job.fileStore.getLocalTempDir()
@@ -177,7 +225,8 @@ def static_dag(job, uuid, rg_line, inputs):
                         inputs,
                         [[uuid,
                          ['s3://{s3_bucket}/{sequence_dir}/{uuid}_1.fastq.gz'.format(**args),
-                          's3://{s3_bucket}/{sequence_dir}/{uuid}_2.fastq.gz'.format(**args)]]]).encapsulate()
+                          's3://{s3_bucket}/{sequence_dir}/{uuid}_2.fastq.gz'.format(**args)]]],
+                        shared_ids=bwa_ids).encapsulate()
 
     # get head ADAM preprocessing job function and encapsulate it
     adam_preprocess = job.wrapJobFn(static_adam_preprocessing_dag,
@@ -192,6 +241,7 @@ def static_dag(job, uuid, rg_line, inputs):
     gatk_preprocessing_inputs.preprocess = True
     gatk_preprocessing_inputs.preprocess_only = True
     gatk_preprocessing_inputs.output_dir = 's3://{s3_bucket}/analysis{dir_suffix}'.format(**args)
+    vars(gatk_preprocessing_inputs).update(gatk_ids)
 
     # get head GATK preprocessing job function and encapsulate it
     gatk_preprocess = job.wrapJobFn(run_gatk_germline_pipeline,
@@ -199,16 +249,18 @@ def static_dag(job, uuid, rg_line, inputs):
                                                    's3://{s3_bucket}/alignment{dir_suffix}/{uuid}.bam'.format(**args),
                                                    None,    # Does not require second URL or RG_Line
                                                    None),
-                                    gatk_preprocessing_inputs).encapsulate()
+                                    gatk_preprocessing_inputs,
+                                    staged=True).encapsulate()
 
     # Configure options for Toil Germline pipeline for preprocessed ADAM BAM file.
-    adam_call_inputs = inputs
+    adam_call_inputs = copy.deepcopy(inputs)
     adam_call_inputs.suffix = '.adam'
     adam_call_inputs.sorted = True
     adam_call_inputs.preprocess = False
     adam_call_inputs.run_vqsr = False
     adam_call_inputs.joint_genotype = False
     adam_call_inputs.output_dir = 's3://{s3_bucket}/analysis{dir_suffix}'.format(**args)
+    vars(adam_call_inputs).update(gatk_ids)
 
     # get head GATK haplotype caller job function for the result of ADAM preprocessing and encapsulate it
     gatk_adam_call = job.wrapJobFn(run_gatk_germline_pipeline,
@@ -216,22 +268,26 @@ def static_dag(job, uuid, rg_line, inputs):
                                                   's3://{s3_bucket}/analysis{dir_suffix}/{uuid}/{uuid}.adam.bam'.format(**args),
                                                   None,
                                                   None),
-                                   adam_call_inputs).encapsulate()
+                                   adam_call_inputs,
+                                   staged=True).encapsulate()
 
     # Configure options for Toil Germline pipeline for preprocessed GATK BAM file.
     gatk_call_inputs = copy.deepcopy(inputs)
+    gatk_call_inputs.suffix = '.gatk'
     gatk_call_inputs.sorted = True
     gatk_call_inputs.preprocess = False
     gatk_call_inputs.run_vqsr = False
     gatk_call_inputs.joint_genotype = False
     gatk_call_inputs.output_dir = 's3://{s3_bucket}/analysis{dir_suffix}'.format(**args)
+    vars(gatk_call_inputs).update(gatk_ids)
 
     # get head GATK haplotype caller job function for the result of GATK preprocessing and encapsulate it
     gatk_gatk_call = job.wrapJobFn(run_gatk_germline_pipeline,
                                    GermlineSample(uuid,
                                                   'S3://{s3_bucket}/analysis{dir_suffix}/{uuid}/{uuid}.gatk.bam'.format(**args),
                                                   None, None),
-                                   gatk_call_inputs).encapsulate()
+                                   gatk_call_inputs,
+                                   staged=True).encapsulate()
 
     # wire up dag
     if not inputs.skip_alignment:
@@ -265,6 +321,78 @@ def static_dag(job, uuid, rg_line, inputs):
 
             gatk_preprocess.addChild(gatk_gatk_call)
 
+    # compare the calls made after ADAM preprocessing with those made after GATK preprocessing
+    if inputs.pipeline_to_run == "both":
+        compare = job.wrapJobFn(sample_concordance,
+                                uuid,
+                                gatk_adam_call.rv(),
+                                gatk_gatk_call.rv(),
+                                's3://{s3_bucket}/analysis{dir_suffix}'.format(**args),
+                                s3_key_path=inputs.ssec)
+        gatk_adam_call.addChild(compare)
+        gatk_gatk_call.addChild(compare)
+        return compare.rv()
+
+
+def sample_concordance(job, uuid, adam_vcfs, gatk_vcfs, output_dir, s3_key_path=None):
+    """
+    Compares the calls made after ADAM preprocessing with those made after GATK preprocessing, streaming both VCFs
+    from the file store, and writes the counts to <output_dir>/<uuid>/<uuid>.concordance.tsv
+
+    adam_vcfs, gatk_vcfs: Filtered VCFs by sample, as returned by run_gatk_germline_pipeline
+    return: Concordance of the sample
+    """
+    with job.fileStore.readGlobalFileStream(adam_vcfs[uuid]) as adam, \
+            job.fileStore.readGlobalFileStream(gatk_vcfs[uuid]) as gatk:
+        stats = concordance(adam, gatk, ('adam', 'gatk'))
+    filename = '{}.concordance.tsv'.format(uuid)
+    job.addChildJobFn(output_file_job,
+                      filename,
+                      _write_table(job, stats.write),
+                      os.path.join(output_dir, uuid),
+                      s3_key_path=s3_key_path)
+    return stats
+
+
+def cohort_concordance(job, concordances, output_dir, s3_key_path=None):
+    """
+    Sums up the concordance of all samples. Writes the summed counts to <output_dir>/cohort.concordance.tsv and the
+    summary of every sample to <output_dir>/cohort.concordance_by_sample.tsv
+
+    concordances: Concordance of each sample by UUID, None for samples that were not compared
+    """
+    concordances = {uuid: stats for uuid, stats in concordances.iteritems() if stats is not None}
+    if not concordances:
+        return
+    cohort = Concordance(('adam', 'gatk'))
+    for stats in concordances.itervalues():
+        cohort += stats
+    job.fileStore.logToMaster('Concordance of {} samples: {}'.format(
+        len(concordances), ', '.join('{}={}'.format(k, 'NA' if v is None else '{:.4f}'.format(v))
+                                     for k, v in cohort.summary())))
+
+    def write_by_sample(f):
+        metrics = [metric for metric, _ in cohort.summary()]
+        f.write('\t'.join(['sample'] + metrics) + '\n')
+        for name, stats in sorted(concordances.items()) + [('cohort', cohort)]:
+            summary = dict(stats.summary())
+            f.write('\t'.join([name] + ['NA' if summary[x] is None else '{:.4f}'.format(summary[x])
+                                         for x in metrics]) + '\n')
+
+    for filename, write in [('cohort.concordance.tsv', cohort.write),
+                            ('cohort.concordance_by_sample.tsv', write_by_sample)]:
+        job.addChildJobFn(output_file_job, filename, _write_table(job, write), output_dir, s3_key_path=s3_key_path)
+
+
+def _write_table(job, write):
+    """
+    Writes a table with write(f) to the file store and returns its FileStoreID
+    """
+    path = os.path.join(job.fileStore.getLocalTempDir(), 'table.tsv')
+    with open(path, 'w') as f:
+        write(f)
+    return job.fileStore.writeGlobalFile(path)
+
 
 def generate_mock_config():
 
@@ -455,7 +583,10 @@ def main():
             inputs.pipeline_to_run != "both"):
             raise ValueError("pipeline_to_run must be either 'adam', 'gatk', or 'both'. %s was passed." % inputs.pipeline_to_run)
 
-        Job.Runner.startToil(Job.wrapJobFn(sample_loop, uuid_list, inputs), args)
+        # The shared files are staged once, and the samples processed once all of them are in the file store
+        shared_files = Job.wrapJobFn(stage_shared_files, inputs).encapsulate()
+        shared_files.addChildJobFn(sample_loop, uuid_list, inputs, shared_files.rv())
+        Job.Runner.startToil(shared_files, args)
 
 if __name__=="__main__":
     main()
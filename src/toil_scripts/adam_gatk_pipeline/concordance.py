@@ -0,0 +1,292 @@
+#!/usr/bin/env python2.7
+"""
+Concordance of two call sets of one sample, e.g. the calls made after ADAM preprocessing and after GATK
+preprocessing.
+
+Both VCFs are read once, as streams, and merge-joined by contig, position and allele. Only the records at one position
+are held in memory at a time. Records with several ALT alleles are split into one variant per allele. Symbolic and
+spanning deletion alleles are skipped. The alleles of each variant are trimmed of their common trailing bases, so that
+the same variant matches when it is written differently in the two call sets.
+
+Every variant is counted by its type (transition, transversion, INDEL or OTHER) and by its status in each call set:
+PASS, FILTERED or absent (-). Variants that are filtered in either call set are also counted per filter. Variants that
+pass in both call sets are compared by the genotype of the first sample. Ti/Tv ratios and concordance rates are
+derived from these counts, so the counts of several samples add up to those of the cohort.
+
+Contigs are ordered as in the ##contig lines of the headers, which must declare every contig that has variants, and
+both VCFs must be sorted in that order. The order of undeclared contigs could only be guessed from the order in which
+the two streams happen to reach them.
+"""
+import argparse
+import gzip
+import re
+import sys
+from collections import Counter
+
+TRANSITIONS = {frozenset('AG'), frozenset('CT')}
+SNP_TYPES = ('transition', 'transversion')
+VARIANT_TYPES = SNP_TYPES + ('INDEL', 'OTHER')
+ABSENT = '-'
+
+_CONTIG = re.compile(r'^##contig=<.*?ID=([^,>]+)')
+
+
+def variant_type(ref, alt):
+    """
+    :param str ref: Reference allele
+    :param str alt: Alternate allele
+    :return: 'transition', 'transversion', 'INDEL' or 'OTHER'
+    :rtype: str
+    """
+    if len(ref) == len(alt) == 1:
+        return 'transition' if frozenset(ref + alt) in TRANSITIONS else 'transversion'
+    elif len(ref) != len(alt):
+        return 'INDEL'
+    return 'OTHER'
+
+
+def trim_alleles(ref, alt):
+    """
+    Removes the trailing bases that ref and alt share, leaving at least one base of each
+    """
+    while len(ref) > 1 and len(alt) > 1 and ref[-1] == alt[-1]:
+        ref, alt = ref[:-1], alt[:-1]
+    return ref, alt
+
+
+class VcfReader(object):
+    """
+    Reads the header of a VCF, then its variants grouped by position
+    """
+
+    def __init__(self, lines):
+        """
+        :param iter lines: Lines of the VCF
+        """
+        self.contigs = []
+        self._lines = iter(lines)
+        for line in self._lines:
+            if line.startswith('#CHROM'):
+                break
+            elif not line.startswith('##'):
+                raise ValueError('VCF has no #CHROM header line')
+            match = _CONTIG.match(line)
+            if match:
+                self.contigs.append(match.group(1))
+
+    def positions(self, ranks):
+        """
+        Yields the variants at every position, in order
+
+        :param dict ranks: Rank of every contig
+        :return: Generator of ((contig rank, position), {(ref, alt): (filters, genotype)}). The filters are a
+            frozenset, empty if the variant passed. The genotype is a sorted tuple of '0' (reference), '1' (this
+            variant), 'x' (another allele) or '.' (no call), or None if the VCF has no genotypes.
+        """
+        last, variants = None, {}
+        for line in self._lines:
+            if not line.strip():
+                continue
+            fields = line.rstrip('\r\n').split('\t', 10)
+            if len(fields) < 8:
+                raise ValueError('Malformed VCF record: {}'.format(line.rstrip()))
+            if fields[0] not in ranks:
+                raise ValueError('Contig {} is not declared in a ##contig line of either VCF, so the contig order is '
+                                 'unknown'.format(fields[0]))
+            key = (ranks[fields[0]], int(fields[1]))
+            if key != last:
+                if last is not None and key < last:
+                    raise ValueError('VCF is not sorted: {}:{} follows a later position'.format(fields[0],
+                                                                                               fields[1]))
+                if variants:
+                    yield last, variants
+                last, variants = key, {}
+            filters = frozenset() if fields[6] in ('PASS', '.') else frozenset(fields[6].split(';'))
+            alleles = _genotype_alleles(fields)
+            for i, alt in enumerate(fields[4].split(','), 1):
+                if alt in ('.', '*') or alt.startswith('<') or '[' in alt or ']' in alt:
+                    continue
+                genotype = None
+                if alleles is not None:
+                    genotype = tuple(sorted('0' if x == '0' else '1' if x == str(i) else '.' if x == '.' else 'x'
+                                            for x in alleles))
+                variants.setdefault(trim_alleles(fields[3].upper(), alt.upper()), (filters, genotype))
+        if variants:
+            yield last, variants
+
+
+def _genotype_alleles(fields):
+    """
+    Returns the alleles of the GT of the first sample of a record split into fields, or None
+    """
+    if len(fields) < 10:
+        return None
+    try:
+        index = fields[8].split(':').index('GT')
+        return re.split(r'[/|]', fields[9].split(':')[index])
+    except (ValueError, IndexError):
+        return None
+
+
+def merge_join(first, second):
+    """
+    Merge-joins two sorted streams of (key, variants)
+
+    :return: Generator of (key, variants in first, variants in second), where either may be empty
+    """
+    a, b = next(first, None), next(second, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[0] < b[0]):
+            yield a[0], a[1], {}
+            a = next(first, None)
+        elif a is None or b[0] < a[0]:
+            yield b[0], {}, b[1]
+            b = next(second, None)
+        else:
+            yield a[0], a[1], b[1]
+            a, b = next(first, None), next(second, None)
+
+
+def _status(call):
+    if call is None:
+        return ABSENT
+    return 'FILTERED' if call[0] else 'PASS'
+
+
+class Concordance(object):
+    """
+    Counts of the variants of two call sets of one sample, or summed over a cohort
+    """
+
+    def __init__(self, names=('first', 'second')):
+        """
+        :param tuple(str, str) names: Names of the two call sets
+        """
+        self.names = tuple(names)
+        # (section, name, status in first, status in second) -> number of variants
+        self.counts = Counter()
+
+    def __iadd__(self, other):
+        self.counts.update(other.counts)
+        return self
+
+    def add(self, ref, alt, first, second):
+        """
+        Counts a variant
+
+        :param tuple first: (filters, genotype) of the variant in the first call set, or None if it is absent
+        :param tuple second: Same for the second call set
+        """
+        kind = variant_type(ref, alt)
+        statuses = _status(first), _status(second)
+        self.counts['sites', kind, statuses[0], statuses[1]] += 1
+        for name in (first[0] if first else frozenset()) | (second[0] if second else frozenset()):
+            # The filter itself where it was applied, otherwise the variant's status
+            self.counts['filter', name,
+                        name if first and name in first[0] else statuses[0],
+                        name if second and name in second[0] else statuses[1]] += 1
+        if statuses == ('PASS', 'PASS') and first[1] is not None and second[1] is not None:
+            self.counts['genotype', kind, 'same' if first[1] == second[1] else 'different', ''] += 1
+
+    def _sites(self, kinds, predicate):
+        return sum(n for (section, kind, s1, s2), n in self.counts.iteritems()
+                   if section == 'sites' and kind in kinds and predicate(s1, s2))
+
+    def titv(self, predicate):
+        """
+        Ti/Tv ratio of the SNPs whose statuses in the two call sets satisfy predicate(status1, status2)
+
+        :rtype: float|None
+        """
+        tv = self._sites(['transversion'], predicate)
+        return float(self._sites(['transition'], predicate)) / tv if tv else None
+
+    def summary(self):
+        """
+        Ti/Tv ratios and concordance rates
+
+        :return: (metric, value) pairs, where value is None if undefined
+        :rtype: list[tuple(str, float|None)]
+        """
+        first, second = self.names
+        metrics = []
+        for name, predicate in [(first, lambda s1, s2: s1 == 'PASS'),
+                                (second, lambda s1, s2: s2 == 'PASS'),
+                                ('shared', lambda s1, s2: s1 == s2 == 'PASS'),
+                                (first + '_only', lambda s1, s2: s1 == 'PASS' and s2 != 'PASS'),
+                                (second + '_only', lambda s1, s2: s2 == 'PASS' and s1 != 'PASS')]:
+            metrics.append(('titv_' + name, self.titv(predicate)))
+        for name, kinds in [('snp', SNP_TYPES), ('indel', ['INDEL'])]:
+            either = self._sites(kinds, lambda s1, s2: 'PASS' in (s1, s2))
+            both = self._sites(kinds, lambda s1, s2: s1 == s2 == 'PASS')
+            metrics.append((name + '_concordance', float(both) / either if either else None))
+        same = sum(n for key, n in self.counts.iteritems() if key[0] == 'genotype' and key[2] == 'same')
+        compared = sum(n for key, n in self.counts.iteritems() if key[0] == 'genotype')
+        metrics.append(('genotype_concordance', float(same) / compared if compared else None))
+        return metrics
+
+    def write(self, f):
+        """
+        Writes the counts, followed by the summary, as a tab-separated table
+        """
+        f.write('\t'.join(('section', 'name') + self.names + ('count',)) + '\n')
+        for key in sorted(self.counts):
+            f.write('\t'.join(key + (str(self.counts[key]),)) + '\n')
+        for metric, value in self.summary():
+            f.write('\t'.join(['summary', metric, '', '', 'NA' if value is None else '{:.4f}'.format(value)]) + '\n')
+
+    @classmethod
+    def read(cls, f):
+        """
+        Reads the counts from a table written by write()
+
+        :rtype: Concordance
+        """
+        header = next(f).rstrip('\n').split('\t')
+        self = cls(header[2:4])
+        for line in f:
+            section, name, s1, s2, count = line.rstrip('\n').split('\t')
+            if section != 'summary':
+                self.counts[section, name, s1, s2] += int(count)
+        return self
+
+
+def concordance(first, second, names=('first', 'second')):
+    """
+    Compares two call sets of one sample
+
+    :param iter first: Lines of the VCF of the first call set
+    :param iter second: Lines of the VCF of the second call set
+    :param tuple(str, str) names: Names of the call sets
+    :rtype: Concordance
+    """
+    first, second = VcfReader(first), VcfReader(second)
+    ranks = {}
+    for contig in first.contigs + second.contigs:
+        ranks.setdefault(contig, len(ranks))
+    stats = Concordance(names)
+    for _, a, b in merge_join(first.positions(ranks), second.positions(ranks)):
+        for ref, alt in sorted(set(a) | set(b)):
+            stats.add(ref, alt, a.get((ref, alt)), b.get((ref, alt)))
+    return stats
+
+
+def _open(path):
+    return gzip.open(path) if path.endswith('.gz') else open(path)
+
+
+def main():
+    """
+    Compares two VCFs of the same sample, writing a concordance table to stdout
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('first', help='Path of the first VCF, which may be gzipped')
+    parser.add_argument('second', help='Path of the second VCF, which may be gzipped')
+    parser.add_argument('--names', nargs=2, default=['first', 'second'], help='Names of the two call sets')
+    args = parser.parse_args()
+    with _open(args.first) as first, _open(args.second) as second:
+        concordance(first, second, args.names).write(sys.stdout)
+
+
+if __name__ == '__main__':
+    main()
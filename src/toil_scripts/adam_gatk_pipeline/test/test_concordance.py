@@ -0,0 +1,61 @@
+from StringIO import StringIO
+from unittest import TestCase
+
+from toil_scripts.adam_gatk_pipeline.concordance import Concordance, concordance
+
+
+def vcf(*records):
+    """
+    Builds a VCF of one sample with contigs 1 and 2 from records of (contig, position, ref, alt, filter, genotype)
+    """
+    lines = ['##fileformat=VCFv4.1', '##contig=<ID=1,length=1000>', '##contig=<ID=2,length=1000>',
+             '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tNA12878']
+    lines += ['{}\t{}\t.\t{}\t{}\t50\t{}\t.\tGT:DP\t{}:30'.format(*record) for record in records]
+    return StringIO('\n'.join(lines) + '\n')
+
+
+class ConcordanceTest(TestCase):
+
+    def test_concordance(self):
+        adam = vcf(('1', 10, 'A', 'G', 'PASS', '0/1'),
+                   ('1', 20, 'C', 'A', 'PASS', '1/1'),
+                   ('1', 30, 'ATT', 'A,AT', 'LowQual', '1/2'),
+                   ('2', 5, 'T', 'C', 'PASS', '0/1'))
+        gatk = vcf(('1', 10, 'A', 'G', 'PASS', '1/1'),
+                   ('1', 25, 'G', 'T', 'PASS', '0/1'),
+                   ('1', 30, 'AT', 'A', 'PASS', '0/1'),
+                   ('2', 5, 'T', 'C', '.', '0|1'))
+        stats = concordance(adam, gatk, ('adam', 'gatk'))
+        self.assertEqual(stats.counts, {('sites', 'transition', 'PASS', 'PASS'): 2,
+                                        ('sites', 'transversion', 'PASS', '-'): 1,
+                                        ('sites', 'transversion', '-', 'PASS'): 1,
+                                        ('sites', 'INDEL', 'FILTERED', 'PASS'): 1,
+                                        ('sites', 'INDEL', 'FILTERED', '-'): 1,
+                                        ('filter', 'LowQual', 'LowQual', 'PASS'): 1,
+                                        ('filter', 'LowQual', 'LowQual', '-'): 1,
+                                        ('genotype', 'transition', 'different', ''): 1,
+                                        ('genotype', 'transition', 'same', ''): 1})
+        summary = dict(stats.summary())
+        self.assertEqual(summary['titv_adam'], 2.0)
+        self.assertEqual(summary['titv_shared'], None)
+        self.assertEqual(summary['snp_concordance'], 0.5)
+        self.assertEqual(summary['indel_concordance'], 0.0)
+        self.assertEqual(summary['genotype_concordance'], 0.5)
+
+        # Tables of samples add up to that of the cohort
+        table = StringIO()
+        stats.write(table)
+        table.seek(0)
+        cohort = Concordance(('adam', 'gatk'))
+        cohort += Concordance.read(table)
+        cohort += stats
+        self.assertEqual(cohort.counts[('sites', 'transition', 'PASS', 'PASS')], 4)
+        self.assertEqual(cohort.summary(), stats.summary())
+
+    def test_unsorted(self):
+        with self.assertRaises(ValueError):
+            concordance(vcf(('1', 20, 'A', 'G', 'PASS', '0/1'), ('1', 10, 'A', 'G', 'PASS', '0/1')), vcf())
+
+    def test_undeclared_contig(self):
+        with self.assertRaises(ValueError):
+            concordance(vcf(('1', 10, 'A', 'G', 'PASS', '0/1'), ('X', 10, 'A', 'G', 'PASS', '0/1')), vcf())
@@ -5,17 +5,31 @@ Spark demo application.
 # imports from python core
 import argparse
 import logging
+import multiprocessing
+import os
 import shlex
+import shutil
+from urlparse import urlparse
+
+# imports from toil
+from toil.job import Job
 
 # imports from toil_scripts
 from toil_lib import require
 from toil_lib.tools.spark_tools import call_adam, call_conductor, \
     MasterAddress, HDFS_MASTER_PORT, SPARK_MASTER_PORT
 from toil_lib.spark import spawn_spark_cluster
+from toil_lib.urls import download_url, s3am_upload
+
+from toil_scripts.adam_pipeline.autosize import autosize
+from toil_scripts.admission import url_size
 
 
 _log = logging.getLogger(__name__)
 
+# Inputs the local engine can count
+LOCAL_SUFFIXES = ('.fq', '.fastq', '.fq.gz', '.fastq.gz')
+
 
 def kmer_dag(job,
              input_file,
@@ -25,10 +39,15 @@ def kmer_dag(job,
              workers,
              cores,
              memory,
-             sudo):
+             sudo,
+             autosize_cluster=False,
+             engine='spark',
+             local_threshold=None,
+             canonical=False,
+             output_format='text'):
     '''
     Optionally launches a Spark cluster and then runs ADAM to count k-mers on an
-    input file.
+    input file, or counts them on a single node without Spark.
 
     :param job: Toil job
     :param input_file: URL/path to input file to count k-mers on
@@ -43,6 +62,16 @@ def kmer_dag(job,
     :param memory: Amount of memory to provided to Spark workers. Must be set \
     if workers is set.
     :param sudo: Whether or not to run Spark containers with sudo.
+    :param autosize_cluster: If true, the number of workers (at most \
+    `workers`), their memory (at most `memory`) and the number of partitions \
+    are chosen from the size of the input.
+    :param engine: 'spark' to count with ADAM, 'local' to count on one node, \
+    or 'auto' to count FASTQs of at most local_threshold bytes locally. The \
+    local engine skips k-mers with bases other than ACGT, which ADAM counts.
+    :param local_threshold: Size in bytes up to which 'auto' counts locally.
+    :param canonical: Count canonical k-mers. Local engine only.
+    :param output_format: 'text' or 'index' (see kmer_index). Local engine \
+    only; text output of ADAM can be indexed with `kmer_index build`.
 
     :type job: toil.Job
     :type input_file: string
@@ -53,25 +82,103 @@ def kmer_dag(job,
     :type cores: int or None
     :type memory: int or None
     :type sudo: boolean
+    :type autosize_cluster: boolean
+    :type engine: string
+    :type local_threshold: int or None
+    :type canonical: boolean
+    :type output_format: string
     '''
 
+    if engine == 'auto':
+        size = url_size(input_file) if input_file.endswith(LOCAL_SUFFIXES) else None
+        engine = 'local' if size is not None and local_threshold and size <= local_threshold else 'spark'
+        job.fileStore.logToMaster('Counting k-mers of %s (%s bytes) with the %s engine.' % (input_file, size, engine))
+        if engine == 'local':
+            job.fileStore.logToMaster('Unlike ADAM, the local engine skips k-mers that contain a base other than A, C, '
+                                      'G or T, so counts of %s differ from --engine spark if it has any.' % input_file)
+    require(not canonical or engine == 'local', 'Canonical k-mers are only counted by the local engine.')
+    require(output_format == 'text' or engine == 'local', 'Only the local engine writes k-mer index files.')
+    if engine == 'local':
+        require(input_file.endswith(LOCAL_SUFFIXES), 'The local engine counts FASTQs only, not %s.' % input_file)
+        job.addChildJobFn(count_local,
+                          input_file, output_path, kmer_length, canonical, output_format,
+                          cores=cores or multiprocessing.cpu_count(),
+                          memory='%dG' % memory if memory else None)
+        return
+
     require((spark_conf is not None and workers is None) or
-            (workers is not None and cores is not None and memory is not None and spark_conf is not None),
+            (workers is not None and cores is not None and memory is not None and spark_conf is None),
             "Either worker count (--workers) must be defined or user must pass in Spark configuration (--spark-conf).")
 
     # if we do not have a spark configuration, then we must spawn a cluster
+    partitions = None
     if spark_conf is None:
+        if autosize_cluster:
+            sizing = autosize(input_file, workers, memory, cores, job.fileStore.getLocalTempDir())
+            job.fileStore.logToMaster('Autosized Spark cluster for %s: %s' % (input_file, sizing))
+            workers, memory, partitions = sizing.workers, sizing.memory, sizing.partitions
         master_hostname = spawn_spark_cluster(job,
                                               sudo,
                                               workers,
-                                              cores)
+                                              cores,
+                                              memory=memory)
     else:
+        master_hostname = None
         spark_conf = shlex.split(spark_conf)
 
     job.addChildJobFn(download_count_upload,
-                      masterHostname,
-                      input_file, output_file, kmer_length,
-                      spark_conf, memory, sudo)
+                      master_hostname,
+                      input_file, output_path, kmer_length,
+                      spark_conf, memory, sudo, partitions)
+
+def count_local(job,
+                input_file,
+                output_path,
+                kmer_length,
+                canonical,
+                output_format='text'):
+    '''
+    Counts k-mers of a FASTQ on this node with all the cores of the job, and
+    writes them out in the format of ADAM's count_kmers.
+
+    :param job: Toil job
+    :param input_file: URL/path to the FASTQ
+    :param output_path: Local directory or S3 URL to save k-mer counts at
+    :param kmer_length: The length of k-mer substrings to count.
+    :param canonical: Whether to count canonical k-mers.
+    :param output_format: 'text' for ADAM's format, 'index' for a k-mer index.
+
+    :type job: toil.Job
+    :type input_file: string
+    :type output_path: string
+    :type kmer_length: int or string
+    :type canonical: boolean
+    :type output_format: string
+    '''
+    # numpy is only needed by the local engine
+    from toil_scripts.adam_kmers.local_kmers import count_kmers_local
+
+    work_dir = job.fileStore.getLocalTempDir()
+    if urlparse(input_file).scheme in ('', 'file'):
+        local_input = urlparse(input_file).path
+    else:
+        local_input = download_url(job=job, url=input_file, work_dir=work_dir)
+
+    upload = output_path.startswith('s3://')
+    require(upload or urlparse(output_path).scheme in ('', 'file'),
+            'The local engine writes to a local directory or S3, not %s.' % output_path)
+    output_dir = os.path.join(work_dir, 'kmers') if upload else urlparse(output_path).path
+    total, distinct = count_kmers_local(local_input, output_dir, int(kmer_length),
+                                        cores=int(job.cores), canonical=canonical, work_dir=work_dir,
+                                        output_format=output_format)
+    _log.info('Counted %d %s-mers, %d distinct, in %s.', total, kmer_length, distinct, input_file)
+
+    if upload:
+        _log.info("Uploading output files to %s.", output_path)
+        for name in sorted(os.listdir(output_dir)):
+            s3am_upload(job=job, fpath=os.path.join(output_dir, name), s3_dir=output_path)
+        shutil.rmtree(output_dir)
+
 
 def download_count_upload(job,
                           master_ip,
@@ -80,7 +187,8 @@ def download_count_upload(job,
                           kmer_length,
                           spark_conf,
                           memory,
-                          sudo):
+                          sudo,
+                          partitions=None):
     '''
     Runs k-mer counting.
 
@@ -98,6 +206,7 @@ def download_count_upload(job,
     :param memory: Amount of memory to provided to Spark workers. Must be set \
     if spark_conf is not set.
     :param sudo: Whether or not to run Spark containers with sudo.
+    :param partitions: Optional number of partitions to count k-mers in.
 
     :type job: toil.Job
     :type input_file: string
@@ -106,9 +215,11 @@ def download_count_upload(job,
     :type spark_conf: list of string or None
     :type memory: int or None
     :type sudo: boolean
+    :type partitions: int or None
     '''
 
     if master_ip is not None:
+        master_ip = MasterAddress(master_ip)
         hdfs_dir = "hdfs://{0}:{1}/".format(master_ip, HDFS_MASTER_PORT)
     else:
         _log.warn('Master IP is not set. If default filesystem is not set, jobs may fail.')
@@ -147,17 +258,18 @@ def download_count_upload(job,
         hdfs_tmp_file = hdfs_input_file
 
         # change the file extension to adam
-        hdfs_input_file = '.'.join(hdfs_input_file.split('.')[:-1].append('adam'))
+        hdfs_input_file = '.'.join(hdfs_input_file.split('.')[:-1] + ['adam'])
 
         # convert the file
         _log.info('Converting %s into ADAM format at %s.', hdfs_tmp_file, hdfs_input_file)
         call_adam(job, master_ip,
                   ['transform',
-                   hdfs_tmp_file, hdfs_input_file],
+                   hdfs_tmp_file, hdfs_input_file] +
+                  (['-repartition', str(partitions)] if partitions else []),
                   memory=memory, override_parameters=spark_conf)
         
     # run k-mer counting
-    _log.info('Counting %d-mers in %s, and saving to %s.',
+    _log.info('Counting %s-mers in %s, and saving to %s.',
               kmer_length, hdfs_input_file, hdfs_output_file)
     call_adam(job, master_ip,
               ['count_kmers',
@@ -204,6 +316,31 @@ def main():
                         help='Number of workers to spin up in Toil. Either this or --spark-conf must be specified. If this is specified, --memory and --cores must be specified.',
                         default=None,
                         type=int)
+    parser.add_argument('--autosize',
+                        help='Choose the number of workers (at most --workers), their memory (at most --memory) and '
+                             'the number of partitions from the size of the input. The decision is logged.',
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--engine',
+                        help='spark (the default) counts with ADAM; local counts a FASTQ on a single node without '
+                             'Spark, skipping k-mers with bases other than ACGT, which ADAM counts; auto counts '
+                             'FASTQs up to --local-threshold locally and everything else with Spark.',
+                        choices=['auto', 'spark', 'local'],
+                        default='spark')
+    parser.add_argument('--local-threshold',
+                        help='Largest input in bytes that --engine auto counts locally. Defaults to 10 GB.',
+                        default=10 * 1000 ** 3,
+                        type=int)
+    parser.add_argument('--canonical',
+                        help='Count canonical k-mers, i.e. each k-mer together with its reverse complement. '
+                             'Only supported by the local engine.',
+                        default=False,
+                        action='store_true')
+    parser.add_argument('--output-format',
+                        help='text writes "KMER, COUNT" lines; index writes a compact k-mer index file with '
+                             'lookups (local engine only, see kmer_index.py).',
+                        choices=['text', 'index'],
+                        default='text')
     parser.add_argument('--sudo',
                         help='Run docker containers with sudo. Defaults to False.',
                         default=False,
@@ -211,15 +348,25 @@ def main():
 
     Job.Runner.addToilOptions(parser)
     args = parser.parse_args()
+    if args.autosize:
+        require(args.workers is not None and args.memory is not None,
+                '--autosize needs --workers and --memory as upper bounds.')
+        if args.cores is None:
+            args.cores = multiprocessing.cpu_count()
     Job.Runner.startToil(Job.wrapJobFn(kmer_dag,
-                                       args.kmer_length,
                                        args.input_path,
                                        args.output_path,
+                                       args.kmer_length,
                                        args.spark_conf,
                                        args.workers,
                                        args.cores,
                                        args.memory,
                                        args.sudo,
+                                       autosize_cluster=args.autosize,
+                                       engine=args.engine,
+                                       local_threshold=args.local_threshold,
+                                       canonical=args.canonical,
+                                       output_format=args.output_format,
                                        checkpoint=True), args)
     
 if __name__ == "__main__":
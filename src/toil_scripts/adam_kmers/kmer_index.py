@@ -0,0 +1,447 @@
+#!/usr/bin/env python2.7
+"""
+Compact, indexed file format for k-mer counts.
+
+Text output ("KMER, COUNT" lines) takes about k + 8 bytes per k-mer and can only be searched by reading all of it.
+A k-mer index file holds the k-mers sorted and 2-bit encoded, in blocks of up to BLOCK_SIZE k-mers. Within a block
+every k-mer is stored as the varint difference to the previous one, followed by its count as a varint. That takes
+a few bytes per k-mer. The file ends with one entry per block: the block's first k-mer, its offset and its length.
+
+    header   MAGIC, k (uint32), block size (uint32), number of k-mers (uint64), number of blocks (uint64),
+             offset of the block index (uint64)
+    blocks   varint pairs (k-mer - previous k-mer, count); the first difference is to the block's first k-mer
+    index    per block: first k-mer (uint64), offset (uint64), number of k-mers (uint32)
+
+KmerIndex reads such a file through mmap. A point lookup binary-searches the block index, which is held in memory,
+and decodes a single block. Prefix scans decode only the blocks that overlap the prefix's range.
+
+Indexes are built with KmerIndexWriter from sorted counts, with build_index() from the text output of
+`adam count_kmers` or of the local engine, and combined by merge_indexes(), which adds up the counts of k-mers
+present in several inputs. Indexes of disjoint, increasing ranges of k-mers are joined by concatenate_indexes(),
+which copies their blocks without decoding them. K-mers are at most 32 bases long; k-mers with bases other than A,
+C, G or T cannot be encoded and are skipped.
+"""
+import argparse
+import heapq
+import logging
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+from bisect import bisect_right
+from itertools import groupby
+
+log = logging.getLogger(__name__)
+
+MAGIC = 'KMERIDX1'
+BLOCK_SIZE = 256
+_HEADER = struct.Struct('<8sIIQQQ')
+_ENTRY = struct.Struct('<QQI')
+_ENCODE = {'A': 0, 'C': 1, 'G': 2, 'T': 3, 'a': 0, 'c': 1, 'g': 2, 't': 3}
+_DECODE = 'ACGT'
+
+
+def encode(kmer):
+    """
+    Returns a k-mer as an integer of 2 bits per base
+
+    :param str kmer: k-mer of A, C, G and T
+    :rtype: int
+    """
+    value = 0
+    for base in kmer:
+        value = (value << 2) | _ENCODE[base]
+    return value
+
+
+def decode(value, k):
+    """
+    Returns the k-mer encoded by encode()
+
+    :param int value: Encoded k-mer
+    :param int k: k-mer length
+    :rtype: str
+    """
+    return ''.join(_DECODE[(value >> (2 * i)) & 3] for i in xrange(k - 1, -1, -1))
+
+
+def _varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return out
+
+
+class KmerIndexWriter(object):
+    """
+    Writes a k-mer index file from counts added in increasing order of k-mer.
+    """
+
+    def __init__(self, path, k, block_size=BLOCK_SIZE):
+        """
+        :param str path: Path of the index file
+        :param int k: k-mer length, at most 32
+        :param int block_size: Number of k-mers per block. Smaller blocks make lookups faster and the index larger.
+        """
+        if not 0 < k <= 32:
+            raise ValueError('k-mers must be 1 to 32 bases long, not {}'.format(k))
+        self.path = path
+        self.k = k
+        self.block_size = block_size
+        self.f = open(path, 'wb')
+        self.f.write(_HEADER.pack(MAGIC, k, block_size, 0, 0, 0))
+        self.entries = []
+        self.block = bytearray()
+        self.in_block = 0
+        self.previous = None
+        self.num_kmers = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+            os.remove(self.path)
+
+    def add(self, kmer, count):
+        """
+        :param int kmer: Encoded k-mer, greater than the previous one
+        :param int count: Number of occurrences
+        """
+        if self.previous is not None and kmer <= self.previous:
+            raise ValueError('k-mers must be added in increasing order')
+        if self.in_block == 0:
+            self.entries.append((kmer, self.f.tell() + len(self.block)))
+            delta = 0
+        else:
+            delta = kmer - self.previous
+        self.block += _varint(delta)
+        self.block += _varint(count)
+        self.in_block += 1
+        self.previous = kmer
+        self.num_kmers += 1
+        if self.in_block == self.block_size:
+            self._flush()
+
+    def add_block(self, first, last, data, length):
+        """
+        Adds a block that was encoded beforehand, e.g. copied from another index
+
+        :param int first: First encoded k-mer of the block, greater than the previous one
+        :param int last: Last encoded k-mer of the block, or an upper bound of it below the next k-mer added
+        :param bytes data: Varint pairs of the block, as described above
+        :param int length: Number of k-mers in the block
+        """
+        if self.previous is not None and first <= self.previous:
+            raise ValueError('k-mers must be added in increasing order')
+        self._flush()
+        self.entries.append((first, self.f.tell(), length))
+        self.f.write(data)
+        self.previous = last
+        self.num_kmers += length
+
+    def _flush(self):
+        if self.in_block:
+            kmer, offset = self.entries[-1]
+            self.entries[-1] = (kmer, offset, self.in_block)
+            self.f.write(self.block)
+            self.block = bytearray()
+            self.in_block = 0
+
+    def close(self):
+        self._flush()
+        index_offset = self.f.tell()
+        for entry in self.entries:
+            self.f.write(_ENTRY.pack(*entry))
+        self.f.seek(0)
+        self.f.write(_HEADER.pack(MAGIC, self.k, self.block_size, self.num_kmers, len(self.entries), index_offset))
+        self.f.close()
+
+
+class KmerIndex(object):
+    """
+    Memory-mapped reader of a k-mer index file.
+    """
+
+    def __init__(self, path):
+        """
+        :param str path: Path of the index file
+        """
+        self.path = path
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < _HEADER.size:
+                raise RuntimeError('{} is not a k-mer index'.format(path))
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.k, self.block_size, self.num_kmers, num_blocks, index_offset = _HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC:
+            raise RuntimeError('{} is not a k-mer index'.format(path))
+        self.first_kmers, self.offsets, self.lengths = [], [], []
+        for i in xrange(num_blocks):
+            first, offset, length = _ENTRY.unpack_from(self.map, index_offset + i * _ENTRY.size)
+            self.first_kmers.append(first)
+            self.offsets.append(offset)
+            self.lengths.append(length)
+        self.offsets.append(index_offset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.map.close()
+
+    def __len__(self):
+        return self.num_kmers
+
+    def _block(self, i):
+        """
+        Yields the (encoded k-mer, count) pairs of block i
+        """
+        data = bytearray(self.map[self.offsets[i]:self.offsets[i + 1]])
+        kmer = self.first_kmers[i]
+        pos = 0
+        for _ in xrange(self.lengths[i]):
+            values = []
+            for _ in xrange(2):
+                value, shift = 0, 0
+                while True:
+                    byte = data[pos]
+                    pos += 1
+                    value |= (byte & 0x7f) << shift
+                    if byte < 0x80:
+                        break
+                    shift += 7
+                values.append(value)
+            kmer += values[0]
+            yield kmer, values[1]
+
+    def _from(self, lo):
+        """
+        Yields the (encoded k-mer, count) pairs of all k-mers from lo on
+        """
+        for i in xrange(max(bisect_right(self.first_kmers, lo) - 1, 0), len(self.first_kmers)):
+            for kmer, count in self._block(i):
+                if kmer >= lo:
+                    yield kmer, count
+
+    def get(self, kmer):
+        """
+        Returns the count of a k-mer
+
+        :param str|int kmer: k-mer, or encoded k-mer
+        :return: Count, 0 if the k-mer is absent
+        :rtype: int
+        """
+        if isinstance(kmer, basestring):
+            if len(kmer) != self.k:
+                raise ValueError('Expected a {}-mer, got {}'.format(self.k, kmer))
+            kmer = encode(kmer)
+        i = bisect_right(self.first_kmers, kmer) - 1
+        if i < 0:
+            return 0
+        for value, count in self._block(i):
+            if value >= kmer:
+                return count if value == kmer else 0
+        return 0
+
+    def __getitem__(self, kmer):
+        return self.get(kmer)
+
+    def prefix(self, prefix):
+        """
+        Yields the k-mers that start with a prefix, with their counts, in order
+
+        :param str prefix: Prefix of at most k bases
+        """
+        shift = 2 * (self.k - len(prefix))
+        if shift < 0:
+            raise ValueError('Prefix {} is longer than k = {}'.format(prefix, self.k))
+        lo = encode(prefix) << shift
+        hi = lo + (1 << shift)
+        for kmer, count in self._from(lo):
+            if kmer >= hi:
+                return
+            yield decode(kmer, self.k), count
+
+    def __iter__(self):
+        """
+        Yields every (encoded k-mer, count) pair, in order
+        """
+        for i in xrange(len(self.first_kmers)):
+            for item in self._block(i):
+                yield item
+
+    def items(self):
+        """
+        Yields every (k-mer, count) pair, in order
+        """
+        for kmer, count in self:
+            yield decode(kmer, self.k), count
+
+
+def merge_indexes(paths, output_path, block_size=BLOCK_SIZE):
+    """
+    Merges k-mer index files into one, adding up the counts of k-mers present in several of them
+
+    :param list[str] paths: Paths of the index files, which must have the same k
+    :param str output_path: Path of the merged index file
+    :param int block_size: Number of k-mers per block of the output
+    :return: Number of distinct k-mers
+    :rtype: int
+    """
+    indexes = [KmerIndex(x) for x in paths]
+    try:
+        ks = set(x.k for x in indexes)
+        if len(ks) != 1:
+            raise ValueError('Cannot merge indexes of different k: {}'.format(', '.join(map(str, sorted(ks)))))
+        with KmerIndexWriter(output_path, ks.pop(), block_size=block_size) as writer:
+            for kmer, items in groupby(heapq.merge(*indexes), key=lambda x: x[0]):
+                writer.add(kmer, sum(count for _, count in items))
+            return writer.num_kmers
+    finally:
+        for index in indexes:
+            index.close()
+
+
+def concatenate_indexes(paths, output_path):
+    """
+    Concatenates k-mer index files block by block, without decoding them
+
+    :param list[str] paths: Paths of the index files, which must have the same k, in increasing order of k-mer. The
+        k-mers of each must all be greater than those of the previous one.
+    :param str output_path: Path of the concatenated index file
+    :return: Number of k-mers
+    :rtype: int
+    """
+    indexes = [KmerIndex(x) for x in paths]
+    try:
+        ks = set(x.k for x in indexes)
+        if len(ks) != 1:
+            raise ValueError('Cannot concatenate indexes of different k: {}'.format(', '.join(map(str, sorted(ks)))))
+        with KmerIndexWriter(output_path, ks.pop(), block_size=indexes[0].block_size) as writer:
+            for index in indexes:
+                num_blocks = len(index.first_kmers)
+                for i, first in enumerate(index.first_kmers):
+                    # Only the last block of each index is decoded, for its last k-mer
+                    last = index.first_kmers[i + 1] - 1 if i + 1 < num_blocks else list(index._block(i))[-1][0]
+                    writer.add_block(first, last, index.map[index.offsets[i]:index.offsets[i + 1]],
+                                     index.lengths[i])
+            return writer.num_kmers
+    finally:
+        for index in indexes:
+            index.close()
+
+
+def parse_counts(path):
+    """
+    Yields the (k-mer, count) pairs of a text file of "KMER, COUNT" lines
+
+    :param str path: Path of the text file
+    """
+    with open(path) as f:
+        for line in f:
+            kmer, _, count = line.rstrip('\n').rpartition(',')
+            yield kmer.strip(), int(count)
+
+
+def build_index(text_paths, output_path, block_size=BLOCK_SIZE, work_dir=None):
+    """
+    Builds a k-mer index file from text k-mer counts, e.g. the part files written by `adam count_kmers`
+
+    Each text file is sorted in memory on its own, so each must fit in memory. Counts of a k-mer that appears in
+    several files are added up.
+
+    :param list[str] text_paths: Text files of "KMER, COUNT" lines, or directories of part-* files
+    :param str output_path: Path of the index file
+    :param int block_size: Number of k-mers per block
+    :param str work_dir: Directory for the sorted runs. Defaults to the system's temporary directory.
+    :return: Number of distinct k-mers
+    :rtype: int
+    """
+    paths = []
+    for path in text_paths:
+        if os.path.isdir(path):
+            paths.extend(os.path.join(path, x) for x in sorted(os.listdir(path)) if x.startswith('part-'))
+        else:
+            paths.append(path)
+    run_dir = tempfile.mkdtemp(prefix='kmer_runs', dir=work_dir)
+    try:
+        runs = []
+        k = None
+        skipped = 0
+        for path in paths:
+            counts = {}
+            for kmer, count in parse_counts(path):
+                if k is None:
+                    k = len(kmer)
+                elif len(kmer) != k:
+                    raise ValueError('{} holds k-mers of different lengths'.format(path))
+                try:
+                    value = encode(kmer)
+                except KeyError:
+                    skipped += 1
+                    continue
+                counts[value] = counts.get(value, 0) + count
+            if not counts:
+                continue
+            run = os.path.join(run_dir, '{}.kmi'.format(len(runs)))
+            with KmerIndexWriter(run, k, block_size=block_size) as writer:
+                for value in sorted(counts):
+                    writer.add(value, counts[value])
+            runs.append(run)
+        if skipped:
+            log.warn('Skipped %d k-mers with bases other than A, C, G or T.', skipped)
+        if not runs:
+            raise ValueError('No k-mers found in {}'.format(', '.join(text_paths)))
+        if len(runs) == 1:
+            shutil.move(runs[0], output_path)
+            with KmerIndex(output_path) as index:
+                return len(index)
+        return merge_indexes(runs, output_path, block_size=block_size)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def main():
+    """
+    Builds, queries and merges k-mer index files
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    subparsers = parser.add_subparsers(dest='command')
+    build = subparsers.add_parser('build', help='Builds an index from text k-mer counts')
+    build.add_argument('output', help='Path of the index file')
+    build.add_argument('inputs', nargs='+', help='Text files of "KMER, COUNT" lines, or directories of part files')
+    get = subparsers.add_parser('get', help='Prints the counts of k-mers')
+    get.add_argument('index', help='Path of the index file')
+    get.add_argument('kmers', nargs='+')
+    prefix = subparsers.add_parser('prefix', help='Prints the k-mers that start with a prefix, with their counts')
+    prefix.add_argument('index', help='Path of the index file')
+    prefix.add_argument('prefix')
+    merge = subparsers.add_parser('merge', help='Merges indexes, adding up counts')
+    merge.add_argument('output', help='Path of the merged index file')
+    merge.add_argument('inputs', nargs='+', help='Index files')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'build':
+        log.info('Indexed %d k-mers.', build_index(args.inputs, args.output))
+    elif args.command == 'merge':
+        log.info('Merged into %d k-mers.', merge_indexes(args.inputs, args.output))
+    else:
+        with KmerIndex(args.index) as index:
+            items = ((x, index.get(x)) for x in args.kmers) if args.command == 'get' else index.prefix(args.prefix)
+            for kmer, count in items:
+                sys.stdout.write('{}, {}\n'.format(kmer, count))
+
+
+if __name__ == '__main__':
+    main()
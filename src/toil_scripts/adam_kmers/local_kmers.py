@@ -0,0 +1,303 @@
+#!/usr/bin/env python2.7
+"""
+Single-node k-mer counting, without Spark.
+
+count_kmers_local() counts the k-mers of a FASTQ on a pool of processes, in two phases:
+
+1. Map: chunks of reads are 2-bit packed and turned into k-mers, at most 32 bases long, with vectorized NumPy
+   operations. Each k-mer is one uint64. The k-mers of a chunk are counted and written out in hash-partitioned
+   shards, or for index output in range-partitioned shards (by the top bits of the packed k-mers).
+2. Reduce: the counts of each shard are summed over all chunks and written as one part file. For index output,
+   each shard is written as an index of its own, whose varints are encoded with vectorized operations, and the
+   shards' indexes are concatenated in order, block by block, without merging.
+
+Only a couple of chunks per process and one shard per process at a time are held in memory. K-mers that contain a
+base other than A, C, G or T are skipped. The output directory looks like that of `adam count_kmers`: one part-NNNNN
+file per shard, with a "KMER, COUNT" line per k-mer, and a _SUCCESS marker. Alternatively the counts are written as
+a single k-mer index file (see kmer_index).
+
+Unlike ADAM, k-mers can optionally be counted as canonical k-mers: the lesser of a k-mer and its reverse
+complement.
+
+Requires numpy.
+"""
+import argparse
+import glob
+import gzip
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+from collections import deque
+
+import numpy as np
+
+from toil_scripts.adam_kmers.kmer_index import KmerIndexWriter, concatenate_indexes
+
+log = logging.getLogger(__name__)
+
+MAX_KMER_LENGTH = 32
+
+# 2-bit codes of bases; 255 marks anything else, including the separators between reads
+_CODES = np.full(256, 255, dtype=np.uint8)
+for _i, _bases in enumerate(['Aa', 'Cc', 'Gg', 'Tt']):
+    for _base in _bases:
+        _CODES[ord(_base)] = _i
+_BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+# Multiplier of Fibonacci hashing, which spreads consecutive k-mers over the shards
+_HASH = np.uint64(0x9E3779B97F4A7C15)
+
+
+def kmers(sequences, k, canonical=False):
+    """
+    Returns the packed k-mers of sequences, in order of occurrence
+
+    :param str sequences: Sequences separated by a character other than ACGT, e.g. a newline
+    :param int k: k-mer length, at most 32
+    :param bool canonical: If true, returns the lesser of every k-mer and its reverse complement
+    :rtype: numpy.ndarray
+    """
+    codes = _CODES[np.frombuffer(sequences, dtype=np.uint8)]
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.uint64)
+    bad = codes == 255
+    bad_before = np.concatenate(([0], np.cumsum(bad)))
+    valid = bad_before[k:] == bad_before[:n]
+    packed = codes.astype(np.uint64)
+    packed[bad] = 0
+    forward = np.zeros(n, dtype=np.uint64)
+    for j in xrange(k):
+        forward <<= np.uint64(2)
+        forward |= packed[j:j + n]
+    if canonical:
+        reverse = np.zeros(n, dtype=np.uint64)
+        for j in xrange(k):
+            reverse |= (np.uint64(3) - packed[j:j + n]) << np.uint64(2 * j)
+        forward = np.minimum(forward, reverse)
+    return forward[valid]
+
+
+def decode(packed, k):
+    """
+    Returns the k-mers packed by kmers() as strings
+
+    :param numpy.ndarray packed: Packed k-mers
+    :param int k: k-mer length
+    :rtype: list[str]
+    """
+    shifts = np.arange(2 * (k - 1), -1, -2, dtype=np.uint64)
+    letters = _BASES[((packed[:, None] >> shifts[None, :]) & np.uint64(3)).astype(np.uint8)]
+    return np.ascontiguousarray(letters).view('S{}'.format(k)).ravel().tolist()
+
+
+def shard_of(packed, num_shards):
+    """
+    Returns the shard of every packed k-mer
+
+    :param numpy.ndarray packed: Packed k-mers
+    :param int num_shards: Number of shards, a power of two
+    :rtype: numpy.ndarray
+    """
+    bits = num_shards.bit_length() - 1
+    if bits == 0:
+        return np.zeros(len(packed), dtype=np.uint64)
+    return (packed * _HASH) >> np.uint64(64 - bits)
+
+
+def range_shard_of(packed, num_shards, k):
+    """
+    Returns the shard of every packed k-mer, by its top bits, so that every shard holds a range of k-mers and the
+    ranges increase with the shard
+
+    :param numpy.ndarray packed: Packed k-mers
+    :param int num_shards: Number of shards, a power of two
+    :param int k: k-mer length
+    :rtype: numpy.ndarray
+    """
+    bits = min(num_shards.bit_length() - 1, 2 * k)
+    return packed >> np.uint64(2 * k - bits)
+
+
+def _varints(values):
+    """
+    Varint-encodes values, as in kmer_index, with vectorized operations
+
+    :param numpy.ndarray values: Non-negative integers
+    :return: One row of bytes per value, and the number of bytes of each value
+    :rtype: tuple(numpy.ndarray, numpy.ndarray)
+    """
+    values = values.astype(np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    rest = values >> np.uint64(7)
+    while rest.any():
+        lengths += rest > 0
+        rest >>= np.uint64(7)
+    width = int(lengths.max()) if len(values) else 1
+    shifts = np.arange(0, 7 * width, 7, dtype=np.uint64)
+    rows = ((values[:, None] >> shifts[None, :]) & np.uint64(0x7f)).astype(np.uint8)
+    rows[np.arange(width)[None, :] < lengths[:, None] - 1] |= 0x80
+    return rows, lengths
+
+
+def index_blocks(packed, counts, block_size):
+    """
+    Yields the blocks of a k-mer index (see kmer_index) of sorted k-mers, as the arguments of
+    KmerIndexWriter.add_block: (first k-mer, last k-mer, data, number of k-mers)
+
+    :param numpy.ndarray packed: Packed k-mers, in increasing order
+    :param numpy.ndarray counts: Count of every k-mer
+    :param int block_size: Number of k-mers per block
+    """
+    deltas = np.zeros(len(packed), dtype=np.uint64)
+    deltas[1:] = np.diff(packed)
+    # The first k-mer of every block is stored in the block index
+    deltas[::block_size] = 0
+    delta_rows, delta_lengths = _varints(deltas)
+    count_rows, count_lengths = _varints(counts)
+    # Row by row, every k-mer's delta followed by its count
+    rows = np.hstack([delta_rows, count_rows])
+    used = np.hstack([np.arange(delta_rows.shape[1])[None, :] < delta_lengths[:, None],
+                      np.arange(count_rows.shape[1])[None, :] < count_lengths[:, None]])
+    data = rows[used].tostring()
+    offsets = np.zeros(len(packed) + 1, dtype=np.int64)
+    np.cumsum(delta_lengths + count_lengths, out=offsets[1:])
+    for start in xrange(0, len(packed), block_size):
+        stop = min(start + block_size, len(packed))
+        yield int(packed[start]), int(packed[stop - 1]), data[offsets[start]:offsets[stop]], stop - start
+
+
+def read_chunks(path, chunk_bases):
+    """
+    Yields the sequences of a FASTQ, newline separated, in chunks of about chunk_bases bases
+
+    :param str path: Path of the FASTQ, which may be gzipped
+    :param int chunk_bases: Number of bases per chunk
+    """
+    with (gzip.open if path.endswith('.gz') else open)(path) as f:
+        chunk, size = [], 0
+        for i, line in enumerate(f):
+            if i % 4 == 1:
+                chunk.append(line)
+                size += len(line)
+                if size >= chunk_bases:
+                    yield ''.join(chunk)
+                    chunk, size = [], 0
+        if chunk:
+            yield ''.join(chunk)
+
+
+def _count_chunk(args):
+    chunk_id, sequences, k, canonical, num_shards, shard_dir, output_format = args
+    unique, counts = np.unique(kmers(sequences, k, canonical), return_counts=True)
+    if output_format == 'index':
+        shards = range_shard_of(unique, num_shards, k)
+    else:
+        shards = shard_of(unique, num_shards)
+    for shard in xrange(num_shards):
+        mask = shards == shard
+        if mask.any():
+            path = os.path.join(shard_dir, '{}.{}.npz'.format(shard, chunk_id))
+            np.savez(path, kmers=unique[mask], counts=counts[mask].astype(np.int64))
+    return int(counts.sum())
+
+
+def _reduce_shard(args):
+    shard, k, shard_dir, output_dir, output_format = args
+    paths = glob.glob(os.path.join(shard_dir, '{}.*.npz'.format(shard)))
+    total_kmers, total_counts = [], []
+    for path in paths:
+        with np.load(path) as data:
+            total_kmers.append(data['kmers'])
+            total_counts.append(data['counts'])
+        os.remove(path)
+    unique = np.empty(0, dtype=np.uint64)
+    counts = np.empty(0, dtype=np.int64)
+    if paths:
+        unique, inverse = np.unique(np.concatenate(total_kmers), return_inverse=True)
+        counts = np.zeros(len(unique), dtype=np.int64)
+        np.add.at(counts, inverse, np.concatenate(total_counts))
+    if output_format == 'index':
+        # Index of the shard's range of k-mers, concatenated with those of the other shards afterwards
+        with KmerIndexWriter(os.path.join(shard_dir, '{}.kmi'.format(shard)), k) as writer:
+            for block in index_blocks(unique, counts, writer.block_size):
+                writer.add_block(*block)
+    else:
+        with open(os.path.join(output_dir, 'part-{:05d}'.format(shard)), 'w') as f:
+            f.writelines('{}, {}\n'.format(kmer, count) for kmer, count in zip(decode(unique, k), counts.tolist()))
+    return len(unique)
+
+
+def count_kmers_local(input_path, output_dir, kmer_length, cores=None, canonical=False, num_shards=None,
+                      chunk_bases=16 * 1024 * 1024, work_dir=None, output_format='text'):
+    """
+    Counts the k-mers of a FASTQ on one node
+
+    :param str input_path: Path of the FASTQ, which may be gzipped
+    :param str output_dir: Directory the part files are written to, which is created
+    :param int kmer_length: Length of the k-mers, at most 32
+    :param int cores: Number of processes. Defaults to the number of cores.
+    :param bool canonical: If true, counts canonical k-mers
+    :param int num_shards: Number of shards (part files), rounded up to a power of two. Defaults to 4 per process.
+    :param int chunk_bases: Number of bases in the chunks read by each process. Every process uses about 50 bytes
+        of memory per base.
+    :param str work_dir: Directory for the shards of the map phase. Defaults to the system's temporary directory.
+    :param str output_format: 'text' for part files, or 'index' for a single k-mer index file, kmers.kmi
+    :return: Numbers of k-mers counted and of distinct k-mers
+    :rtype: tuple(int, int)
+    """
+    if not 0 < kmer_length <= MAX_KMER_LENGTH:
+        raise ValueError('k-mers must be 1 to {} bases long, not {}'.format(MAX_KMER_LENGTH, kmer_length))
+    cores = cores or multiprocessing.cpu_count()
+    num_shards = 1 << max((num_shards or 4 * cores) - 1, 0).bit_length()
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    shard_dir = tempfile.mkdtemp(prefix='kmers', dir=work_dir)
+    pool = multiprocessing.Pool(cores)
+    try:
+        # Pool.imap would read the whole input ahead of the processes, so chunks in flight are bounded here
+        pending = deque()
+        total = 0
+        for i, chunk in enumerate(read_chunks(input_path, chunk_bases)):
+            pending.append(pool.apply_async(_count_chunk, [(i, chunk, kmer_length, canonical, num_shards,
+                                                            shard_dir, output_format)]))
+            if len(pending) > 2 * cores:
+                total += pending.popleft().get()
+        total += sum(x.get() for x in pending)
+        distinct = sum(pool.map(_reduce_shard, [(shard, kmer_length, shard_dir, output_dir, output_format)
+                                                for shard in xrange(num_shards)]))
+        if output_format == 'index':
+            concatenate_indexes([os.path.join(shard_dir, '{}.kmi'.format(x)) for x in xrange(num_shards)],
+                                os.path.join(output_dir, 'kmers.kmi'))
+    finally:
+        pool.terminate()
+        pool.join()
+        shutil.rmtree(shard_dir, ignore_errors=True)
+    open(os.path.join(output_dir, '_SUCCESS'), 'w').close()
+    log.info('Counted %d %d-mers, %d distinct, in %s.', total, kmer_length, distinct, input_path)
+    return total, distinct
+
+
+def main():
+    """
+    Counts the k-mers of a FASTQ on this machine, writing the counts like `adam count_kmers`
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('input', help='Path of the FASTQ, which may be gzipped')
+    parser.add_argument('output_dir', help='Directory the counts are written to')
+    parser.add_argument('--kmer-length', default=20, type=int, help='Length of the k-mers, at most 32')
+    parser.add_argument('--cores', default=None, type=int, help='Number of processes. Defaults to all cores.')
+    parser.add_argument('--canonical', default=False, action='store_true',
+                        help='Count canonical k-mers, i.e. a k-mer and its reverse complement together')
+    parser.add_argument('--output-format', default='text', choices=['text', 'index'],
+                        help='Write text part files, or a single k-mer index file (kmers.kmi)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    count_kmers_local(args.input, args.output_dir, args.kmer_length, cores=args.cores, canonical=args.canonical,
+                      output_format=args.output_format)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+import os
+import random
+import shutil
+import tempfile
+from unittest import TestCase
+
+from toil_scripts.adam_kmers.kmer_index import KmerIndex, KmerIndexWriter, build_index, concatenate_indexes, \
+    decode, encode, merge_indexes
+
+
+class KmerIndexTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        rng = random.Random(3)
+        self.counts = dict((''.join(rng.choice('ACGT') for _ in xrange(9)), rng.choice([1, 2, 300, 70000]))
+                           for _ in xrange(2000))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _path(self, name):
+        return os.path.join(self.work_dir, name)
+
+    def _write(self, name, counts, block_size=16):
+        with KmerIndexWriter(self._path(name), 9, block_size=block_size) as writer:
+            for kmer in sorted(counts):
+                writer.add(encode(kmer), counts[kmer])
+        return self._path(name)
+
+    def test_encoding(self):
+        self.assertEqual(encode('ACGT'), 0b00011011)
+        self.assertEqual(decode(encode('TTGCA'), 5), 'TTGCA')
+        self.assertEqual(decode(encode('T' * 32), 32), 'T' * 32)
+
+    def test_lookup_and_scan(self):
+        with KmerIndex(self._write('a.kmi', self.counts)) as index:
+            self.assertEqual(len(index), len(self.counts))
+            self.assertEqual(list(index.items()), sorted(self.counts.items()))
+            for kmer, count in self.counts.items():
+                self.assertEqual(index[kmer], count)
+            absent = [x for x in ('A' * 9, 'C' * 9, 'T' * 9, 'GATTACAGA') if x not in self.counts]
+            self.assertTrue(absent)
+            for kmer in absent:
+                self.assertEqual(index.get(kmer), 0)
+            for prefix in ['', 'A', 'GT', 'TTT', sorted(self.counts)[100]]:
+                self.assertEqual(list(index.prefix(prefix)),
+                                 sorted(x for x in self.counts.items() if x[0].startswith(prefix)))
+
+    def test_writer_requires_order(self):
+        with self.assertRaises(ValueError):
+            with KmerIndexWriter(self._path('b.kmi'), 9) as writer:
+                writer.add(5, 1)
+                writer.add(5, 1)
+        self.assertFalse(os.path.exists(self._path('b.kmi')))
+
+    def test_merge(self):
+        kmers = sorted(self.counts)
+        a = dict((x, self.counts[x]) for x in kmers[:1500])
+        b = dict((x, self.counts[x]) for x in kmers[1000:])
+        merged = self._path('merged.kmi')
+        self.assertEqual(merge_indexes([self._write('a.kmi', a), self._write('b.kmi', b)], merged),
+                         len(self.counts))
+        with KmerIndex(merged) as index:
+            expected = dict((x, self.counts[x] * (2 if 1000 <= i < 1500 else 1)) for i, x in enumerate(kmers))
+            self.assertEqual(dict(index.items()), expected)
+
+    def test_concatenate(self):
+        kmers = sorted(self.counts)
+        paths = [self._write('{}.kmi'.format(i), dict((x, self.counts[x]) for x in kmers[start:stop]))
+                 for i, (start, stop) in enumerate([(0, 700), (700, 700), (700, 1001), (1001, len(kmers))])]
+        concatenated = self._path('concatenated.kmi')
+        self.assertEqual(concatenate_indexes(paths, concatenated), len(self.counts))
+        with KmerIndex(concatenated) as index:
+            self.assertEqual(list(index.items()), sorted(self.counts.items()))
+            self.assertEqual(index[kmers[1000]], self.counts[kmers[1000]])
+        # Overlapping ranges cannot be concatenated
+        with self.assertRaises(ValueError):
+            concatenate_indexes([paths[2], paths[0]], concatenated)
+
+    def test_build_from_text(self):
+        parts = self._path('counts')
+        os.mkdir(parts)
+        items = self.counts.items()
+        for i in xrange(3):
+            with open(os.path.join(parts, 'part-{:05d}'.format(i)), 'w') as f:
+                f.writelines('{}, {}\n'.format(kmer, count) for kmer, count in items[i::3])
+                f.write('ACGTNACGT, 5\n')
+        self.assertEqual(build_index([parts], self._path('built.kmi'), work_dir=self.work_dir), len(self.counts))
+        with KmerIndex(self._path('built.kmi')) as index:
+            self.assertEqual(dict(index.items()), self.counts)
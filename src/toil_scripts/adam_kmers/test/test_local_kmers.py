@@ -0,0 +1,106 @@
+import os
+import random
+import shutil
+import tempfile
+from collections import Counter
+from unittest import TestCase
+
+import numpy as np
+
+from toil_scripts.adam_kmers.kmer_index import KmerIndex, KmerIndexWriter
+from toil_scripts.adam_kmers.local_kmers import count_kmers_local, decode, index_blocks, kmers, range_shard_of
+
+
+def reverse_complement(kmer):
+    return ''.join({'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}[x] for x in reversed(kmer))
+
+
+def expected_counts(reads, k, canonical=False):
+    counts = Counter()
+    for read in reads:
+        for i in xrange(len(read) - k + 1):
+            kmer = read[i:i + k]
+            if set(kmer) <= set('ACGT'):
+                counts[min(kmer, reverse_complement(kmer)) if canonical else kmer] += 1
+    return counts
+
+
+class LocalKmersTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        rng = random.Random(7)
+        self.reads = [''.join(rng.choice('ACGTN' if i % 7 == 0 else 'ACGT') for _ in xrange(rng.randint(5, 60)))
+                      for i in xrange(300)]
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _fastq(self):
+        fastq = os.path.join(self.work_dir, 'reads.fastq')
+        with open(fastq, 'w') as f:
+            for i, read in enumerate(self.reads):
+                f.write('@read{}\n{}\n+\n{}\n'.format(i, read, 'I' * len(read)))
+        return fastq
+
+    def test_kmers(self):
+        packed = kmers('ACGTN\nTTAC', 3)
+        self.assertEqual(decode(packed, 3), ['ACG', 'CGT', 'TTA', 'TAC'])
+        self.assertEqual(decode(kmers('ACGTN\nTTAC', 3, canonical=True), 3), ['ACG', 'ACG', 'TAA', 'GTA'])
+        self.assertEqual(decode(kmers('A' * 32, 32), 32), ['A' * 32])
+        self.assertEqual(decode(kmers('T' * 32, 32), 32), ['T' * 32])
+
+    def test_range_shards(self):
+        packed = np.unique(kmers('\n'.join(self.reads), 5))
+        shards = range_shard_of(packed, 8, 5)
+        self.assertTrue((np.diff(shards.astype(np.int64)) >= 0).all())
+        self.assertEqual(set(shards.tolist()), set(xrange(8)))
+        self.assertEqual(range_shard_of(packed, 4096, 5).tolist(), packed.tolist())
+
+    def test_index_blocks(self):
+        rng = random.Random(5)
+        packed = np.array(sorted(rng.sample(xrange(1 << 40), 1000)) + [(1 << 64) - 1], dtype=np.uint64)
+        counts = np.array([rng.choice([1, 127, 128, 70000, 1 << 40]) for _ in xrange(len(packed))])
+        expected, actual = (os.path.join(self.work_dir, x) for x in ('expected.kmi', 'actual.kmi'))
+        with KmerIndexWriter(expected, 32, block_size=64) as writer:
+            for kmer, count in zip(packed.tolist(), counts.tolist()):
+                writer.add(kmer, count)
+        with KmerIndexWriter(actual, 32, block_size=64) as writer:
+            for block in index_blocks(packed, counts, 64):
+                writer.add_block(*block)
+        with open(expected, 'rb') as f1, open(actual, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def _count(self, k, canonical):
+        fastq = self._fastq()
+        output_dir = os.path.join(self.work_dir, 'out')
+        shutil.rmtree(output_dir, ignore_errors=True)
+        # Small chunks and several shards, so that counts are merged across chunks
+        total, distinct = count_kmers_local(fastq, output_dir, k, cores=2, canonical=canonical, num_shards=5,
+                                            chunk_bases=500, work_dir=self.work_dir)
+        counts = Counter()
+        parts = sorted(x for x in os.listdir(output_dir) if x.startswith('part-'))
+        self.assertEqual(len(parts), 8)
+        self.assertTrue(os.path.exists(os.path.join(output_dir, '_SUCCESS')))
+        for part in parts:
+            with open(os.path.join(output_dir, part)) as f:
+                for line in f:
+                    kmer, count = line.rstrip('\n').split(', ')
+                    self.assertNotIn(kmer, counts)
+                    counts[kmer] = int(count)
+        expected = expected_counts(self.reads, k, canonical=canonical)
+        self.assertEqual(counts, expected)
+        self.assertEqual((total, distinct), (sum(expected.values()), len(expected)))
+
+    def test_count(self):
+        self._count(5, False)
+
+    def test_count_canonical(self):
+        self._count(21, True)
+
+    def test_count_index(self):
+        fastq = self._fastq()
+        output_dir = os.path.join(self.work_dir, 'out')
+        count_kmers_local(fastq, output_dir, 7, cores=2, num_shards=4, chunk_bases=500, output_format='index')
+        with KmerIndex(os.path.join(output_dir, 'kmers.kmi')) as index:
+            self.assertEqual(dict(index.items()), expected_counts(self.reads, 7))
@@ -33,7 +33,8 @@ import multiprocessing
 import os
 import sys
 import textwrap
-from subprocess import check_call, check_output
+from copy import copy
+from subprocess import check_call
 
 import yaml
 from toil.job import Job
@@ -46,174 +47,241 @@ from toil_lib.tools.spark_tools import call_adam, call_conductor, MasterAddress,
 
 from toil_lib.files import generate_file
 
+from toil_scripts.adam_pipeline.autosize import autosize
+from toil_scripts.adam_pipeline.hdfs_client import HDFSClient, LocalFiles
+from toil_scripts.adam_pipeline.known_sites import cached_known_sites
+from toil_scripts.admission import DiskBudget, budgeted_map_job
+
 log = logging.getLogger(__name__)
 
+ADAM_IMAGE = "quay.io/ucsc_cgl/adam:962-ehf--6e7085f8cac4b9a927dc9fb06b48007957256b80"
 
-def remove_file(master_ip, filename, spark_on_toil):
-    """
-    Remove the given file from hdfs with master at the given IP address
 
-    :type masterIP: MasterAddress
+def run_adam(job, master_ip, inputs, arguments):
     """
-    master_ip = master_ip.actual
-
-    ssh_call = ['ssh', '-o', 'StrictHostKeyChecking=no', master_ip]
+    Runs an ADAM command on the Spark cluster, or with inputs.run_local, in a local Spark sized to the job
 
-    if spark_on_toil:
-        output = check_output(ssh_call + ['docker', 'ps'])
-        container_id = next(line.split()[0] for line in output.splitlines() if 'apache-hadoop-master' in line)
-        ssh_call += ['docker', 'exec', container_id]
+    call_adam always runs local Spark as local[*], so concurrent samples on one host would each start a thread per
+    core. Here a local run gets as many threads as the job has cores and a driver (which also runs the tasks)
+    with most of the job's memory, and keeps its shuffle files in the sample's directory.
 
-    try:
-        check_call(ssh_call + ['hdfs', 'dfs', '-rm', '-r', '/' + filename])
-    except:
-        pass
+    :type master_ip: MasterAddress
+    :param list[str] arguments: ADAM command and its arguments
+    """
+    if not inputs.run_local:
+        call_adam(job, master_ip, arguments,
+                  run_local=False,
+                  native_adam_path=inputs.native_adam_path,
+                  **spark_resources(master_ip, inputs))
+        return
+
+    work_dir = inputs.local_dir if inputs.native_adam_path else "/data"
+    # Leave room for the JVM's own overhead
+    driver_memory = max(1, int(job.memory * 0.85) // 1024 ** 3)
+    parameters = ["--master", "local[%d]" % max(1, int(job.cores)),
+                  "--driver-memory", "%dg" % driver_memory,
+                  "--conf", "spark.driver.maxResultSize=0",
+                  "--conf", "spark.storage.memoryFraction=0.3",
+                  "--conf", "spark.storage.unrollFraction=0.1",
+                  "--conf", "spark.network.timeout=300s",
+                  "--conf", "spark.local.dir=%s/spark" % work_dir,
+                  "--"] + arguments
+    if inputs.native_adam_path is None:
+        docker_call(job=job, rm=False,
+                    tool=ADAM_IMAGE,
+                    work_dir=inputs.local_dir,
+                    parameters=parameters,
+                    mock=False)
+    else:
+        check_call([os.path.join(inputs.native_adam_path, "bin/adam-submit")] + parameters)
 
 
-def truncate_file(master_ip, filename, spark_on_toil):
+def local_resources(inputs):
     """
-    Truncate the given hdfs file to 10 bytes with master at the given IP address
+    Cores and memory of a sample preprocessed with run-local, which shares its host with the other samples in flight
 
-    :type masterIP: MasterAddress
+    :return: Toil requirements of the sample's job
+    :rtype: dict
     """
-    master_ip = master_ip.actual
+    concurrent_samples = getattr(inputs, 'concurrent_samples', None) or 1
+    cores = getattr(inputs, 'local_cores', None) or max(1, multiprocessing.cpu_count() // concurrent_samples)
+    return dict(cores=cores, memory='%dG' % inputs.memory)
 
-    ssh_call = ['ssh', '-o', 'StrictHostKeyChecking=no', master_ip]
-    hdfs = ['hdfs']
 
-    if spark_on_toil:
-        output = check_output(ssh_call + ['docker', 'ps'])
-        container_id = next(line.split()[0] for line in output.splitlines() if 'apache-hadoop-master' in line)
-        ssh_call += ['docker', 'exec', container_id]
-        hdfs = ['/opt/apache-hadoop/bin/hdfs']
-
-    try:
-        check_call(ssh_call + hdfs + ['dfs', '-truncate', '-w', '10', '/' + filename])
-    except:
-        pass
+def spark_resources(master_ip, inputs, conductor=False):
+    """
+    Spark settings of a sample, as keyword arguments of call_adam or call_conductor
 
+    A sample of a batch that shares a Spark-on-Toil cluster (see batch_adam_preprocessing_dag) is capped at its
+    share of the cluster's cores, with executors whose memory is in proportion, so that the samples in flight run
+    side by side instead of the first one taking every executor.
 
-def download_data(job, master_ip, inputs, known_snps, bam, hdfs_snps, hdfs_bam):
+    :type master_ip: MasterAddress
+    :param bool conductor: Whether the settings are for call_conductor, which takes the master from them
+    :rtype: dict
+    """
+    if not getattr(inputs, 'sample_cores', None):
+        return dict(memory=inputs.memory)
+    parameters = []
+    if conductor:
+        parameters = ["--master", "spark://%s:%s" % (master_ip, SPARK_MASTER_PORT),
+                      "--conf", "spark.hadoop.fs.default.name=hdfs://%s:%s" % (master_ip, HDFS_MASTER_PORT)]
+    parameters += ["--conf", "spark.driver.memory=%sg" % inputs.memory,
+                   "--conf", "spark.executor.memory=%sg" % inputs.executor_memory,
+                   "--conf", "spark.executor.cores=%d" % inputs.executor_cores,
+                   "--conf", "spark.cores.max=%d" % inputs.sample_cores]
+    return dict(override_parameters=parameters)
+
+
+def download_data(job, master_ip, inputs, url, hdfs_path):
     """
-    Downloads input data files from S3.
+    Downloads an input data file from S3.
 
     :type masterIP: MasterAddress
     """
 
-    log.info("Downloading known sites file %s to %s.", known_snps, hdfs_snps)
-    call_conductor(job, master_ip, known_snps, hdfs_snps, memory=inputs.memory)
+    log.info("Downloading %s to %s.", url, hdfs_path)
+    call_conductor(job, master_ip, url, hdfs_path, **spark_resources(master_ip, inputs, conductor=True))
 
-    log.info("Downloading input BAM %s to %s.", bam, hdfs_bam)
-    call_conductor(job, master_ip, bam, hdfs_bam, memory=inputs.memory)
 
-
-def adam_convert(job, master_ip, inputs, in_file, in_snps, adam_file, adam_snps, spark_on_toil):
+def adam_convert(job, master_ip, inputs, in_file, adam_file, hdfs):
     """
-    Convert input sam/bam file and known SNPs file into ADAM format
+    Convert input sam/bam file into ADAM format
+
+    :type hdfs: HDFSClient
     """
 
     log.info("Converting input BAM to ADAM.")
-    call_adam(job, master_ip,
-              ["transform", in_file, adam_file],
-              memory=inputs.memory,
-              run_local=inputs.run_local,
-              native_adam_path=inputs.native_adam_path)
+    # The Parquet dataset keeps this partitioning for the following steps
+    partitions = getattr(inputs, 'partitions', None)
+    run_adam(job, master_ip, inputs,
+             ["transform", in_file, adam_file] + (["-repartition", str(partitions)] if partitions else []))
+
+    hdfs.remove(in_file)
+
 
-    in_file_name = in_file.split("/")[-1]
-    remove_file(master_ip, in_file_name, spark_on_toil)
+def adam_convert_known_sites(job, master_ip, inputs, in_snps, adam_snps, hdfs):
+    """
+    Convert known SNPs file into ADAM format
+
+    :type hdfs: HDFSClient
+    """
 
     log.info("Converting known sites VCF to ADAM.")
 
-    call_adam(job, master_ip,
-              ["vcf2adam", "-only_variants", in_snps, adam_snps],
-              memory=inputs.memory,
-              run_local=inputs.run_local,
-              native_adam_path=inputs.native_adam_path)
+    run_adam(job, master_ip, inputs,
+             ["vcf2adam", "-only_variants", in_snps, adam_snps])
 
-    in_snps_name = in_snps.split("/")[-1]
-    remove_file(master_ip, in_snps_name, spark_on_toil)
+    hdfs.remove(in_snps)
 
 
-def adam_transform(job, master_ip, inputs, in_file, snp_file, hdfs_dir, out_file, spark_on_toil):
+def adam_transform(job, master_ip, inputs, in_file, snp_file, hdfs_dir, out_file, hdfs):
     """
     Preprocess in_file with known SNPs snp_file:
         - mark duplicates
         - realign indels
         - recalibrate base quality scores
+
+    Runs as a single ADAM transform unless inputs.staged_transform is set, in which case every step is a
+    transform of its own that checkpoints its output to hdfs_dir.
+
+    :type hdfs: HDFSClient
+    """
+    if getattr(inputs, 'staged_transform', False):
+        return adam_staged_transform(job, master_ip, inputs, in_file, snp_file, hdfs_dir, out_file, hdfs)
+
+    # One Spark application: the reads are cached (spilling to local disk) between stages instead of being written
+    # to and read back from HDFS three times
+    log.info("Marking duplicates, realigning INDELs, recalibrating base quality scores and sorting reads.")
+    run_adam(job, master_ip, inputs,
+             ["transform",
+              in_file, out_file,
+              "-aligned_read_predicate",
+              "-limit_projection",
+              "-mark_duplicate_reads",
+              "-realign_indels",
+              "-recalibrate_base_qualities",
+              "-known_snps", snp_file,
+              "-cache",
+              "-storage_level", "MEMORY_AND_DISK_SER",
+              "-sort_reads", "-single"])
+
+    hdfs.remove(in_file + "*")
+
+    return out_file
+
+
+def adam_staged_transform(job, master_ip, inputs, in_file, snp_file, hdfs_dir, out_file, hdfs):
+    """
+    Preprocess in_file with known SNPs snp_file in four ADAM transforms, checkpointing the reads to HDFS after
+    marking duplicates, realigning indels and recalibrating base quality scores
+
+    :type hdfs: HDFSClient
     """
 
     log.info("Marking duplicate reads.")
-    call_adam(job, master_ip,
-              ["transform",
-               in_file,  hdfs_dir + "/mkdups.adam",
-               "-aligned_read_predicate",
-               "-limit_projection",
-               "-mark_duplicate_reads"],
-              memory=inputs.memory,
-              run_local=inputs.run_local,
-              native_adam_path=inputs.native_adam_path)
-
-    #FIXME
-    in_file_name = in_file.split("/")[-1]
-    remove_file(master_ip, in_file_name + "*", spark_on_toil)
+    run_adam(job, master_ip, inputs,
+             ["transform",
+              in_file,  hdfs_dir + "/mkdups.adam",
+              "-aligned_read_predicate",
+              "-limit_projection",
+              "-mark_duplicate_reads"])
+
+    hdfs.remove(in_file + "*")
 
     log.info("Realigning INDELs.")
-    call_adam(job, master_ip,
-              ["transform",
-               hdfs_dir + "/mkdups.adam",
-               hdfs_dir + "/ri.adam",
-               "-realign_indels"],
-              memory=inputs.memory,
-              run_local=inputs.run_local,
-              native_adam_path=inputs.native_adam_path)
+    run_adam(job, master_ip, inputs,
+             ["transform",
+              hdfs_dir + "/mkdups.adam",
+              hdfs_dir + "/ri.adam",
+              "-realign_indels"])
 
-    remove_file(master_ip, hdfs_dir + "/mkdups.adam*", spark_on_toil)
+    hdfs.remove(hdfs_dir + "/mkdups.adam*")
 
     log.info("Recalibrating base quality scores.")
-    call_adam(job, master_ip,
-              ["transform",
-               hdfs_dir + "/ri.adam",
-               hdfs_dir + "/bqsr.adam",
-               "-recalibrate_base_qualities",
-               "-known_snps", snp_file],
-              memory=inputs.memory,
-              run_local=inputs.run_local,
-              native_adam_path=inputs.native_adam_path)
-
-    remove_file(master_ip, "ri.adam*", spark_on_toil)
+    run_adam(job, master_ip, inputs,
+             ["transform",
+              hdfs_dir + "/ri.adam",
+              hdfs_dir + "/bqsr.adam",
+              "-recalibrate_base_qualities",
+              "-known_snps", snp_file])
+
+    hdfs.remove(hdfs_dir + "/ri.adam*")
 
     log.info("Sorting reads and saving a single BAM file.")
-    call_adam(job, master_ip,
-              ["transform",
-               hdfs_dir + "/bqsr.adam",
-               out_file,
-               "-sort_reads", "-single"],
-              memory=inputs.memory,
-              run_local=inputs.run_local,
-              native_adam_path=inputs.native_adam_path)
+    run_adam(job, master_ip, inputs,
+             ["transform",
+              hdfs_dir + "/bqsr.adam",
+              out_file,
+              "-sort_reads", "-single"])
 
-    remove_file(master_ip, "bqsr.adam*", spark_on_toil)
+    hdfs.remove(hdfs_dir + "/bqsr.adam*")
 
     return out_file
 
 
-def upload_data(job, master_ip, inputs, hdfs_name, upload_name, spark_on_toil):
+def upload_data(job, master_ip, inputs, hdfs_name, upload_name, hdfs):
     """
     Upload file hdfsName from hdfs to s3
+
+    :type hdfs: HDFSClient
     """
 
     if mock_mode():
-        truncate_file(master_ip, hdfs_name, spark_on_toil)
+        hdfs.truncate(hdfs_name)
 
     log.info("Uploading output BAM %s to %s.", hdfs_name, upload_name)
-    call_conductor(job, master_ip, hdfs_name, upload_name, memory=inputs.memory)
-    remove_file(master_ip, hdfs_name, spark_on_toil)
+    call_conductor(job, master_ip, hdfs_name, upload_name, **spark_resources(master_ip, inputs, conductor=True))
+    hdfs.remove(hdfs_name)
 
 
 def download_run_and_upload(job, master_ip, inputs, spark_on_toil):
     """
     Monolithic job that calls data download, conversion, transform, upload.
     Previously, this was not monolithic; change came in due to #126/#134.
+
+    All HDFS housekeeping of the sample goes through one HDFSClient, i.e. one SSH connection to the master. With
+    run-local, the sample's files are kept in a local directory instead.
     """
     master_ip = MasterAddress(master_ip)
 
@@ -228,9 +296,11 @@ def download_run_and_upload(job, master_ip, inputs, spark_on_toil):
             hdfs_dir = "/data/"
         else:
             hdfs_dir = inputs.local_dir
+        hdfs = LocalFiles(inputs.local_dir)
     else:
         inputs.local_dir = None
         hdfs_dir = "hdfs://{0}:{1}/{2}".format(master_ip, HDFS_MASTER_PORT, hdfs_subdir)
+        hdfs = HDFSClient(master_ip, spark_on_toil)
 
     try:
         hdfs_prefix = hdfs_dir + "/" + sample_name
@@ -238,30 +308,42 @@ def download_run_and_upload(job, master_ip, inputs, spark_on_toil):
 
         hdfs_snps = hdfs_dir + "/" + inputs.dbsnp.split('://')[-1].split('/')[-1]
 
+        def convert_known_sites(adam_snps):
+            if not inputs.run_local:
+                download_data(job, master_ip, inputs, inputs.dbsnp, hdfs_snps)
+            adam_convert_known_sites(job, master_ip, inputs, hdfs_snps, adam_snps, hdfs)
+
         if not inputs.run_local:
-            download_data(job, master_ip, inputs, inputs.dbsnp, inputs.sample, hdfs_snps, hdfs_bam)
+            download_data(job, master_ip, inputs, inputs.sample, hdfs_bam)
         else:
             copy_files([inputs.sample, inputs.dbsnp], inputs.local_dir)
 
         adam_input = hdfs_prefix + ".adam"
-        adam_snps = hdfs_dir + "/snps.var.adam"
-        adam_convert(job, master_ip, inputs, hdfs_bam, hdfs_snps, adam_input, adam_snps, spark_on_toil)
+        adam_convert(job, master_ip, inputs, hdfs_bam, adam_input, hdfs)
+
+        # The conversion of the known sites is shared by all samples on the cluster
+        adam_snps = None
+        if not inputs.run_local:
+            hdfs_root = "hdfs://{0}:{1}".format(master_ip, HDFS_MASTER_PORT)
+            adam_snps = cached_known_sites(hdfs, hdfs_root, inputs.dbsnp, convert_known_sites)
+        if adam_snps is None:
+            adam_snps = hdfs_dir + "/snps.var.adam"
+            convert_known_sites(adam_snps)
 
         adam_output = hdfs_prefix + ".processed.bam"
-        adam_transform(job, master_ip, inputs, adam_input, adam_snps, hdfs_dir, adam_output, spark_on_toil)
+        adam_transform(job, master_ip, inputs, adam_input, adam_snps, hdfs_dir, adam_output, hdfs)
 
         out_file = inputs.output_dir + "/" + sample_name + inputs.suffix + ".bam"
 
         if not inputs.run_local:
-            upload_data(job, master_ip, inputs, adam_output, out_file, spark_on_toil)
+            upload_data(job, master_ip, inputs, adam_output, out_file, hdfs)
         else:
             local_adam_output = "%s/%s.processed.bam" % (inputs.local_dir, sample_name)
             move_files([local_adam_output], inputs.output_dir)
 
-        remove_file(master_ip, hdfs_subdir, spark_on_toil)
-    except:
-        remove_file(master_ip, hdfs_subdir, spark_on_toil)
-        raise
+    finally:
+        hdfs.remove(hdfs_subdir)
+        hdfs.close()
 
 
 def static_adam_preprocessing_dag(job, inputs, sample, output_dir, suffix=''):
@@ -276,26 +358,36 @@ def static_adam_preprocessing_dag(job, inputs, sample, output_dir, suffix=''):
         if not inputs.run_local and inputs.master_ip == 'auto':
             # Static, standalone Spark cluster managed by uberscript
             spark_on_toil = False
-            scale_up = job.wrapJobFn(scale_external_spark_cluster, 1)
+            scale_up = job.wrapFn(scale_external_spark_cluster, 1)
             job.addChild(scale_up)
             spark_work = job.wrapJobFn(download_run_and_upload,
                                        inputs.master_ip, inputs, spark_on_toil)
             scale_up.addChild(spark_work)
-            scale_down = job.wrapJobFn(scale_external_spark_cluster, -1)
+            scale_down = job.wrapFn(scale_external_spark_cluster, -1)
             spark_work.addChild(scale_down)
         else:
-            # Static, external Spark cluster
+            # Static, external Spark cluster, or local Spark sized by the job's requirements
             spark_on_toil = False
+            resources = local_resources(inputs) if inputs.run_local else {}
             spark_work = job.wrapJobFn(download_run_and_upload,
-                                       inputs.master_ip, inputs, spark_on_toil)
+                                       inputs.master_ip, inputs, spark_on_toil, **resources)
             job.addChild(spark_work)
     else:
         # Dynamic subclusters, i.e. Spark-on-Toil
         spark_on_toil = True
         cores = multiprocessing.cpu_count()
+        num_workers = inputs.num_nodes - 1 if inputs.num_nodes != 'auto' else None
+        if num_workers is None:
+            # Workers, their memory and the partitioning are chosen from the size of the input
+            sizing = autosize(sample, getattr(inputs, 'max_nodes', None) or 16, inputs.memory, cores,
+                              job.fileStore.getLocalTempDir())
+            job.fileStore.logToMaster('Autosized Spark cluster for {}: {}'.format(sample, sizing))
+            num_workers = sizing.workers
+            inputs.memory = sizing.memory
+            inputs.partitions = sizing.partitions
         master_ip = spawn_spark_cluster(job,
                                         False, # Sudo
-                                        inputs.num_nodes-1,
+                                        num_workers,
                                         cores=cores,
                                         memory=inputs.memory)
         spark_work = job.wrapJobFn(download_run_and_upload,
@@ -303,6 +395,92 @@ def static_adam_preprocessing_dag(job, inputs, sample, output_dir, suffix=''):
         job.addChild(spark_work)
 
 
+def batch_adam_preprocessing_dag(job, inputs, samples, output_dir, suffix=''):
+    """
+    A Toil job function performing ADAM preprocessing on a batch of samples with one Spark cluster
+
+    The cluster (or, with an external cluster, its share of it) is set up once and fed up to
+    inputs.concurrent_samples samples at a time, largest first. It is torn down once the batch has drained. On a
+    Spark-on-Toil cluster, every sample is limited to its share of the cluster's cores and memory.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param Namespace inputs: Pipeline configuration
+    :param list[str] samples: S3 URLs or local paths of the input SAM or BAM files
+    :param str output_dir: Full path where final results will be output
+    :param str suffix: Additional suffix to add to the names of the output files
+    """
+    concurrent_samples = getattr(inputs, 'concurrent_samples', None) or 2
+    inputs = copy(inputs)
+    inputs.concurrent_samples = concurrent_samples
+    budget = DiskBudget(total=None, max_concurrent=concurrent_samples)
+
+    if inputs.master_ip is not None or inputs.run_local:
+        spark_on_toil = False
+        master_ip = inputs.master_ip
+        if not inputs.run_local and inputs.master_ip == 'auto':
+            # Static, standalone Spark cluster managed by uberscript, scaled once for the whole batch
+            num_lanes = min(concurrent_samples, len(samples))
+            scale_up = job.wrapFn(scale_external_spark_cluster, num_lanes)
+            job.addChild(scale_up)
+            spark_work = job.wrapJobFn(budgeted_map_job, adam_batch_sample, samples, budget, _sample_urls,
+                                       master_ip, inputs, output_dir, suffix, spark_on_toil)
+            scale_up.addChild(spark_work)
+            spark_work.addFollowOn(job.wrapFn(scale_external_spark_cluster, -num_lanes))
+            return
+    else:
+        # One Spark-on-Toil cluster, whose services stop once all children of this job are done
+        spark_on_toil = True
+        cores = multiprocessing.cpu_count()
+        num_workers = inputs.num_nodes - 1 if inputs.num_nodes != 'auto' else None
+        if num_workers is None:
+            # Sized for the largest sample, once for every sample in flight
+            max_nodes = getattr(inputs, 'max_nodes', None) or 16
+            work_dir = job.fileStore.getLocalTempDir()
+            sizing = max((autosize(x, max_nodes, inputs.memory, cores, work_dir) for x in samples),
+                         key=lambda x: x.working_set)
+            num_workers = min(max_nodes, sizing.workers * min(concurrent_samples, len(samples)))
+            job.fileStore.logToMaster('Autosized Spark cluster for a batch of {} samples: {} workers with {} GiB '
+                                      'each, from the largest sample: {}'.format(len(samples), num_workers,
+                                                                                 sizing.memory, sizing))
+            inputs.memory = sizing.memory
+            # Every sample's share of the cluster is about the size of the largest sample's cluster
+            inputs.partitions = sizing.partitions
+        # Each sample in flight gets its share of the cluster, see spark_resources
+        lanes = min(concurrent_samples, len(samples))
+        inputs.sample_cores = max(1, num_workers * cores // lanes)
+        inputs.executor_cores = min(cores, inputs.sample_cores)
+        inputs.executor_memory = max(1, inputs.memory * inputs.executor_cores // cores)
+        master_ip = spawn_spark_cluster(job,
+                                        False, # Sudo
+                                        num_workers,
+                                        cores=cores,
+                                        memory=inputs.memory)
+    job.addChildJobFn(budgeted_map_job, adam_batch_sample, samples, budget, _sample_urls,
+                      master_ip, inputs, output_dir, suffix, spark_on_toil)
+
+
+def _sample_urls(sample):
+    return [sample]
+
+
+def adam_batch_sample(job, sample, master_ip, inputs, output_dir, suffix, spark_on_toil):
+    """
+    Preprocesses one sample of a batch on the batch's Spark cluster
+    """
+    # download_run_and_upload keeps per sample state in inputs
+    sample_inputs = copy(inputs)
+    sample_inputs.sample = sample
+    sample_inputs.output_dir = output_dir
+    sample_inputs.suffix = suffix
+    if inputs.run_local:
+        # Local samples in flight share the host, so each runs in a job holding its share of the cores and memory
+        resources = local_resources(inputs)
+    else:
+        # The sample's Spark driver runs in its job, so Toil accounts for the drivers of all samples in flight
+        resources = dict(memory='%dG' % inputs.memory)
+    job.addChildJobFn(download_run_and_upload, master_ip, sample_inputs, spark_on_toil, **resources)
+
+
 def scale_external_spark_cluster(num_samples=1):
     from toil_scripts.adam_uberscript.adam_uberscript import standalone_spark_semaphore_name
     from toil_scripts.adam_uberscript.automated_scaling import Semaphore
@@ -321,6 +499,10 @@ def generate_config():
         # Comments (beginning with #) do not need to be removed. Optional parameters may be left blank.
         ##############################################################################################################
         num-nodes: 9              # Optional: Number of nodes to use. Do not set if providing master_ip.
+                                  # The value 'auto' sizes the cluster, the memory of its workers and the number
+                                  # of partitions from the input (its read count if a BAM index is found next to
+                                  # it, otherwise its size). The decision is logged.
+        max-nodes:                # Optional: With num-nodes 'auto', the largest number of worker nodes. Default: 16
         master-ip:                # Optional: IP or hostname of host running for Spark master and HDFS namenode.
                                   # Should be provided instead of num-nodes if pointing at a static (external or
                                   # standalone) Spark cluster. The special value 'auto' indicates the master of
@@ -329,9 +511,19 @@ def generate_config():
         dbsnp:                    # Required: The full s3 url of a VCF file of known snps
         memory:                   # Required: Amount of memory to allocate for Spark Driver and executor.
                                   # This should be equal to the available memory on each worker node.
+                                  # With num-nodes 'auto', this is the most memory a worker is given.
+                                  # With run-local, the memory (in GB) of each sample's local Spark.
         run-local:                # Optional: If true, runs ADAM locally and doesn't connect to a cluster.
+                                  # With --manifest, concurrent-samples samples run side by side on the host.
+        local-cores:              # Optional: With run-local, the cores of each sample's local Spark.
+                                  # Default: the cores of the host divided by concurrent-samples
         local-dir:                # Required if run-local is true. Sets the local directory to use for input.
         native-adam-path:         # Optional: If set, runs ADAM using the local build of ADAM at this path.
+        concurrent-samples:       # Optional: With --manifest, the number of samples preprocessed at once on the
+                                  # shared Spark cluster. Default: 2
+        staged-transform:         # Optional: If true, runs each preprocessing step as a separate ADAM transform
+                                  # that writes its output to HDFS, e.g. to inspect intermediates. By default all
+                                  # steps run in one Spark application without intermediate files.
     """[1:])
 
 
@@ -346,8 +538,11 @@ def main():
     parser_run.add_argument('--config', default='adam_preprocessing.config', type=str,
                             help='Path to the (filled in) config file, generated with "generate-config". '
                                  '\nDefault value: "%(default)s"')
-    parser_run.add_argument('--sample', help='The S3 URL or local path to the input SAM or BAM file.'
-                            'NOTE: unlike other pipelines, we do not support ftp://, gnos://, etc. schemes.')
+    group = parser_run.add_mutually_exclusive_group(required=True)
+    group.add_argument('--sample', help='The S3 URL or local path to the input SAM or BAM file.'
+                       'NOTE: unlike other pipelines, we do not support ftp://, gnos://, etc. schemes.')
+    group.add_argument('--manifest', help='Path to a file with one S3 URL or local path of an input SAM or BAM '
+                       'file per line. All samples are preprocessed with one Spark cluster.')
     parser_run.add_argument('--output-dir', required=True, default=None,
                             help='full path where final results will be output')
     parser_run.add_argument('-s', '--suffix', default='',
@@ -372,13 +567,20 @@ def main():
         if not hasattr(inputs, 'master_ip'):
             require(inputs.num_nodes > 1,
                 'num_nodes allocates one Spark/HDFS master and n-1 workers, and '
-                'thus must be greater than 1. %d was passed.' % inputs.num_nodes)
+                'thus must be greater than 1. %s was passed.' % inputs.num_nodes)
 
         for arg in [inputs.dbsnp, inputs.memory]:
             require(arg, 'Required argument {} missing from config'.format(arg))
 
-        Job.Runner.startToil(Job.wrapJobFn(static_adam_preprocessing_dag, inputs,
-                                           args.sample, args.output_dir), args)
+        if args.manifest:
+            with open(args.manifest) as f:
+                samples = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+            require(samples, 'No samples were found in {}'.format(args.manifest))
+            Job.Runner.startToil(Job.wrapJobFn(batch_adam_preprocessing_dag, inputs,
+                                               samples, args.output_dir, args.suffix), args)
+        else:
+            Job.Runner.startToil(Job.wrapJobFn(static_adam_preprocessing_dag, inputs,
+                                               args.sample, args.output_dir, args.suffix), args)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,176 @@
+#!/usr/bin/env python2.7
+"""
+Sizing of Spark clusters for ADAM from the size of the input.
+
+autosize() estimates the working set of an ADAM job from the number of reads of the input, which it takes from the
+BAM index when one is found next to the BAM, and otherwise from the size of the input file. From the working set it
+derives the number of workers, the memory given to each worker, and the number of partitions to run with.
+
+The coefficients of the model are held in a SizingModel. The defaults are conservative starting points for ADAM
+preprocessing of BAMs; where measurements of past runs are available they should replace them.
+"""
+import logging
+import math
+import os
+import shutil
+import struct
+import urllib2
+from collections import namedtuple
+from contextlib import closing
+from urlparse import urlparse
+
+from toil_scripts.admission import url_size
+
+log = logging.getLogger(__name__)
+
+GiB = 1024 ** 3
+
+# bytes_per_read:   Executor memory taken by one read during preprocessing, including shuffle overhead
+# input_expansion:  Ratio of the working set to the size of the input, used when the read count is unknown
+# cache_fraction:   Fraction of executor memory available for cached and shuffled data
+# overhead:         GiB of memory added to every worker for the JVM and Spark itself
+# min_memory:       Smallest amount of memory in GiB given to a worker
+# partition_size:   Bytes of input per partition
+# tasks_per_core:   Minimum number of partitions per core of the cluster
+SizingModel = namedtuple('SizingModel', 'bytes_per_read input_expansion cache_fraction overhead min_memory '
+                                        'partition_size tasks_per_core')
+DEFAULT_MODEL = SizingModel(bytes_per_read=600,
+                            input_expansion=6.0,
+                            cache_fraction=0.5,
+                            overhead=2,
+                            min_memory=4,
+                            partition_size=128 * 1024 * 1024,
+                            tasks_per_core=2)
+
+
+class SparkSizing(namedtuple('SparkSizing', 'workers memory cores partitions input_size reads working_set')):
+    """
+    Cluster settings chosen by autosize()
+
+    workers: number of Spark workers
+    memory: memory in GiB given to each worker and to the driver
+    cores: cores per worker
+    partitions: number of partitions to process the input in
+    input_size: size of the input in bytes, or None if unknown
+    reads: number of reads in the input, or None if unknown
+    working_set: estimated working set in bytes
+    """
+    __slots__ = ()
+
+    def __str__(self):
+        return ('{} workers with {} GiB and {} cores each, {} partitions (input: {} bytes, reads: {}, '
+                'estimated working set: {} bytes)').format(self.workers, self.memory, self.cores, self.partitions,
+                                                           self.input_size, self.reads, self.working_set)
+
+
+def bai_read_count(path):
+    """
+    Returns the number of mapped and unmapped reads recorded in a BAM index, as samtools idxstats does
+
+    :param str path: Path of the .bai file
+    :return: Number of reads, or None if the index carries no read counts
+    :rtype: int|None
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] != 'BAI\1':
+        raise RuntimeError('{} is not a BAM index'.format(path))
+    offset = 4
+
+    def unpack(fmt):
+        values = struct.unpack_from(fmt, data, offset)
+        return values, offset + struct.calcsize(fmt)
+
+    (n_ref,), offset = unpack('<i')
+    reads = 0
+    found = False
+    for _ in xrange(n_ref):
+        (n_bin,), offset = unpack('<i')
+        for _ in xrange(n_bin):
+            (bin_id, n_chunk), offset = unpack('<Ii')
+            if bin_id == 37450 and n_chunk == 2:
+                # Pseudo-bin whose second chunk holds the numbers of mapped and unmapped reads of the reference
+                (_, _, mapped, unmapped), offset = unpack('<4Q')
+                reads += mapped + unmapped
+                found = True
+            else:
+                offset += 16 * n_chunk
+        (n_intv,), offset = unpack('<i')
+        offset += 8 * n_intv
+    if len(data) >= offset + 8:
+        # Reads without coordinates
+        (no_coor,), offset = unpack('<Q')
+        reads += no_coor
+    return reads if found else None
+
+
+def fetch_index(url, work_dir):
+    """
+    Returns the local path of the index of a BAM, downloading it if need be
+
+    :param str url: URL or local path of the BAM
+    :param str work_dir: Directory an index is downloaded to
+    :return: Path of the index, or None if none was found
+    :rtype: str|None
+    """
+    if not url.endswith('.bam'):
+        return None
+    dest = os.path.join(work_dir, os.path.basename(urlparse(url).path) + '.bai')
+    for candidate in [url + '.bai', url[:-len('.bam')] + '.bai']:
+        parsed = urlparse(candidate)
+        try:
+            if parsed.scheme in ('', 'file'):
+                if os.path.exists(parsed.path):
+                    return parsed.path
+            elif parsed.scheme in ('http', 'https', 'ftp'):
+                with closing(urllib2.urlopen(candidate, timeout=60)) as f_in, open(dest, 'wb') as f_out:
+                    shutil.copyfileobj(f_in, f_out)
+                return dest
+            elif parsed.scheme == 's3':
+                import boto
+                bucket = boto.connect_s3().get_bucket(parsed.netloc, validate=False)
+                key = bucket.get_key(parsed.path.lstrip('/'))
+                if key is not None:
+                    key.get_contents_to_filename(dest)
+                    return dest
+        except Exception as e:
+            log.debug('No index at %s: %s', candidate, e)
+    return None
+
+
+def autosize(input_url, max_workers, max_memory, cores, work_dir, model=DEFAULT_MODEL):
+    """
+    Chooses the number of Spark workers, their memory and the number of partitions for an input
+
+    :param str input_url: URL or local path of the input SAM/BAM/ADAM/FASTQ file
+    :param int max_workers: Largest number of workers to launch
+    :param int max_memory: Memory in GiB available to a worker
+    :param int cores: Cores per worker
+    :param str work_dir: Scratch directory, e.g. for downloading the BAM index
+    :param SizingModel model: Coefficients of the sizing model
+    :rtype: SparkSizing
+    """
+    input_size = url_size(input_url)
+    index = fetch_index(input_url, work_dir)
+    reads = None
+    if index is not None:
+        try:
+            reads = bai_read_count(index)
+        except (RuntimeError, struct.error) as e:
+            log.warn('Could not read the index of %s: %s', input_url, e)
+    if reads is not None:
+        working_set = reads * model.bytes_per_read
+    elif input_size is not None:
+        working_set = int(input_size * model.input_expansion)
+    else:
+        # Nothing is known, so everything available is used
+        working_set = int(max_workers * (max_memory - model.overhead) * model.cache_fraction * GiB)
+    needed = working_set / model.cache_fraction / GiB
+    workers = max(1, min(max_workers, int(math.ceil(needed / max(max_memory - model.overhead, 1)))))
+    memory = int(math.ceil(needed / workers)) + model.overhead
+    memory = max(min(memory, max_memory), min(model.min_memory, max_memory))
+    partitions = workers * cores * model.tasks_per_core
+    if input_size is not None:
+        partitions = max(partitions, int(math.ceil(float(input_size) / model.partition_size)))
+    return SparkSizing(workers=workers, memory=memory, cores=cores, partitions=partitions,
+                       input_size=input_size, reads=reads, working_set=working_set)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python2.7
+"""
+HDFS housekeeping on a Spark/HDFS master over a shared SSH connection.
+
+The preprocessing pipeline deletes intermediates after every ADAM stage. Opening a new SSH connection for each
+command is slow. With Spark-on-Toil, every command also had to find the hadoop master container again through
+`docker ps`. An HDFSClient opens one multiplexed SSH connection (ControlMaster) to the master and sends every
+command through it. The container is looked up once, and several paths are removed with a single `hdfs dfs -rm`.
+
+LocalFiles does the same housekeeping for samples preprocessed with local Spark, in the sample's local directory.
+"""
+import glob
+import logging
+import os
+import shutil
+import tempfile
+from subprocess import CalledProcessError, call, check_call, check_output
+
+log = logging.getLogger(__name__)
+
+
+class HDFSClient(object):
+    """
+    Runs hdfs dfs commands on a master node through one persistent SSH connection.
+    """
+
+    def __init__(self, master_ip, spark_on_toil, persist=600):
+        """
+        :param MasterAddress master_ip: Address of the Spark master and HDFS namenode
+        :param bool spark_on_toil: True if HDFS runs in the apache-hadoop-master container of Spark-on-Toil
+        :param int persist: Seconds the connection stays open once idle
+        """
+        self.master_ip = master_ip.actual
+        self.spark_on_toil = spark_on_toil
+        self.control_dir = tempfile.mkdtemp(prefix='ssh')
+        self.ssh_call = ['ssh',
+                         '-o', 'StrictHostKeyChecking=no',
+                         '-o', 'ControlMaster=auto',
+                         '-o', 'ControlPath={}/%r@%h:%p'.format(self.control_dir),
+                         '-o', 'ControlPersist={}'.format(persist),
+                         self.master_ip]
+        self._hdfs = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def hdfs(self):
+        """
+        Command that runs hdfs on the master, resolving the hadoop container on first use
+        """
+        if self._hdfs is None:
+            if self.spark_on_toil:
+                output = check_output(self.ssh_call + ['docker', 'ps'])
+                container_id = next(line.split()[0] for line in output.splitlines()
+                                    if 'apache-hadoop-master' in line)
+                self._hdfs = self.ssh_call + ['docker', 'exec', container_id, '/opt/apache-hadoop/bin/hdfs']
+            else:
+                self._hdfs = self.ssh_call + ['hdfs']
+        return self._hdfs
+
+    @staticmethod
+    def path(filename):
+        """
+        Absolute HDFS path of filename, which is relative to the root unless it is a URL or starts with '/'
+        """
+        return filename if filename.startswith('/') or '://' in filename else '/' + filename
+
+    def remove(self, *filenames):
+        """
+        Recursively removes files and directories, which may be glob patterns, with a single command. Failures
+        are logged and ignored, as removal only frees space.
+
+        :param str filenames: Paths to remove
+        """
+        if not filenames:
+            return
+        try:
+            check_call(self.hdfs + ['dfs', '-rm', '-r', '-f'] + [self.path(x) for x in filenames])
+        except (CalledProcessError, OSError, StopIteration) as e:
+            log.warn('Failed to remove %s from HDFS: %s', ', '.join(filenames), e)
+
+    def exists(self, filename):
+        """
+        :param str filename: Path of a file or directory
+        :return: True if the path exists
+        :rtype: bool
+        """
+        return call(self.hdfs + ['dfs', '-test', '-e', self.path(filename)]) == 0
+
+    def isdir(self, filename):
+        """
+        :param str filename: Path
+        :return: True if the path is a directory
+        :rtype: bool
+        """
+        return call(self.hdfs + ['dfs', '-test', '-d', self.path(filename)]) == 0
+
+    def rename(self, src, dst):
+        """
+        Moves src to dst, which must not exist. If dst is a directory, src is moved into it under its own name,
+        which must not exist in it.
+
+        :param str src: Path to move
+        :param str dst: New path
+        :return: True if src was moved
+        :rtype: bool
+        """
+        return call(self.hdfs + ['dfs', '-mv', self.path(src), self.path(dst)]) == 0
+
+    def truncate(self, filename, length=10):
+        """
+        Truncates a file to the given number of bytes, waiting for the truncation to complete. Failures are
+        logged and ignored.
+
+        :param str filename: Path of the file
+        :param int length: Length in bytes
+        """
+        try:
+            check_call(self.hdfs + ['dfs', '-truncate', '-w', str(length), self.path(filename)])
+        except (CalledProcessError, OSError, StopIteration) as e:
+            log.warn('Failed to truncate %s: %s', filename, e)
+
+    def close(self):
+        """
+        Closes the shared connection
+        """
+        try:
+            check_call(['ssh', '-o', 'ControlPath={}/%r@%h:%p'.format(self.control_dir), '-O', 'exit',
+                        self.master_ip])
+        except (CalledProcessError, OSError):
+            # No connection was ever opened
+            pass
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+
+class LocalFiles(object):
+    """
+    Housekeeping of a sample preprocessed locally, with the interface of HDFSClient. Only paths in the sample's
+    directory are touched.
+    """
+
+    def __init__(self, local_dir, mount='/data'):
+        """
+        :param str local_dir: Directory of the sample
+        :param str mount: Path of local_dir in the ADAM container
+        """
+        self.local_dir = os.path.abspath(local_dir)
+        self.mount = mount
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def path(self, filename):
+        """
+        Local path of filename, which may be relative to the sample's directory or inside the container's mount
+
+        :rtype: str|None
+        """
+        if filename == self.mount or filename.startswith(self.mount + '/'):
+            filename = self.local_dir + filename[len(self.mount):]
+        path = os.path.normpath(os.path.join(self.local_dir, filename))
+        return path if path.startswith(self.local_dir + os.sep) else None
+
+    def remove(self, *filenames):
+        """
+        Recursively removes files and directories, which may be glob patterns. Failures are logged and ignored.
+
+        :param str filenames: Paths to remove
+        """
+        for filename in filenames:
+            path = self.path(filename)
+            if path is None:
+                log.warn('Not removing %s, which is outside of %s', filename, self.local_dir)
+                continue
+            for match in glob.glob(path):
+                try:
+                    if os.path.isdir(match):
+                        shutil.rmtree(match)
+                    else:
+                        os.remove(match)
+                except OSError as e:
+                    log.warn('Failed to remove %s: %s', match, e)
+
+    def exists(self, filename):
+        """
+        :param str filename: Path of a file or directory
+        :rtype: bool
+        """
+        path = self.path(filename)
+        return path is not None and os.path.exists(path)
+
+    def isdir(self, filename):
+        """
+        :param str filename: Path
+        :rtype: bool
+        """
+        path = self.path(filename)
+        return path is not None and os.path.isdir(path)
+
+    def rename(self, src, dst):
+        """
+        Moves src to dst, which must not exist. If dst is a directory, src is moved into it under its own name,
+        which must not exist in it.
+
+        :rtype: bool
+        """
+        src, dst = self.path(src), self.path(dst)
+        if src is not None and dst is not None and os.path.isdir(dst):
+            dst = os.path.join(dst, os.path.basename(src))
+        if src is None or dst is None or os.path.exists(dst):
+            return False
+        try:
+            os.rename(src, dst)
+        except OSError:
+            return False
+        return True
+
+    def truncate(self, filename, length=10):
+        """
+        Truncates a file to the given number of bytes. Failures are logged and ignored.
+        """
+        try:
+            with open(self.path(filename), 'r+b') as f:
+                f.truncate(length)
+        except (IOError, TypeError) as e:
+            log.warn('Failed to truncate %s: %s', filename, e)
+
+    def close(self):
+        """
+        Nothing to close; the sample's directory is removed by Toil
+        """
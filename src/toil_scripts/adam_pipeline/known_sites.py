@@ -0,0 +1,99 @@
+#!/usr/bin/env python2.7
+"""
+Store of known sites VCFs converted to ADAM, shared by all samples preprocessed on a cluster.
+
+Every sample needs the same known sites (e.g. dbSNP) in ADAM format for BQSR. Converting them takes a Spark job of
+several minutes, so converted datasets are kept in HDFS under KNOWN_SITES_DIR, named after the VCF URL and a
+fingerprint of its contents, and reused by later samples. Each conversion is written to a directory of its own and
+then moved into the store, so a dataset in the store is always complete. Moving a dataset into the store directory,
+rather than onto its final path, fails if another sample stored the same dataset first; `hdfs dfs -mv` onto an
+existing directory would nest the dataset inside the other one instead.
+"""
+import hashlib
+import logging
+import os
+import urllib2
+import uuid
+from urlparse import urlparse
+
+log = logging.getLogger(__name__)
+
+KNOWN_SITES_DIR = 'known_sites'
+
+
+def url_fingerprint(url):
+    """
+    Returns a string that changes when the contents at a URL change: the ETag of S3 objects and HTTP resources
+    (or their size and modification time), and the size and modification time of local files
+
+    :param str url: S3, HTTP(S) or file URL, or a local path
+    :rtype: str
+    """
+    parsed = urlparse(url)
+    if parsed.scheme in ('', 'file'):
+        stat = os.stat(parsed.path)
+        return '{}:{}'.format(stat.st_size, int(stat.st_mtime))
+    elif parsed.scheme == 's3':
+        import boto
+        key = boto.connect_s3().get_bucket(parsed.netloc, validate=False).get_key(parsed.path.lstrip('/'))
+        if key is None:
+            raise RuntimeError('{} does not exist'.format(url))
+        return key.etag.strip('"')
+    elif parsed.scheme in ('http', 'https'):
+        request = urllib2.Request(url)
+        request.get_method = lambda: 'HEAD'
+        info = urllib2.urlopen(request, timeout=30).info()
+        return info.getheader('ETag') or '{}:{}'.format(info.getheader('Content-Length'),
+                                                       info.getheader('Last-Modified'))
+    raise RuntimeError('Cannot fingerprint {}'.format(url))
+
+
+def known_sites_key(url):
+    """
+    Name of the converted dataset of a known sites VCF in the store
+
+    :param str url: URL of the known sites VCF
+    :return: Key, or None if the VCF cannot be fingerprinted, in which case it should not be cached
+    :rtype: str|None
+    """
+    try:
+        fingerprint = url_fingerprint(url)
+    except Exception as e:
+        log.warn('Not caching the conversion of %s: %s', url, e)
+        return None
+    return hashlib.sha1('{}\0{}'.format(url, fingerprint)).hexdigest()
+
+
+def cached_known_sites(hdfs, hdfs_root, url, convert):
+    """
+    Returns the path of the ADAM conversion of a known sites VCF, converting it only if the store lacks it
+
+    :param HDFSClient hdfs: Client of the HDFS holding the store
+    :param str hdfs_root: URL of the root of that HDFS, e.g. hdfs://master:8020
+    :param str url: URL of the known sites VCF
+    :param function convert: convert(adam_path) converts the VCF into an ADAM dataset at adam_path
+    :return: Path of the converted dataset, or None if the VCF cannot be cached (and nothing was converted)
+    :rtype: str|None
+    """
+    key = known_sites_key(url)
+    if key is None:
+        return None
+    store = '{}/{}'.format(hdfs_root, KNOWN_SITES_DIR)
+    path = '{}/{}.var.adam'.format(store, key)
+    if hdfs.exists(path):
+        log.info('Reusing the ADAM conversion of %s at %s.', url, path)
+        return path
+    attempt = '{}/partial-{}'.format(store, uuid.uuid4().hex)
+    partial = '{}/{}.var.adam'.format(attempt, key)
+    convert(partial)
+    # Fails, leaving partial in place, if another sample stored the same conversion in the meantime
+    if hdfs.isdir(store):
+        hdfs.rename(partial, store)
+    if hdfs.exists(partial):
+        if not hdfs.exists(path):
+            log.warn('Could not store the ADAM conversion of %s, using it from %s.', url, partial)
+            return partial
+    elif not hdfs.exists(path):
+        raise RuntimeError('The ADAM conversion of {} was lost while moving it to {}'.format(url, path))
+    hdfs.remove(attempt)
+    return path
@@ -0,0 +1,61 @@
+import os
+import shutil
+import struct
+import tempfile
+from unittest import TestCase
+
+from toil_scripts.adam_pipeline.autosize import GiB, SizingModel, autosize, bai_read_count
+
+
+def bai(refs, no_coor=None):
+    """
+    Builds a BAM index whose references each have one ordinary bin and, if counts are given, the pseudo-bin
+    """
+    data = 'BAI\1' + struct.pack('<i', len(refs))
+    for counts in refs:
+        bins = struct.pack('<Ii2Q', 4681, 1, 0, 100)
+        if counts is not None:
+            bins += struct.pack('<Ii4Q', 37450, 2, 0, 100, counts[0], counts[1])
+        data += struct.pack('<i', 1 if counts is None else 2) + bins + struct.pack('<iQ', 1, 0)
+    if no_coor is not None:
+        data += struct.pack('<Q', no_coor)
+    return data
+
+
+class AutosizeTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def _write(self, name, data):
+        path = os.path.join(self.work_dir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_bai_read_count(self):
+        self.assertEqual(bai_read_count(self._write('a.bai', bai([(10, 2), (5, 0)], no_coor=3))), 20)
+        self.assertEqual(bai_read_count(self._write('b.bai', bai([(10, 2)]))), 12)
+        self.assertIsNone(bai_read_count(self._write('c.bai', bai([None]))))
+
+    def test_autosize_from_index(self):
+        model = SizingModel(bytes_per_read=GiB, input_expansion=1.0, cache_fraction=0.5, overhead=2, min_memory=4,
+                            partition_size=1024, tasks_per_core=2)
+        bam = self._write('sample.bam', 'x' * 4096)
+        self._write('sample.bam.bai', bai([(10, 0)]))
+        sizing = autosize(bam, max_workers=8, max_memory=10, cores=4, work_dir=self.work_dir, model=model)
+        # 10 reads of 1 GiB each, with half of the memory for data, need 20 GiB over workers with 8 GiB to spare
+        self.assertEqual((sizing.reads, sizing.workers, sizing.memory), (10, 3, 9))
+        self.assertEqual(sizing.partitions, 24)
+        sizing = autosize(bam, max_workers=2, max_memory=10, cores=4, work_dir=self.work_dir, model=model)
+        self.assertEqual((sizing.workers, sizing.memory), (2, 10))
+
+    def test_autosize_from_size(self):
+        model = SizingModel(bytes_per_read=GiB, input_expansion=1.0, cache_fraction=0.5, overhead=2, min_memory=4,
+                            partition_size=1024, tasks_per_core=1)
+        sam = self._write('sample.sam', 'x' * 40960)
+        sizing = autosize(sam, max_workers=8, max_memory=10, cores=1, work_dir=self.work_dir, model=model)
+        self.assertEqual((sizing.reads, sizing.workers, sizing.memory, sizing.partitions), (None, 1, 4, 40))
@@ -0,0 +1,82 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from toil_scripts.adam_pipeline.known_sites import KNOWN_SITES_DIR, cached_known_sites, known_sites_key
+
+ROOT = 'hdfs://master:8020'
+
+
+class FakeHDFS(object):
+    """
+    In-memory HDFS that holds a set of file paths and moves them like `hdfs dfs -mv`
+    """
+
+    def __init__(self, rename_fails=False):
+        self.files = set()
+        self.rename_fails = rename_fails
+
+    def exists(self, filename):
+        return any(x == filename or x.startswith(filename + '/') for x in self.files)
+
+    def isdir(self, filename):
+        return any(x.startswith(filename + '/') for x in self.files)
+
+    def rename(self, src, dst):
+        if self.isdir(dst):
+            dst = dst + '/' + src.rsplit('/', 1)[1]
+        if self.rename_fails or not self.exists(src) or self.exists(dst):
+            return False
+        moved = set(x for x in self.files if x == src or x.startswith(src + '/'))
+        self.files = (self.files - moved) | set(dst + x[len(src):] for x in moved)
+        return True
+
+    def remove(self, *filenames):
+        self.files = set(x for x in self.files if not any(x == y or x.startswith(y + '/') for y in filenames))
+
+
+class KnownSitesTest(TestCase):
+
+    def setUp(self):
+        fd, self.vcf = tempfile.mkstemp(suffix='.vcf')
+        os.close(fd)
+        self.path = '{}/{}/{}.var.adam'.format(ROOT, KNOWN_SITES_DIR, known_sites_key(self.vcf))
+        self.conversions = []
+
+    def tearDown(self):
+        os.remove(self.vcf)
+
+    def converter(self, hdfs, before=None):
+        def convert(adam_path):
+            self.conversions.append(adam_path)
+            hdfs.files.add(adam_path + '/part-0.parquet')
+            if before:
+                before()
+        return convert
+
+    def test_stores_conversion(self):
+        hdfs = FakeHDFS()
+        hdfs.files.add(ROOT + '/' + KNOWN_SITES_DIR + '/other.var.adam/part-0.parquet')
+        self.assertEqual(cached_known_sites(hdfs, ROOT, self.vcf, self.converter(hdfs)), self.path)
+        self.assertIn(self.path + '/part-0.parquet', hdfs.files)
+        self.assertEqual(len(hdfs.files), 2)
+        # Later samples reuse it
+        self.assertEqual(cached_known_sites(hdfs, ROOT, self.vcf, self.converter(hdfs)), self.path)
+        self.assertEqual(len(self.conversions), 1)
+
+    def test_concurrent_conversion(self):
+        hdfs = FakeHDFS()
+        # Another sample stores its conversion while this one converts
+        stored = self.path + '/part-0.parquet'
+        result = cached_known_sites(hdfs, ROOT, self.vcf, self.converter(hdfs, lambda: hdfs.files.add(stored)))
+        self.assertEqual(result, self.path)
+        # Nothing is nested inside the other sample's dataset, and the partial conversion is removed
+        self.assertEqual(hdfs.files, {stored})
+
+    def test_failed_move(self):
+        hdfs = FakeHDFS(rename_fails=True)
+        result = cached_known_sites(hdfs, ROOT, self.vcf, self.converter(hdfs))
+        # The sample uses its own conversion, which is kept
+        self.assertEqual(result, self.conversions[0])
+        self.assertTrue(hdfs.exists(result))
+        self.assertFalse(hdfs.exists(self.path))
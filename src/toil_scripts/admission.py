@@ -0,0 +1,204 @@
+#!/usr/bin/env python2.7
+"""
+Disk-budgeted admission of samples into a pipeline.
+
+map_job starts every sample of a manifest at once, so with thousands of samples all downloads run together and
+exhaust scratch space and bandwidth. budgeted_map_job() instead runs samples in a fixed number of lanes. Each lane
+is a chain that admits its next sample once the previous one, including all of its descendant jobs, has finished.
+
+The number of lanes is the largest number of samples whose estimated footprints fit in the disk budget at once,
+even if the largest samples happen to run together. Samples are dealt out largest first, each to the lane with the
+least work so far (longest-processing-time-first scheduling). This keeps lanes balanced and the largest samples from
+being left for last, which shortens the makespan.
+
+Because a lane admits its next sample as a follow-on of the previous one, a sample that fails for good (after Toil's
+retries) stops the rest of its lane: those samples never start, while the other lanes carry on. map_job, by contrast,
+lets every other sample finish. Toil has no way for a job to outlive the failure of another job's descendants, so
+samples left over by a failed lane are run by restarting the workflow, or in a new one.
+"""
+import logging
+import os
+import urllib2
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+
+from bd2k.util.humanize import human2bytes
+from toil_lib.jobs import map_job
+
+log = logging.getLogger(__name__)
+
+# total:            Bytes of scratch space that samples in flight may use together, None for no limit
+# expansion:        Ratio of a sample's peak footprint to the size of its inputs
+# unknown_size:     Input size assumed for samples whose size cannot be determined. Defaults to the median of the
+#                   known sizes, or to the whole budget (one sample at a time) if no size is known.
+# max_concurrent:   Optional cap on the number of samples in flight, e.g. to bound bandwidth
+DiskBudget = namedtuple('DiskBudget', 'total expansion unknown_size max_concurrent')
+DiskBudget.__new__.__defaults__ = (1.0, None, None)
+
+
+def disk_budget(total, expansion=1.0, unknown_size=None, max_concurrent=None):
+    """
+    Builds a DiskBudget from user-supplied values
+
+    :param str total: Disk budget, as a number followed by (base-10) [TGMK], e.g. 2T. No limit if empty.
+    :param float expansion: Ratio of a sample's peak footprint to the size of its inputs
+    :param str unknown_size: Input size assumed for samples whose size is unknown, e.g. 100G
+    :param int max_concurrent: Maximum number of samples in flight
+    :return: The budget, or None if neither a total nor a maximum number of samples was given
+    :rtype: DiskBudget|None
+    """
+    if not total and not max_concurrent:
+        return None
+    return DiskBudget(total=human2bytes(str(total)) if total else None,
+                      expansion=expansion,
+                      unknown_size=human2bytes(str(unknown_size)) if unknown_size else None,
+                      max_concurrent=int(max_concurrent) if max_concurrent else None)
+
+
+def url_size(url):
+    """
+    Returns the size in bytes of the file at a URL, or None if it cannot be determined
+
+    :param str url: file://, http(s)://, ftp:// or s3:// URL, or a local path
+    :rtype: int|None
+    """
+    parsed = urlparse(url)
+    try:
+        if parsed.scheme in ('', 'file'):
+            return os.path.getsize(parsed.path)
+        elif parsed.scheme in ('http', 'https'):
+            request = urllib2.Request(url)
+            request.get_method = lambda: 'HEAD'
+            length = urllib2.urlopen(request, timeout=30).info().getheader('Content-Length')
+            return int(length) if length else None
+        elif parsed.scheme == 'ftp':
+            length = urllib2.urlopen(url, timeout=30).info().getheader('Content-Length')
+            return int(length) if length else None
+        elif parsed.scheme == 's3':
+            import boto
+            key = boto.connect_s3().get_bucket(parsed.netloc, validate=False).get_key(parsed.path.lstrip('/'))
+            return key.size if key else None
+    except Exception as e:
+        log.warn('Could not determine the size of %s: %s', url, e)
+    return None
+
+
+def estimate_input_size(urls, threads=16):
+    """
+    Returns the total size of the files at the given URLs, or None if the size of any of them is unknown
+
+    :param list[str] urls: URLs of a sample's inputs
+    :param int threads: Number of sizes requested concurrently
+    :rtype: int|None
+    """
+    if not urls:
+        return None
+    pool = ThreadPool(min(threads, len(urls)))
+    try:
+        sizes = pool.map(url_size, urls)
+    finally:
+        pool.close()
+        pool.join()
+    return None if None in sizes else sum(sizes)
+
+
+def sample_footprints(samples, sample_urls, budget, threads=16):
+    """
+    Estimates the peak scratch footprint of every sample from the size of its inputs
+
+    :param list samples: Samples, as passed to the per-sample job function
+    :param function sample_urls: Returns the list of input URLs of a sample
+    :param DiskBudget budget: Disk budget
+    :param int threads: Number of sizes requested concurrently
+    :rtype: list[int]
+    """
+    pool = ThreadPool(threads)
+    try:
+        sizes = pool.map(lambda x: estimate_input_size(sample_urls(x), threads=1), samples)
+    finally:
+        pool.close()
+        pool.join()
+    known = sorted(x for x in sizes if x is not None)
+    if budget.unknown_size is not None:
+        unknown = budget.unknown_size
+    elif known:
+        unknown = known[len(known) // 2]
+    else:
+        unknown = budget.total / budget.expansion if budget.total else 0
+    return [int((unknown if x is None else x) * budget.expansion) for x in sizes]
+
+
+def num_lanes(footprints, budget):
+    """
+    Returns the number of samples that may be in flight at once: the largest number whose biggest footprints
+    together fit in the budget, and at least one
+
+    :param list[int] footprints: Estimated footprint of every sample
+    :param DiskBudget budget: Disk budget
+    :rtype: int
+    """
+    lanes, total = 0, 0
+    for footprint in sorted(footprints, reverse=True):
+        total += footprint
+        if budget.total is not None and total > budget.total:
+            break
+        lanes += 1
+    if budget.max_concurrent:
+        lanes = min(lanes, budget.max_concurrent)
+    return max(lanes, 1)
+
+
+def lpt_lanes(items, sizes, lanes):
+    """
+    Distributes items over lanes, largest first, each to the lane with the smallest total size so far, or with the
+    fewest items among lanes of equal size (e.g. when no size is known)
+
+    :param list items: Items to distribute
+    :param list[int] sizes: Size of every item
+    :param int lanes: Number of lanes
+    :return: Items of every lane, largest first within each lane
+    :rtype: list[list]
+    """
+    result = [[] for _ in xrange(max(min(lanes, len(items)), 1))]
+    totals = [0] * len(result)
+    for size, i in sorted(((size, i) for i, size in enumerate(sizes)), key=lambda x: (-x[0], x[1])):
+        lane = min(xrange(len(result)), key=lambda x: (totals[x], len(result[x])))
+        result[lane].append(items[i])
+        totals[lane] += size
+    return result
+
+
+def budgeted_map_job(job, func, samples, budget, sample_urls, *args):
+    """
+    Like toil_lib.jobs.map_job, but only admits as many samples at a time as fit in a disk budget
+
+    Falls back to map_job if no budget is given. A sample that fails for good keeps the later samples of its lane
+    from starting (see the module's docstring).
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param function func: Job function called as func(job, sample, *args)
+    :param list samples: Samples to run
+    :param DiskBudget budget: Disk budget, or None to run all samples at once
+    :param function sample_urls: Returns the list of input URLs of a sample, used to estimate its footprint
+    :param args: Additional arguments passed to func
+    """
+    if budget is None or not samples:
+        job.addChildJobFn(map_job, func, samples, *args)
+        return
+    footprints = sample_footprints(samples, sample_urls, budget)
+    lanes = lpt_lanes(samples, footprints, num_lanes(footprints, budget))
+    job.fileStore.logToMaster('Admitting {} samples in {} lanes (disk budget: {} bytes, estimated total: {} bytes)'
+                              .format(len(samples), len(lanes), budget.total, sum(footprints)))
+    for lane in lanes:
+        job.addChildJobFn(_run_lane, func, lane, *args)
+
+
+def _run_lane(job, func, lane, *args):
+    """
+    Runs the first sample of a lane, and the rest of the lane once it has finished
+    """
+    job.addChildJobFn(func, lane[0], *args)
+    if len(lane) > 1:
+        # Follow-ons only start after every descendant of the child has finished
+        job.addFollowOnJobFn(_run_lane, func, lane[1:], *args)
@@ -12,19 +12,41 @@ from toil.job import Job
 from toil_lib import require, required_length
 from toil_lib.files import copy_file_job
 from toil_lib.files import generate_file
-from toil_lib.jobs import map_job
 from toil_lib.tools.aligners import run_bwakit
 from toil_lib.tools.indexing import run_samtools_faidx, run_bwa_index
 from toil_lib.urls import download_url_job, s3am_upload_job
 
+from toil_scripts.admission import budgeted_map_job, disk_budget
 
-def download_reference_files(job, inputs, samples):
+
+def download_reference_files(job, inputs, samples, shared_ids=None):
     """
     Downloads shared files that are used by all samples for alignment, or generates them if they were not provided.
 
     :param JobFunctionWrappingJob job: passed automatically by Toil
     :param Namespace inputs: Input arguments (see main)
     :param list[list[str, list[str, str]]] samples: Samples in the format [UUID, [URL1, URL2]]
+    :param dict shared_ids: FileStoreIDs of the shared files, if they were already staged with stage_reference_files
+    """
+    if shared_ids is None:
+        shared_ids = stage_reference_files(job, inputs)
+
+    # Distributes one sample in samples to the download_sample_and_align function, as many at a time as the disk
+    # budget allows (all at once if there is none)
+    budget = disk_budget(getattr(inputs, 'disk_budget', None), expansion=3.0,
+                         max_concurrent=getattr(inputs, 'max_concurrent_samples', None))
+    job.addFollowOnJobFn(budgeted_map_job, download_sample_and_align, samples, budget, sample_urls, inputs, shared_ids)
+
+
+def stage_reference_files(job, inputs):
+    """
+    Adds child jobs that download the reference and its indexes, or generate the indexes if they were not provided
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param Namespace inputs: Input arguments (see main)
+    :return: FileStoreIDs of the shared files by name (ref, fai, amb, ann, bwt, pac, sa and optionally alt),
+        fulfilled once the children of job have finished
+    :rtype: dict
     """
     # Create dictionary to store FileStoreIDs of shared input files
     shared_ids = {}
@@ -53,9 +75,17 @@ def download_reference_files(job, inputs, samples):
         download_ref.addChild(bwa_index)
         for x, name in enumerate(['amb', 'ann', 'bwt', 'pac', 'sa']):
             shared_ids[name] = bwa_index.rv(x)
+    return shared_ids
+
 
-    # Map_job distributes one sample in samples to the downlaod_sample_and_align function
-    job.addFollowOnJobFn(map_job, download_sample_and_align, samples, inputs, shared_ids)
+def sample_urls(sample):
+    """
+    Returns the fastq URLs of a sample in the format [UUID, [URL1, URL2]]
+
+    :param list sample: Sample
+    :rtype: list[str]
+    """
+    return sample[1]
 
 
 def download_sample_and_align(job, sample, inputs, ids):
@@ -165,6 +195,13 @@ def generate_config():
 
         # Optional: Optional suffix to add to sample output
         suffix:
+
+        # Optional: Total scratch space that samples in flight may use together, e.g. 2T. Samples are then started,
+        # largest first, as earlier ones finish. If blank (and max-concurrent-samples is blank), all start at once.
+        disk-budget:
+
+        # Optional: Maximum number of samples in flight at once
+        max-concurrent-samples:
     """[1:])
 
 
@@ -0,0 +1,163 @@
+#!/usr/bin/env python2.7
+"""
+Consolidation of per-tool output tarballs into a single gzipped tarball per sample.
+
+tarfile's 'w:gz' mode compresses the whole archive on one thread, and compresses again members that are already
+compressed (.vcf.gz, .bam, ...). consolidate_tarballs() writes the archive through a ParallelGzipWriter instead.
+The output is a series of independent gzip members, which gunzip and tarfile read as one stream. Blocks of ordinary
+members are compressed on a pool of threads (zlib releases the GIL), while already-compressed members are written
+as stored blocks.
+
+The same writer can produce BGZF (the blocked gzip of bgzip and samtools), whose members carry their own size so that
+indexed readers can seek to them.
+"""
+import multiprocessing
+import os
+import struct
+import tarfile
+import zlib
+from collections import deque
+from contextlib import closing
+from multiprocessing.pool import ThreadPool
+
+COMPRESSED_SUFFIXES = ('.gz', '.bgz', '.tgz', '.bz2', '.xz', '.zip', '.bam', '.cram')
+
+# Largest input of a BGZF block that is guaranteed to compress into the 64 KiB a block may hold
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = ('\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43\x02\x00\x1b\x00'
+            '\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+
+def _gzip_member(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _bgzf_member(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+    # gzip header with the BC extra subfield, which holds the size of the whole block minus one
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, len(deflated) + 25)
+    return header + deflated + struct.pack('<2I', zlib.crc32(data) & 0xffffffff, len(data))
+
+
+class ParallelGzipWriter(object):
+    """
+    File-like object that gzips what is written to it on several threads, preserving order.
+    """
+
+    def __init__(self, fileobj, level=6, threads=None, block_size=1024 * 1024, bgzf=False):
+        """
+        :param file fileobj: Destination of the gzipped stream
+        :param int level: zlib compression level of ordinary data
+        :param int threads: Number of compression threads. Defaults to the number of cores.
+        :param int block_size: Bytes of input compressed per gzip member
+        :param bool bgzf: Write BGZF, in blocks of at most BGZF_BLOCK_SIZE bytes followed by an end-of-file block
+        """
+        self.fileobj = fileobj
+        self.level = level
+        self.bgzf = bgzf
+        self.block_size = min(block_size, BGZF_BLOCK_SIZE) if bgzf else block_size
+        self.compress = _bgzf_member if bgzf else _gzip_member
+        self.threads = threads or multiprocessing.cpu_count()
+        self.pool = ThreadPool(self.threads)
+        # Bounds memory use to a couple of blocks per thread
+        self.window = 2 * self.threads
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+        self.buffer_level = level
+
+    def write(self, data, compress=True):
+        """
+        Appends data to the stream
+
+        :param str data: Data to write
+        :param bool compress: False for data that is already compressed, which is then stored as is
+        """
+        level = self.level if compress else 0
+        if level != self.buffer_level:
+            while self.buffered:
+                self._flush_block()
+            self.buffer_level = level
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._flush_block()
+
+    def _flush_block(self):
+        if not self.buffered:
+            return
+        data = ''.join(self.buffer)
+        self.buffer, self.buffered = [], 0
+        if self.bgzf:
+            # BGZF blocks are bounded in size, so whatever does not fit is carried over into the next block
+            data, rest = data[:self.block_size], data[self.block_size:]
+            if rest:
+                self.buffer, self.buffered = [rest], len(rest)
+        self.pending.append(self.pool.apply_async(self.compress, (data, self.buffer_level)))
+        while len(self.pending) > self.window:
+            self.fileobj.write(self.pending.popleft().get())
+        if self.buffered >= self.block_size:
+            self._flush_block()
+
+    def close(self):
+        while self.buffered:
+            self._flush_block()
+        try:
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().get())
+            if self.bgzf:
+                self.fileobj.write(BGZF_EOF)
+        finally:
+            self.pool.close()
+            self.pool.join()
+
+
+def consolidate_tarballs(output_path, sources, threads=None):
+    """
+    Combines the members of several tarballs into one gzipped tarball, each under a directory of its own.
+
+    The archive is written to a temporary name beside output_path and renamed into place once complete, so it can
+    be written straight into an output directory.
+
+    :param str output_path: Path of the consolidated tar.gz
+    :param list[tuple(str, str)] sources: (tarball path, directory within the consolidated tarball) for each input.
+        Members are placed in that directory under their base name.
+    :param int threads: Number of compression threads. Defaults to the number of cores.
+    :return: output_path
+    :rtype: str
+    """
+    partial_path = output_path + '.partial'
+    with open(partial_path, 'wb') as f_out:
+        writer = ParallelGzipWriter(f_out, threads=threads)
+        try:
+            offset = 0
+            for tar, arc_dir in sources:
+                with tarfile.open(tar, 'r') as f_in:
+                    for tarinfo in f_in:
+                        if not tarinfo.isfile():
+                            continue
+                        compress = not tarinfo.name.endswith(COMPRESSED_SUFFIXES)
+                        with closing(f_in.extractfile(tarinfo)) as f_in_file:
+                            tarinfo.name = os.path.join(arc_dir, os.path.basename(tarinfo.name))
+                            header = tarinfo.tobuf(tarfile.GNU_FORMAT)
+                            writer.write(header)
+                            offset += len(header)
+                            for chunk in iter(lambda: f_in_file.read(writer.block_size), ''):
+                                writer.write(chunk, compress=compress)
+                                offset += len(chunk)
+                        padding = -offset % tarfile.BLOCKSIZE
+                        writer.write(tarfile.NUL * padding)
+                        offset += padding
+            # End-of-archive marker, padded to a full record as tarfile does
+            end = 2 * tarfile.BLOCKSIZE
+            end += -(offset + end) % tarfile.RECORDSIZE
+            writer.write(tarfile.NUL * end)
+        except:
+            writer.close()
+            os.remove(partial_path)
+            raise
+        writer.close()
+    os.rename(partial_path, output_path)
+    return output_path
@@ -3,9 +3,7 @@ import argparse
 import multiprocessing
 import os
 import sys
-import tarfile
 import textwrap
-from contextlib import closing
 from urlparse import urlparse
 
 import yaml
@@ -13,8 +11,6 @@ from bd2k.util.files import mkdir_p
 from bd2k.util.processes import which
 from toil.job import Job
 from toil_lib import require
-from toil_lib.files import copy_files
-from toil_lib.jobs import map_job
 from toil_lib.tools.mutation_callers import run_muse
 from toil_lib.tools.mutation_callers import run_mutect
 from toil_lib.tools.mutation_callers import run_pindel
@@ -24,6 +20,9 @@ from toil_lib.tools.preprocessing import run_samtools_faidx
 from toil_lib.tools.preprocessing import run_samtools_index
 from toil_lib.urls import download_url_job, s3am_upload
 
+from toil_scripts.admission import budgeted_map_job, disk_budget
+from toil_scripts.consolidation import consolidate_tarballs
+
 
 # Start of Job Functions
 def download_shared_files(job, samples, config):
@@ -54,7 +53,20 @@ def reference_preprocessing(job, samples, config):
     job.fileStore.logToMaster('Processed reference files')
     config.fai = job.addChildJobFn(run_samtools_faidx, config.reference).rv()
     config.dict = job.addChildJobFn(run_picard_create_sequence_dictionary, config.reference).rv()
-    job.addFollowOnJobFn(map_job, download_sample, samples, config)
+    # Samples are started as many at a time as the disk budget allows (all at once if there is none)
+    budget = disk_budget(getattr(config, 'disk_budget', None), expansion=4.0,
+                         max_concurrent=getattr(config, 'max_concurrent_samples', None))
+    job.addFollowOnJobFn(budgeted_map_job, download_sample, samples, budget, sample_urls, config)
+
+
+def sample_urls(sample):
+    """
+    Returns the normal and tumor URLs of a sample
+
+    :param list sample: Contains uuid, normal URL, and tumor URL
+    :rtype: list[str]
+    """
+    return sample[1:]
 
 
 def download_sample(job, sample, config):
@@ -173,29 +185,22 @@ def consolidate_output(job, config, mutect, pindel, muse):
         pindel_tar = job.fileStore.readGlobalFile(pindel, os.path.join(work_dir, 'pindel.tar.gz'))
     if muse:
         muse_tar = job.fileStore.readGlobalFile(muse, os.path.join(work_dir, 'muse.tar.gz'))
-    out_tar = os.path.join(work_dir, config.uuid + '.tar.gz')
+    # Local output is written in place, S3 output is staged in the work directory for upload
+    is_s3 = urlparse(config.output_dir).scheme == 's3'
+    if is_s3:
+        out_tar = os.path.join(work_dir, config.uuid + '.tar.gz')
+    else:
+        mkdir_p(config.output_dir)
+        out_tar = os.path.join(config.output_dir, config.uuid + '.tar.gz')
     # Consolidate separate tarballs into one as streams (avoids unnecessary untaring)
-    tar_list = [x for x in [mutect_tar, pindel_tar, muse_tar] if x is not None]
-    with tarfile.open(os.path.join(work_dir, out_tar), 'w:gz') as f_out:
-        for tar in tar_list:
-            with tarfile.open(tar, 'r') as f_in:
-                for tarinfo in f_in:
-                    with closing(f_in.extractfile(tarinfo)) as f_in_file:
-                        if tar is mutect_tar:
-                            tarinfo.name = os.path.join(config.uuid, 'mutect', os.path.basename(tarinfo.name))
-                        elif tar is pindel_tar:
-                            tarinfo.name = os.path.join(config.uuid, 'pindel', os.path.basename(tarinfo.name))
-                        else:
-                            tarinfo.name = os.path.join(config.uuid, 'muse', os.path.basename(tarinfo.name))
-                        f_out.addfile(tarinfo, fileobj=f_in_file)
+    sources = [(mutect_tar, 'mutect'), (pindel_tar, 'pindel'), (muse_tar, 'muse')]
+    job.fileStore.logToMaster('Writing {} to: {}'.format(config.uuid, out_tar))
+    consolidate_tarballs(out_tar, [(tar, os.path.join(config.uuid, tool)) for tar, tool in sources if tar],
+                         threads=config.cores)
     # Move to output location
-    if urlparse(config.output_dir).scheme == 's3':
+    if is_s3:
         job.fileStore.logToMaster('Uploading {} to S3: {}'.format(config.uuid, config.output_dir))
         s3am_upload(job=job, fpath=out_tar, s3_dir=config.output_dir, num_cores=config.cores)
-    else:
-        job.fileStore.logToMaster('Moving {} to output dir: {}'.format(config.uuid, config.output_dir))
-        mkdir_p(config.output_dir)
-        copy_files(file_paths=[out_tar], output_dir=config.output_dir)
 
 
 def parse_manifest(path_to_manifest):
@@ -271,6 +276,13 @@ def generate_config():
 
     # Optional: If true, uses resource requirements appropriate for continuous integration
     ci-test: 
+
+    # Optional: Total scratch space that samples in flight may use together, e.g. 2T. Samples are then started,
+    # largest first, as earlier ones finish. If blank (and max-concurrent-samples is blank), all start at once.
+    disk-budget:
+
+    # Optional: Maximum number of samples in flight at once
+    max-concurrent-samples:
     """[1:])
 
 
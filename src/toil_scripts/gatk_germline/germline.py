@@ -64,6 +64,7 @@ from toil_lib.tools.variant_annotation import gatk_genotype_gvcfs, run_oncotator
 from toil_lib.urls import download_url_job
 import yaml
 
+from toil_scripts.admission import disk_budget, lpt_lanes, num_lanes, sample_footprints
 from toil_scripts.gatk_germline.common import output_file_job
 from toil_scripts.gatk_germline.germline_config_manifest import generate_config, generate_manifest
 from toil_scripts.gatk_germline.hard_filter import hard_filter_pipeline
@@ -85,7 +86,7 @@ class GermlineSample(namedtuple('GermlineSample', 'uuid url paired_url rg_line')
     """
 
 
-def run_gatk_germline_pipeline(job, samples, config):
+def run_gatk_germline_pipeline(job, samples, config, staged=False):
     """
     Downloads shared files and calls the GATK best practices germline pipeline for a cohort of samples
 
@@ -97,6 +98,10 @@ def run_gatk_germline_pipeline(job, samples, config):
         config.joint_genotype       If True, then joint genotypes cohort
         config.run_oncotator        If True, then adds Oncotator to pipeline
         Additional parameters are needed for downstream steps. Refer to pipeline README for more information.
+    :param bool staged: If True, config already holds the FileStoreIDs of the shared files (see
+        download_shared_files), which were staged once for several runs of the pipeline
+    :return: Dictionary of filtered VCF FileStoreIDs, or None if config.preprocess_only
+    :rtype: dict
     """
     # Determine the available disk space on a worker node before any jobs have been run.
     work_dir = job.fileStore.getLocalTempDir()
@@ -110,27 +115,39 @@ def run_gatk_germline_pipeline(job, samples, config):
                                   '30 to 200 samples for joint genotyping. '
                                   'The current cohort has %d samples.' % num_samples)
 
-    shared_files = Job.wrapJobFn(download_shared_files, config).encapsulate()
+    if staged:
+        shared_files = Job()
+        shared_config = config
+    else:
+        shared_files = Job.wrapJobFn(download_shared_files, config).encapsulate()
+        shared_config = shared_files.rv()
     job.addChild(shared_files)
 
     if config.preprocess_only:
-        for sample in samples:
-            shared_files.addChildJobFn(prepare_bam,
-                                       sample.uuid,
-                                       sample.url,
-                                       shared_files.rv(),
-                                       paired_url=sample.paired_url,
-                                       rg_line=sample.rg_line)
+        for lane in sample_lanes(job, samples, config):
+            # Each sample in a lane starts once the previous one, and all of its descendants, has finished. If one
+            # fails for good, the rest of its lane does not start (see toil_scripts.admission).
+            previous = None
+            for sample in lane:
+                add = previous.addFollowOnJobFn if previous else shared_files.addChildJobFn
+                previous = add(prepare_bam,
+                               sample.uuid,
+                               sample.url,
+                               shared_config,
+                               paired_url=sample.paired_url,
+                               rg_line=sample.rg_line)
     else:
         run_pipeline = Job.wrapJobFn(gatk_germline_pipeline,
                                      samples,
-                                     shared_files.rv()).encapsulate()
+                                     shared_config).encapsulate()
         shared_files.addChild(run_pipeline)
 
         if config.run_oncotator:
-            annotate = Job.wrapJobFn(annotate_vcfs, run_pipeline.rv(), shared_files.rv())
+            annotate = Job.wrapJobFn(annotate_vcfs, run_pipeline.rv(), shared_config)
             run_pipeline.addChild(annotate)
 
+        return run_pipeline.rv()
+
 
 def gatk_germline_pipeline(job, samples, config):
     """
@@ -172,44 +189,48 @@ def gatk_germline_pipeline(job, samples, config):
     # group preprocessing and variant calling steps in empty Job instance
     group_bam_jobs = Job()
     gvcfs = {}
-    for sample in samples:
-        # 0: Generate processed BAM and BAI files for each sample
-        get_bam = group_bam_jobs.addChildJobFn(prepare_bam,
-                                               sample.uuid,
-                                               sample.url,
-                                               config,
-                                               paired_url=sample.paired_url,
-                                               rg_line=sample.rg_line)
-
-        # 1: Generate per sample gvcfs {uuid: gvcf_id}
-        # The HaplotypeCaller disk requirement depends on the input bam, bai, the genome reference
-        # files, and the output GVCF file. The output GVCF is smaller than the input BAM file.
-        hc_disk = PromisedRequirement(lambda bam, bai, ref_size:
-                                      2 * bam.size + bai.size + ref_size,
-                                      get_bam.rv(0),
-                                      get_bam.rv(1),
-                                      genome_ref_size)
-
-        get_gvcf = get_bam.addFollowOnJobFn(gatk_haplotype_caller,
-                                            get_bam.rv(0),
-                                            get_bam.rv(1),
-                                            config.genome_fasta, config.genome_fai, config.genome_dict,
-                                            annotations=config.annotations,
-                                            cores=config.cores,
-                                            disk=hc_disk,
-                                            memory=config.xmx,
-                                            hc_output=config.hc_output)
-        # Store cohort GVCFs in dictionary
-        gvcfs[sample.uuid] = get_gvcf.rv()
-
-        # Upload individual sample GVCF before genotyping to a sample specific output directory
-        vqsr_name = '{}{}.g.vcf'.format(sample.uuid, config.suffix)
-        get_gvcf.addChildJobFn(output_file_job,
-                               vqsr_name,
-                               get_gvcf.rv(),
-                               os.path.join(config.output_dir, sample.uuid),
-                               s3_key_path=config.ssec,
-                               disk=PromisedRequirement(lambda x: x.size, get_gvcf.rv()))
+    for lane in sample_lanes(job, samples, config):
+        # Each sample in a lane starts once the GVCF of the previous one has been called
+        parent = group_bam_jobs
+        for sample in lane:
+            # 0: Generate processed BAM and BAI files for each sample
+            get_bam = parent.addChildJobFn(prepare_bam,
+                                           sample.uuid,
+                                           sample.url,
+                                           config,
+                                           paired_url=sample.paired_url,
+                                           rg_line=sample.rg_line)
+
+            # 1: Generate per sample gvcfs {uuid: gvcf_id}
+            # The HaplotypeCaller disk requirement depends on the input bam, bai, the genome reference
+            # files, and the output GVCF file. The output GVCF is smaller than the input BAM file.
+            hc_disk = PromisedRequirement(lambda bam, bai, ref_size:
+                                          2 * bam.size + bai.size + ref_size,
+                                          get_bam.rv(0),
+                                          get_bam.rv(1),
+                                          genome_ref_size)
+
+            get_gvcf = get_bam.addFollowOnJobFn(gatk_haplotype_caller,
+                                                get_bam.rv(0),
+                                                get_bam.rv(1),
+                                                config.genome_fasta, config.genome_fai, config.genome_dict,
+                                                annotations=config.annotations,
+                                                cores=config.cores,
+                                                disk=hc_disk,
+                                                memory=config.xmx,
+                                                hc_output=config.hc_output)
+            # Store cohort GVCFs in dictionary
+            gvcfs[sample.uuid] = get_gvcf.rv()
+
+            # Upload individual sample GVCF before genotyping to a sample specific output directory
+            vqsr_name = '{}{}.g.vcf'.format(sample.uuid, config.suffix)
+            get_gvcf.addChildJobFn(output_file_job,
+                                   vqsr_name,
+                                   get_gvcf.rv(),
+                                   os.path.join(config.output_dir, sample.uuid),
+                                   s3_key_path=config.ssec,
+                                   disk=PromisedRequirement(lambda x: x.size, get_gvcf.rv()))
+            parent = get_gvcf
 
     # VQSR requires many variants in order to train a decent model. GATK recommends a minimum of
     # 30 exomes or one large WGS sample:
@@ -233,6 +254,31 @@ def gatk_germline_pipeline(job, samples, config):
     return filtered_vcfs
 
 
+def sample_lanes(job, samples, config):
+    """
+    Splits samples into lanes of samples that run one after the other, so that only as many samples as fit in the
+    disk budget are in flight at once. See toil_scripts.admission.
+
+    :param JobFunctionWrappingJob job: passed automatically by Toil
+    :param list[GermlineSample] samples: List of GermlineSample namedtuples
+    :param Namespace config: Configuration options for pipeline
+        Uses the following optional config attributes:
+        config.disk_budget              Total scratch space samples in flight may use together, e.g. 2T
+        config.max_concurrent_samples   Maximum number of samples in flight at once
+    :return: Lanes of samples, or one lane per sample if there is no budget
+    :rtype: list[list[GermlineSample]]
+    """
+    budget = disk_budget(getattr(config, 'disk_budget', None), expansion=4.0,
+                         max_concurrent=getattr(config, 'max_concurrent_samples', None))
+    if budget is None:
+        return [[sample] for sample in samples]
+    footprints = sample_footprints(samples, lambda x: [x.url] + ([x.paired_url] if x.paired_url else []), budget)
+    lanes = lpt_lanes(samples, footprints, num_lanes(footprints, budget))
+    job.fileStore.logToMaster('Admitting {} samples in {} lanes (disk budget: {} bytes, estimated total: {} bytes)'
+                              .format(len(samples), len(lanes), budget.total, sum(footprints)))
+    return lanes
+
+
 def joint_genotype_and_filter(job, gvcfs, config):
     """
     Checks for enough disk space for joint genotyping, then calls the genotype and filter pipeline function.
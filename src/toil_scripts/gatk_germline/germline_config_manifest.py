@@ -123,6 +123,13 @@ def generate_config():
 
         # Optional: Allow seq dict incompatibility (Default: False)
         unsafe-mode:
+
+        # Optional: Total scratch space that samples in flight may use together, e.g. 2T. Further samples start
+        # as earlier ones finish. (Default: None, all samples start at once)
+        disk-budget:
+
+        # Optional: Maximum number of samples in flight at once (Default: None)
+        max-concurrent-samples:
         """[1:])
 
 
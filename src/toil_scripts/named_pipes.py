@@ -0,0 +1,108 @@
+#!/usr/bin/env python2.7
+"""
+Feeding tools from named pipes instead of intermediate files.
+
+Decompressing and concatenating a sample's fastq.gz files produces FASTQs several times the size of the input, which
+the aligners then read exactly once, front to back. A FifoFeed instead runs the decompression in the consuming job,
+writing into a named pipe inside the job's work directory. Since the work directory is mounted into the tool's
+container, the tool reads the pipe as if it were the file and the uncompressed reads never touch the disk.
+"""
+import errno
+import os
+import stat
+import subprocess
+import threading
+import time
+
+
+class FifoFeed(object):
+    """
+    Runs a command whose standard output is written into a named pipe.
+
+    The pipe is created immediately. The command is started from a background thread once a reader opens the pipe,
+    so the feed can be set up before the consuming tool is launched.
+
+    A feed serves exactly one open: the consumer must read the pipe once, front to back, and must not seek in it.
+    Stat'ing the path is fine. Once the command has finished, the pipe is removed, so a consumer that opens its input
+    a second time fails on the missing file instead of blocking forever on a pipe without a writer.
+    """
+
+    def __init__(self, command, path):
+        """
+        :param list command: Command whose standard output feeds the pipe, e.g. ['zcat', 'a_R1.fq.gz', 'b_R1.fq.gz']
+        :param str path: Path of the named pipe to create
+        """
+        self.command = command
+        self.path = path
+        self.process = None
+        self.returncode = None
+        self.error = None
+        os.mkfifo(path)
+        # Containers may read the pipe as a different user
+        os.chmod(path, 0666)
+        self.thread = threading.Thread(target=self._feed)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _feed(self):
+        try:
+            # Blocks until the consumer opens the pipe for reading
+            with open(self.path, 'w') as f:
+                self.process = subprocess.Popen(self.command, stdout=f)
+            self.returncode = self.process.wait()
+            # The open read end keeps the remaining output readable, a second open fails
+            os.remove(self.path)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        """
+        Waits for the command to finish, raising if it failed or its output was not fully consumed.
+        """
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError('Feeding {} failed: {}'.format(self.path, self.error))
+        if self.returncode != 0:
+            raise RuntimeError('{} exited with status {} while feeding {}'.format(
+                self.command[0], self.returncode, self.path))
+
+    def close(self):
+        """
+        Stops a feed whose consumer exited early or never opened the pipe (e.g. because the tool failed), and
+        removes the pipe.
+        """
+        if self.thread.is_alive():
+            # Opening the read end releases a feed still waiting for its consumer
+            try:
+                fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                # The feed finished and removed the pipe in the meantime
+                fd = None
+            try:
+                while self.thread.is_alive() and self.process is None:
+                    time.sleep(0.1)
+                if self.process is not None and self.process.poll() is None:
+                    try:
+                        self.process.kill()
+                    except OSError:
+                        # Exited in the meantime
+                        pass
+                self.thread.join()
+            finally:
+                if fd is not None:
+                    os.close(fd)
+        if os.path.exists(self.path) and stat.S_ISFIFO(os.stat(self.path).st_mode):
+            os.remove(self.path)
+
+
+def decompress_command(paths):
+    """
+    Returns the command that writes the concatenated, decompressed contents of paths to standard output
+
+    :param list paths: fastq or fastq.gz files, possibly mixed
+    :rtype: list
+    """
+    # zcat -f passes files that are not gzipped through unchanged
+    return (['zcat', '-f'] if any(x.endswith('gz') for x in paths) else ['cat']) + list(paths)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python2.7
+"""
+Node-level store of extracted reference archives.
+
+Reference archives (bowtie indices, RSEM references, STAR indices) are identical for every sample in a run, yet
+each job that needs one used to unpack a private copy into its own work directory. The helpers in this module
+unpack an archive once per node into a shared directory, keyed by something that identifies its contents, so
+that later jobs on the same node can reuse the extracted copy (typically through a read-only bind mount).
+
+Extracted archives outlive the workflow, so that later runs with the same references can reuse them. Every use
+refreshes an archive's modification time, and extract_once() evicts archives that no job on the node has used for
+MAX_AGE seconds, along with the scratch directories of jobs killed while extracting. The cache directory can also
+be pruned by hand with evict_stale(), or removed outright while no workflow is running on the node.
+"""
+import errno
+import fcntl
+import hashlib
+import os
+import shutil
+import stat
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+# Seconds after its last use an extracted archive is evicted. Far longer than any job that mounts one runs.
+MAX_AGE = 7 * 24 * 60 * 60
+
+
+def cache_key(*parts):
+    """
+    Builds a filesystem-safe key from values that identify an archive (name, FileStoreID, URL, checksum, ...)
+
+    :param parts: Values that together identify the contents of an archive
+    :return: Hex digest usable as a directory name
+    :rtype: str
+    """
+    return hashlib.sha1('\0'.join(str(x) for x in parts)).hexdigest()
+
+
+@contextmanager
+def node_lock(path):
+    """
+    Holds an exclusive advisory lock on `path` for the duration of the context
+
+    :param str path: Path of the lock file, created if it does not exist
+    """
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def unzip(archive, dest_dir):
+    """
+    Extracts a zip archive into dest_dir
+    """
+    subprocess.check_call(['unzip', '-q', '-o', archive, '-d', dest_dir])
+
+
+def untar(archive, dest_dir):
+    """
+    Extracts a (optionally compressed) tar archive into dest_dir
+    """
+    subprocess.check_call(['tar', '-xf', archive, '-C', dest_dir])
+
+
+def make_readable(path):
+    """
+    Lets every user read the files below path and traverse its directories, keeping the executable bits of files
+
+    :param str path: Directory to update, including everything below it
+    """
+    os.chmod(path, 0755)
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            child = os.path.join(root, name)
+            mode = os.lstat(child).st_mode
+            if stat.S_ISDIR(mode):
+                os.chmod(child, 0755)
+            elif stat.S_ISREG(mode):
+                executable = stat.S_IXGRP | stat.S_IXOTH if mode & stat.S_IXUSR else 0
+                os.chmod(child, stat.S_IMODE(mode) | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH | executable)
+
+
+def extract_once(cache_dir, key, fetch, extract, max_age=MAX_AGE):
+    """
+    Extracts an archive into `cache_dir`/`key` unless a job on this node has already done so.
+
+    Extraction happens in a scratch directory inside `cache_dir` that is renamed into place once complete, so a
+    job that dies halfway never leaves a partial directory behind that others would mistake for a finished one.
+
+    :param str cache_dir: Node-level directory that holds extracted archives
+    :param str key: Identifier for the archive contents without dots, e.g. from cache_key()
+    :param function fetch: Called with a scratch directory, returns the local path of the archive
+    :param function extract: Called with the archive path and the destination directory (e.g. unzip or untar)
+    :param int max_age: Seconds after their last use other archives in cache_dir are evicted, see evict_stale()
+    :return: Path to the directory holding the extracted archive contents
+    :rtype: str
+    """
+    try:
+        os.makedirs(cache_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    dest = os.path.join(cache_dir, key)
+    with node_lock(os.path.join(cache_dir, key + '.lock')):
+        if not os.path.isdir(dest):
+            scratch = tempfile.mkdtemp(prefix=key + '.', dir=cache_dir)
+            try:
+                extracted = os.path.join(scratch, 'extracted')
+                os.mkdir(extracted)
+                archive = fetch(scratch)
+                extract(archive, extracted)
+                os.remove(archive)
+                # Extracted references are only ever read, but by containers running as other users
+                make_readable(extracted)
+                os.rename(extracted, dest)
+            finally:
+                shutil.rmtree(scratch, ignore_errors=True)
+        # Marks the archive as used, which keeps it from being evicted
+        os.utime(dest, None)
+    evict_stale(cache_dir, max_age)
+    return dest
+
+
+def evict_stale(cache_dir, max_age=MAX_AGE):
+    """
+    Removes the archives in cache_dir that extract_once() has not returned for max_age seconds, and the scratch
+    directories of extractions that were abandoned as long ago.
+
+    :param str cache_dir: Node-level directory that holds extracted archives
+    :param int max_age: Seconds since the last use of an archive after which it is removed
+    """
+    cutoff = time.time() - max_age
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            if os.path.getmtime(path) > cutoff or not os.path.isdir(path):
+                continue
+        except OSError:
+            # Removed in the meantime
+            continue
+        if '.' in name:
+            # A scratch directory of extract_once(), named <key>.<random>
+            shutil.rmtree(path, ignore_errors=True)
+            continue
+        with node_lock(path + '.lock'):
+            # Another job may have used the archive while this one waited for the lock
+            if os.path.isdir(path) and os.path.getmtime(path) <= cutoff:
+                # Moved out of the way first, so that no job mistakes a partially removed archive for a complete one
+                scratch = tempfile.mkdtemp(prefix=name + '.', dir=cache_dir)
+                os.rename(path, os.path.join(scratch, 'evicted'))
+                shutil.rmtree(scratch, ignore_errors=True)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python2.7
+"""
+Coordinate- and name-sorted copies of a BAM from a single read.
+
+The UNC pipeline needs the read-grouped alignments twice: sorted by coordinate (sorted.bam, for RSeQC) and, per
+contig in header order, sorted by read name (sort_by_ref.bam, for exon counting and sam-xlate). dual_sort() reads
+the input once: tee copies it byte for byte into two samtools sorts running side by side, one by coordinate and
+one by name. The name-sorted stream is split by contig with awk, which keeps the name order within every contig,
+into one BAM per contig, and those are concatenated in header order.
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+# Splits name-sorted SAM records into one BAM per contig of the header, named after the contig's index in it.
+# The header is read first (FNR == NR), then the records.
+_SPLIT_BY_CONTIG = r'''
+FNR == NR {
+    if ($1 == "@SQ")
+        for (i = 2; i <= NF; i++)
+            if ($i ~ /^SN:/)
+                ids[substr($i, 4)] = n++
+    next
+}
+$3 in ids {
+    out = dir "/" ids[$3] ".bam"
+    if (!(out in commands))
+        commands[out] = "cat " q header q " - | " q samtools q " view -Sb - > " q out q
+    print | commands[out]
+}
+END {
+    for (out in commands)
+        if (close(commands[out]) != 0)
+            status = 1
+    exit status
+}
+'''
+
+
+def contigs(header):
+    """
+    :param str header: Path of a SAM header
+    :return: Names of the contigs of the header, in order
+    :rtype: list[str]
+    """
+    with open(header) as f:
+        return [x[3:] for line in f if line.startswith('@SQ')
+                for x in line.rstrip('\n').split('\t') if x.startswith('SN:')]
+
+
+def dual_sort(bam, coord_prefix, name_sorted_bam, work_dir, sort_memory=3000000000, samtools='samtools'):
+    """
+    Reads bam once and writes both a coordinate-sorted copy and a copy sorted by read name within each contig.
+    Like per-contig region queries, the name-sorted copy leaves out unplaced reads.
+
+    :param str bam: Input BAM
+    :param str coord_prefix: Output prefix of the coordinate sort; the BAM is written to coord_prefix + '.bam'
+    :param str name_sorted_bam: Path of the per-contig name-sorted BAM, whose contigs appear in header order
+    :param str work_dir: Directory that holds the temporary files of both sorts
+    :param int sort_memory: Bytes of memory used by each of the two sorts
+    :param str samtools: samtools executable
+    """
+    scratch = tempfile.mkdtemp(prefix='dual_sort', dir=work_dir)
+    try:
+        header = os.path.join(scratch, 'header.sam')
+        with open(header, 'w') as f:
+            subprocess.check_call([samtools, 'view', '-H', bam], stdout=f)
+        name_input = os.path.join(scratch, 'name_sort_input.bam')
+        os.mkfifo(name_input)
+        with open(bam, 'rb') as f:
+            tee = subprocess.Popen(['tee', name_input], stdin=f, stdout=subprocess.PIPE)
+        coord_sort = subprocess.Popen([samtools, 'sort', '-m', str(sort_memory), '-', coord_prefix],
+                                      stdin=tee.stdout)
+        tee.stdout.close()
+        # -o writes the sorted BAM to stdout; the prefix is only used for temporary files
+        name_sort = subprocess.Popen([samtools, 'sort', '-n', '-o', '-m', str(sort_memory), name_input,
+                                      os.path.join(scratch, 'name_sorted')], stdout=subprocess.PIPE)
+        view = subprocess.Popen([samtools, 'view', '-'], stdin=name_sort.stdout, stdout=subprocess.PIPE)
+        name_sort.stdout.close()
+        split = subprocess.Popen(['awk', '-F', '\t', '-v', 'dir=' + scratch, '-v', 'header=' + header,
+                                  '-v', 'samtools=' + samtools, '-v', "q='", _SPLIT_BY_CONTIG, header, '-'],
+                                 stdin=view.stdout)
+        view.stdout.close()
+        _wait_all(bam, [('tee', tee), ('samtools sort', coord_sort), ('samtools sort -n', name_sort),
+                        ('samtools view', view), ('awk', split)])
+        # Name sorted copy, one contig at a time in header order
+        parts = [x for x in (os.path.join(scratch, '{}.bam'.format(i)) for i in xrange(len(contigs(header))))
+                 if os.path.exists(x)]
+        if parts:
+            subprocess.check_call([samtools, 'cat', '-h', header, '-o', name_sorted_bam] + parts)
+        else:
+            subprocess.check_call([samtools, 'view', '-Sb', '-o', name_sorted_bam, header])
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def _wait_all(bam, processes, interval=1):
+    """
+    Waits for every process of a pipeline. If one fails, the others are killed, as they may be blocked on it.
+
+    :param list[tuple(str, subprocess.Popen)] processes: Processes by name
+    """
+    failed = []
+    while not failed and any(process.poll() is None for _, process in processes):
+        time.sleep(interval)
+        failed = [name for name, process in processes if process.poll() not in (None, 0)]
+    for _, process in processes:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+    failed = failed or [name for name, process in processes if process.returncode != 0]
+    if failed:
+        raise RuntimeError('{} returned a non-zero exit status while sorting {}'.format(failed[0], bam))
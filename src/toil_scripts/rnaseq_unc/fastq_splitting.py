@@ -0,0 +1,66 @@
+#!/usr/bin/env python2.7
+"""
+Splitting FASTQs into chunks of reads for scatter-gather alignment.
+
+split_fastq() cuts a stream of reads into blocks of consecutive reads with split, whose filter appends every block to
+a chunk, dealing the blocks out round-robin. Every chunk thus receives about the same number of reads without the
+reads being counted first, and the reads are copied by split and cat instead of line by line in Python. Splitting
+R1 and R2 with the same block size keeps the chunks synchronized: read N of a chunk's R1 is the mate of read N of
+its R2 as long as both files have the same number of lines, which count_lines() verifies.
+"""
+import errno
+import os
+import pipes
+import shutil
+import subprocess
+
+# Blocks are numbered from a suffix with a fixed number of digits, starting at the smallest number without a
+# leading zero, which sh would read as octal
+_SUFFIX_LENGTH = 7
+_FIRST_BLOCK = 10 ** (_SUFFIX_LENGTH - 1)
+
+
+def split_fastq(f_in, work_dir, name, num_chunks, reads_per_block=1000000):
+    """
+    Splits the reads of a FASTQ into num_chunks chunks, written to chunk<i>.<name> in work_dir.
+
+    :param file f_in: FASTQ to split, read to its end, e.g. a FileStore stream
+    :param str work_dir: Directory to write the chunks to
+    :param str name: Name of the FASTQ, e.g. R1.fastq
+    :param int num_chunks: Number of chunks
+    :param int reads_per_block: Number of consecutive reads written to a chunk before moving on to the next
+    :return: Paths of the chunks, in order. Chunks that received no reads do not exist.
+    :rtype: list[str]
+    """
+    chunk = os.path.join(work_dir, 'chunk')
+    # $FILE is the name of the block, ending in its number
+    command = 'cat >> {}$(( (${{FILE##*.}} - {}) % {} )){}'.format(pipes.quote(chunk), _FIRST_BLOCK, num_chunks,
+                                                                 pipes.quote('.' + name))
+    p = subprocess.Popen(['split', '-l', str(4 * reads_per_block),
+                          '-a', str(_SUFFIX_LENGTH), '--numeric-suffixes={}'.format(_FIRST_BLOCK),
+                          '--filter', command, '-', os.path.join(work_dir, 'block.')],
+                         stdin=subprocess.PIPE, env=dict(os.environ, SHELL='/bin/sh'))
+    try:
+        shutil.copyfileobj(f_in, p.stdin, 16 * 1024 * 1024)
+    except IOError as e:
+        # If split exited early, its exit status tells why
+        if e.errno != errno.EPIPE:
+            p.kill()
+            raise
+    finally:
+        p.stdin.close()
+    if p.wait() != 0:
+        raise RuntimeError('Splitting {} into chunks failed with exit status {}'.format(name, p.returncode))
+    return [os.path.join(work_dir, 'chunk{}.{}'.format(i, name)) for i in xrange(num_chunks)]
+
+
+def count_lines(path):
+    """
+    Returns the number of lines of a file, or 0 if it does not exist
+
+    :param str path: Path of the file
+    :rtype: int
+    """
+    if not os.path.exists(path):
+        return 0
+    return int(subprocess.check_output(['wc', '-l', path]).split()[0])
@@ -0,0 +1,251 @@
+#!/usr/bin/env python2.7
+"""
+Parallel, resumable HTTP downloads using range requests.
+
+Sample tarballs for the UNC pipeline are tens of gigabytes. Fetching them as a single stream means a dropped
+connection restarts the transfer from byte zero. ranged_download() instead splits the object into parts, fetches
+them concurrently with HTTP range requests and writes each part in place into a preallocated file. Completed parts
+are recorded in a checkpoint file, so a retry only fetches what is still missing.
+
+By default the partial download and its checkpoint are kept at the destination, so parts are only resumed within one
+call; a Toil job's work directory does not survive a failed attempt. Given a cache_dir, such as a node-local
+directory, the partial download is kept there under a name derived from the URL, so a later attempt of the job on
+the same node resumes it. It is moved to the destination once complete.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import shutil
+import urllib2
+from Queue import Queue, Empty
+
+from toil_scripts.node_cache import cache_key, node_lock
+
+log = logging.getLogger(__name__)
+
+_content_range_re = re.compile(r'bytes (\d+)-(\d+)/(\d+)')
+_md5_etag_re = re.compile(r'^[0-9a-f]{32}$')
+
+
+def ranged_download(url, file_path, headers=None, num_threads=8, part_size=64 * 1024 * 1024, retries=5, md5=None,
+                    cache_dir=None):
+    """
+    Downloads a URL to a local file using concurrent HTTP range requests.
+
+    :param str url: http:// or https:// URL to download
+    :param str file_path: Local destination of the download
+    :param dict headers: Extra request headers sent with every request (e.g. SSE-C headers)
+    :param int num_threads: Number of parts fetched concurrently
+    :param int part_size: Size of each range request in bytes
+    :param int retries: Number of times a part is retried, resuming from the last byte received
+    :param str md5: Optional hex MD5 of the object. S3 ETags are used if no MD5 is given and they are plain MD5s.
+    :param str cache_dir: Directory that keeps the partial download between attempts, e.g. a node-local directory.
+        If None, parts are only resumed within this call.
+    :return: Path to the downloaded file
+    :rtype: str
+    """
+    if cache_dir is None:
+        return _ranged_download(url, file_path, file_path, headers, num_threads, part_size, retries, md5)
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    partial = os.path.join(cache_dir, cache_key(url))
+    # Jobs on the same node that download the same URL take turns
+    with node_lock(partial + '.lock'):
+        _ranged_download(url, partial, file_path, headers, num_threads, part_size, retries, md5)
+        shutil.move(partial, file_path)
+    return file_path
+
+
+def _ranged_download(url, file_path, name, headers, num_threads, part_size, retries, md5):
+    """
+    Downloads url to file_path, keeping the checkpoint next to it. name is the download's path in log messages.
+    """
+    headers = dict(headers or {})
+    length, etag, ranged = _probe(url, headers)
+    if not ranged:
+        log.info('%s does not support range requests, downloading as a single stream.', url)
+        _fetch(url, headers, file_path, 0, None if length is None else length - 1, retries, ranged=False)
+        _verify(file_path, length, md5)
+        return file_path
+    if length == 0:
+        open(file_path, 'wb').close()
+        _verify(file_path, length, md5)
+        return file_path
+
+    checkpoint = _Checkpoint(file_path + '.parts', length, etag)
+    if not checkpoint.done or not os.path.exists(file_path):
+        checkpoint.reset()
+        with open(file_path, 'wb') as f:
+            f.truncate(length)
+    parts = [(start, min(start + part_size, length) - 1)
+             for start in xrange(0, length, part_size) if start not in checkpoint.done]
+    log.info('Downloading %s to %s: %d of %d parts remaining.', url, name, len(parts),
+             (length + part_size - 1) // part_size)
+
+    queue = Queue()
+    for part in parts:
+        queue.put(part)
+    errors = []
+
+    def worker():
+        while not errors:
+            try:
+                start, end = queue.get_nowait()
+            except Empty:
+                return
+            try:
+                _fetch(url, headers, file_path, start, end, retries)
+                checkpoint.add(start)
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in xrange(min(num_threads, len(parts)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise RuntimeError('Failed to download {}: {}'.format(url, errors[0]))
+
+    if md5 is None and 'x-amz-server-side-encryption-customer-key' not in headers:
+        md5 = etag if etag and _md5_etag_re.match(etag) else None
+    _verify(file_path, length, md5)
+    checkpoint.remove()
+    return file_path
+
+
+def _probe(url, headers):
+    """
+    Returns the length and ETag of the object at url, and whether the server honours range requests. The length is
+    None if a server without range support does not send it.
+    """
+    request = urllib2.Request(url, headers=dict(headers, Range='bytes=0-0'))
+    try:
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError as e:
+        # The first byte of an empty object is not satisfiable
+        if e.code == 416:
+            match = re.match(r'bytes \*/(\d+)', e.info().getheader('Content-Range') or '')
+            if match is None or match.group(1) == '0':
+                return 0, None, True
+        raise
+    try:
+        info = response.info()
+        etag = (info.getheader('ETag') or '').strip('"') or None
+        # Only S3 ETags of unencrypted or SSE-S3 objects are MD5 digests of the content
+        if info.getheader('x-amz-request-id') is None or info.getheader('x-amz-server-side-encryption') == 'aws:kms':
+            etag = None
+        if response.getcode() == 206:
+            match = _content_range_re.match(info.getheader('Content-Range') or '')
+            if not match:
+                raise RuntimeError('Unexpected Content-Range from {}: {}'.format(url, info.getheader('Content-Range')))
+            return int(match.group(3)), etag, True
+        length = info.getheader('Content-Length')
+        return None if length is None else int(length), etag, False
+    finally:
+        response.close()
+
+
+def _fetch(url, headers, file_path, start, end, retries, ranged=True, chunk_size=1024 * 1024):
+    """
+    Writes bytes start..end (inclusive) of url into file_path at the same offset, resuming after failures. Without
+    range requests, end may be None to read until the server closes the connection.
+    """
+    offset = start
+    attempt = 0
+    with open(file_path, 'r+b' if ranged else 'wb') as f:
+        while end is None or offset <= end:
+            try:
+                request_headers = dict(headers)
+                if ranged:
+                    request_headers['Range'] = 'bytes={}-{}'.format(offset, end)
+                elif offset != start:
+                    # Without range support the transfer has to start over
+                    f.seek(0)
+                    f.truncate()
+                    offset = start
+                response = urllib2.urlopen(urllib2.Request(url, headers=request_headers))
+                try:
+                    if ranged and response.getcode() != 206:
+                        raise RuntimeError('Server ignored range request for bytes {}-{}'.format(offset, end))
+                    f.seek(offset)
+                    while end is None or offset <= end:
+                        data = response.read(chunk_size if end is None else min(chunk_size, end - offset + 1))
+                        if not data:
+                            if end is None:
+                                return
+                            raise IOError('Connection closed at byte {} of range {}-{}'.format(offset, start, end))
+                        f.write(data)
+                        offset += len(data)
+                finally:
+                    response.close()
+            except (IOError, urllib2.URLError) as e:
+                attempt += 1
+                if attempt > retries:
+                    raise
+                log.warn('Retrying bytes %d-%d of %s (attempt %d): %s', offset, end, url, attempt, e)
+                time.sleep(min(2 ** attempt, 30))
+
+
+def _verify(file_path, length, md5):
+    """
+    Checks the length, if known, and the MD5, if known, of a finished download
+    """
+    size = os.path.getsize(file_path)
+    if length is not None and size != length:
+        raise RuntimeError('Downloaded {} has {} bytes, expected {}'.format(file_path, size, length))
+    if md5:
+        digest = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), ''):
+                digest.update(chunk)
+        if digest.hexdigest() != md5:
+            raise RuntimeError('Checksum mismatch for {}: {} != {}'.format(file_path, digest.hexdigest(), md5))
+
+
+class _Checkpoint(object):
+    """
+    Records the start offsets of completed parts, so an interrupted download can resume.
+    """
+
+    def __init__(self, path, length, etag):
+        self.path = path
+        self.length = length
+        self.etag = etag
+        self.done = set()
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            # A changed object invalidates every part downloaded so far
+            if state.get('length') == length and state.get('etag') == etag:
+                self.done = set(state['done'])
+
+    def add(self, start):
+        with self.lock:
+            self.done.add(start)
+            self._save()
+
+    def reset(self):
+        with self.lock:
+            self.done = set()
+            self._save()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'length': self.length, 'etag': self.etag, 'done': sorted(self.done)}, f)
+        os.rename(tmp, self.path)
@@ -29,20 +29,25 @@ Tree Structure of RNA-Seq Pipeline (per sample)
 0 = Start Node
 1 = Download Sample
 2 = Unzip
-3 = Mapsplice
+3 = Mapsplice (with --mapsplice_chunks: Split Fastqs -> Mapsplice per chunk -> Merge Alignments)
+    With --stream_fastqs, 2 is skipped and Mapsplice reads the fastqs of sample.tar through named pipes
 4 = Mapping Stats (not currently included)
 5 = Add Read Groups
 6 = Bamsort and Index
 7 = Rseq-QC
-8 = Sort Bam by Reference
+8 = Sort Bam by Reference (with --dual_sort, 6 and 8 run as one job)
 9 = Exon Quantification
 10 = Transcriptome
-11 = Filter
+11 = Filter (with --fuse_transcriptome_filter, 10 and 11 run as one job)
 12 = RSEM
 13 = RSEM Post-Process
 
 7,9,13 contribute to producing the final output
 
+With several --tool_profiles, the tree branches at 3 (MapSplice), 10 (UBU) and 12 (RSEM) into one subtree per
+distinct image of that tool, so stages upstream of the first differing tool run once. Consolidate Output then
+writes one tarball per profile.
+
 Dependencies
 Curl:       apt-get install curl
 Docker:     apt-get install docker.io # docker.io if using linux, o.w. just docker
@@ -63,14 +68,33 @@ import os
 import shutil
 import subprocess
 import tarfile
+import time
 from collections import OrderedDict
-from contextlib import closing
 from urlparse import urlparse
 
 from toil.job import Job
 
-
-def build_parser():
+from toil_scripts.admission import budgeted_map_job, disk_budget
+from toil_scripts.consolidation import consolidate_tarballs
+from toil_scripts.named_pipes import FifoFeed, decompress_command
+from toil_scripts.node_cache import cache_key, extract_once, unzip
+from toil_scripts.rnaseq_unc.bam_sorting import dual_sort
+from toil_scripts.rnaseq_unc.fastq_splitting import count_lines, split_fastq
+from toil_scripts.rnaseq_unc.ranged_download import ranged_download
+from toil_scripts.rnaseq_unc.s3_upload import S3Uploader, s3_connection_factory
+
+# Docker images of the tools whose versions differ between pipeline variants
+TOOL_PROFILES = {
+    'current': {'mapsplice': 'quay.io/ucsc_cgl/mapsplice:2.1.8--dd5ac549b95eb3e5d166a5e310417ef13651994e',
+                'ubu': 'quay.io/ucsc_cgl/ubu:1.2--02806964cdf74bf5c39411b236b4c4e36d026843',
+                'rsem': 'quay.io/ucsc_cgl/rsem:1.2.25--4e8d1b31d4028f464b3409c6558fb9dfcad73f88'},
+    # Versions used by TCGA
+    'tcga': {'mapsplice': 'quay.io/ucsc_cgl/mapsplice:2.0.1.9--2296da365ead6b12ded9d9c7b7798fbc927cd66b',
+             'ubu': 'quay.io/ucsc_cgl/ubu:1.0--ce6807e937a7a29138f56ea1b8fc077528ee8180',
+             'rsem': 'quay.io/ucsc_cgl/rsem:1.1.13--be66304ff7fcd6fb0babcd1884ed289eabedc655'}}
+
+
+def build_parser(default_profiles='current'):
     parser = argparse.ArgumentParser(description=main.__doc__, add_help=True)
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--config', default=None, help='Path to config. One sample per line, with the format: '
@@ -106,6 +130,48 @@ def build_parser():
     parser.add_argument('--sudo', dest='sudo', action='store_true', default=False,
                         help='Docker usually needs sudo to execute locally, but not when running Mesos or when '
                              'the user is a member of a Docker group.')
+    parser.add_argument('--ref_cache_dir', default=None,
+                        help='Node-local directory where the ebwt, chromosomes, and rsem_ref archives are unpacked '
+                             'once per node and mounted read-only into every job. Archives unused for a week are '
+                             'evicted. If unset, each job unpacks a private copy into its work directory.')
+    parser.add_argument('--download_cache_dir', default=None,
+                        help='Node-local directory where partial downloads of encrypted samples are kept, so that a '
+                             'retried job on the same node resumes them. If unset, a download is only resumed '
+                             'within one attempt of the job.')
+    parser.add_argument('--mapsplice_chunks', default=1, type=int,
+                        help='Split the reads of each sample into this many chunks of read pairs and align every '
+                             'chunk with MapSplice as an independent job. The chunk alignments are merged before '
+                             'read groups are added.')
+    parser.add_argument('--stream_fastqs', default=False, action='store_true',
+                        help='Decompress the fastq.gz files of sample.tar inside the MapSplice job, feeding MapSplice '
+                             'through named pipes, instead of storing uncompressed R1/R2.fastq files in between. '
+                             'Cannot be combined with --mapsplice_chunks.')
+    parser.add_argument('--fuse_transcriptome_filter', default=False, action='store_true',
+                        help='Run the transcriptome translation (sam-xlate) and filtering (sam-filter) steps as '
+                             'one job, streaming between them, instead of two separate 30G jobs.')
+    parser.add_argument('--dual_sort', default=False, action='store_true',
+                        help='Produce the coordinate-sorted and the per-chromosome name-sorted bams in one job from '
+                             'a single read of the alignments, instead of sorting one from the other.')
+    parser.add_argument('--qc_sample_reads', default=None, type=int,
+                        help='Run RSeQC on a random subsample of about this many mapped reads, drawn evenly from '
+                             'every chromosome, instead of the whole bam. The fraction used is recorded in '
+                             'rseq_qc/subsample.txt.')
+    parser.add_argument('--qc_seed', default=42, type=int, help='Seed of the --qc_sample_reads subsample.')
+    parser.add_argument('--tool_profiles', default=default_profiles,
+                        help='Comma-separated tool version profiles to run, out of: {}. Stages before the first tool '
+                             'whose image differs between profiles run once per sample. One output tarball, '
+                             'UUID.PROFILE.tar.gz, is written per profile if there are several.'.format(
+                                 ', '.join(sorted(TOOL_PROFILES))))
+    parser.add_argument('--s3_endpoint', default=None,
+                        help='URL of an S3-compatible service to upload to instead of AWS, e.g. http://localhost:9000')
+    parser.add_argument('--output_ssec', default=None,
+                        help='Path to a master key used to encrypt uploads to --s3_dir with SSE-C. Each object is '
+                             'encrypted with a key derived from the master key and its s3:// URL.')
+    parser.add_argument('--disk_budget', default=None,
+                        help='Total scratch space that samples in flight may use together, e.g. 2T. Samples are then '
+                             'started, largest first, as earlier ones finish. By default all samples start at once.')
+    parser.add_argument('--max_concurrent_samples', default=None, type=int,
+                        help='Maximum number of samples in flight at once.')
     return parser
 
 
@@ -174,9 +240,20 @@ def generate_unique_key(master_key_path, url):
     return new_key
 
 
+def sse_c_headers(key):
+    """
+    key: str        32-byte SSE-C key
+
+    Returns: dict   Headers that encrypt or decrypt an S3 object with the key
+    """
+    return {'x-amz-server-side-encryption-customer-algorithm': 'AES256',
+            'x-amz-server-side-encryption-customer-key': base64.b64encode(key),
+            'x-amz-server-side-encryption-customer-key-md5': base64.b64encode(hashlib.md5(key).digest())}
+
+
 def download_encrypted_file(job, input_args, name):
     """
-    Downloads encrypted files from S3 via header injection
+    Downloads encrypted files from S3 via header injection, using parallel range requests that resume on failure
 
     input_args: dict    Input dictionary defined in main()
     name: str           Symbolic name associated with file
@@ -193,22 +270,24 @@ def download_encrypted_file(job, input_args, name):
 
     key = generate_unique_key(key_path, url)
 
-    encoded_key = base64.b64encode(key)
-    encoded_key_md5 = base64.b64encode(hashlib.md5(key).digest())
-    h1 = 'x-amz-server-side-encryption-customer-algorithm:AES256'
-    h2 = 'x-amz-server-side-encryption-customer-key:{}'.format(encoded_key)
-    h3 = 'x-amz-server-side-encryption-customer-key-md5:{}'.format(encoded_key_md5)
-    try:
-        subprocess.check_call(['curl', '-fs', '--retry', '5', '-H', h1, '-H', h2, '-H', h3, url, '-o', file_path])
-    except OSError:
-        raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
+    headers = sse_c_headers(key)
+    if urlparse(url).scheme in ('http', 'https'):
+        ranged_download(url, file_path, headers=headers, cache_dir=input_args.get('download_cache_dir'))
+    else:
+        curl = ['curl', '-fs', '--retry', '5']
+        for header in sorted(headers.iteritems()):
+            curl.extend(['-H', '{}:{}'.format(*header)])
+        try:
+            subprocess.check_call(curl + [url, '-o', file_path])
+        except OSError:
+            raise RuntimeError('Failed to find "curl". Install via "apt-get install curl"')
     assert os.path.exists(file_path)
     return job.fileStore.writeGlobalFile(file_path)
 
 
 def download_from_url(job, url):
     """
-    Simple curl request made for a given url
+    Downloads a given url. HTTP(S) URLs are fetched with parallel range requests that resume on failure.
 
     url: str    URL to download
     """
@@ -217,6 +296,8 @@ def download_from_url(job, url):
     if not os.path.exists(file_path):
         if url.startswith('s3:'):
             download_from_s3_url(file_path, url)
+        elif urlparse(url).scheme in ('http', 'https'):
+            ranged_download(url, file_path)
         else:
             try:
                 subprocess.check_call(['curl', '-fs', '--retry', '5', '--create-dir', url, '-o', file_path])
@@ -247,6 +328,16 @@ def return_input_paths(job, work_dir, ids, *args):
     return paths.values()
 
 
+def delete_global_files(job, file_ids):
+    """
+    Deletes files from the FileStore, e.g. inputs shared by several branches once all of them are done
+
+    file_ids: list      FileStoreIDs to delete
+    """
+    for file_id in file_ids:
+        job.fileStore.deleteGlobalFile(file_id)
+
+
 def docker_path(filepath):
     """
     Given a path, returns that files path inside the docker mount directory (/data).
@@ -254,22 +345,38 @@ def docker_path(filepath):
     return os.path.join('/data', os.path.basename(filepath))
 
 
-def docker_call(work_dir, tool_parameters, tool, java_opts=None, outfile=None, sudo=False):
+def docker_command(work_dir, java_opts=None, sudo=False, mounts=None):
     """
-    Makes subprocess call of a command to a docker container.
-
+    Returns the "docker run" command, up to the tool name, shared by every docker call in the pipeline.
 
-    tool_parameters: list   An array of the parameters to be passed to the tool
-    tool: str               Name of the Docker image to be used (e.g. quay.io/ucsc_cgl/samtools)
+    work_dir: str           Directory mounted as /data in the container
     java_opts: str          Optional commands to pass to a java jar execution. (e.g. '-Xmx15G')
-    outfile: file           Filehandle that stderr will be passed to
     sudo: bool              If the user wants the docker command executed as sudo
+    mounts: dict            Optional host directories to mount read-only, keyed by their path inside the container
     """
     base_docker_call = 'docker run --log-driver=none --rm -v {}:/data'.format(work_dir).split()
+    for container_path, host_path in sorted((mounts or {}).iteritems()):
+        base_docker_call.extend(['-v', '{}:{}:ro'.format(host_path, container_path)])
     if sudo:
         base_docker_call = ['sudo'] + base_docker_call
     if java_opts:
         base_docker_call = base_docker_call + ['-e', 'JAVA_OPTS={}'.format(java_opts)]
+    return base_docker_call
+
+
+def docker_call(work_dir, tool_parameters, tool, java_opts=None, outfile=None, sudo=False, mounts=None):
+    """
+    Makes subprocess call of a command to a docker container.
+
+
+    tool_parameters: list   An array of the parameters to be passed to the tool
+    tool: str               Name of the Docker image to be used (e.g. quay.io/ucsc_cgl/samtools)
+    java_opts: str          Optional commands to pass to a java jar execution. (e.g. '-Xmx15G')
+    outfile: file           Filehandle that stderr will be passed to
+    sudo: bool              If the user wants the docker command executed as sudo
+    mounts: dict            Optional host directories to mount read-only, keyed by their path inside the container
+    """
+    base_docker_call = docker_command(work_dir, java_opts, sudo, mounts)
     try:
         if outfile:
             subprocess.check_call(base_docker_call + [tool] + tool_parameters, stdout=outfile)
@@ -330,6 +437,85 @@ def download_from_s3_url(file_path, url):
         s3.close()
 
 
+def shared_reference(job, work_dir, input_args, ids, name):
+    """
+    Returns the directory holding the unzipped contents of a shared reference archive.
+
+    If a reference cache directory was given, the archive is unzipped once per node (keyed by its FileStoreID) and
+    the cached directory is returned for mounting. Otherwise the archive is unzipped into work_dir as before.
+
+    work_dir: str       Current working directory
+    input_args: dict    Dictionary of input arguments
+    ids: dict           Dictionary of fileStore IDs
+    name: str           Symbolic name of the archive (e.g. 'ebwt.zip')
+    """
+    if not input_args.get('ref_cache_dir'):
+        archive = return_input_paths(job, work_dir, ids, name)
+        unzip(archive, work_dir)
+        os.remove(archive)
+        return work_dir
+
+    def fetch(scratch_dir):
+        return job.fileStore.readGlobalFile(ids[name], os.path.join(scratch_dir, name))
+
+    return extract_once(input_args['ref_cache_dir'], cache_key(name, ids[name]), fetch, unzip)
+
+
+def branch_profiles(input_args, tool):
+    """
+    Groups the tool profiles of a branch by the image they use for tool, returning input_args for every group.
+
+    input_args: dict    Dictionary of input arguments
+    tool: str           Tool at which profiles may diverge (a key of TOOL_PROFILES' entries)
+    """
+    groups = OrderedDict()
+    for profile in input_args['profiles']:
+        groups.setdefault(TOOL_PROFILES[profile][tool], []).append(profile)
+    branches = []
+    for profiles in groups.values():
+        branch_args = dict(input_args)
+        branch_args['profiles'] = profiles
+        # Inputs are read by every branch, so no single branch may delete them; the job fanning out does
+        branch_args['shared_inputs'] = input_args.get('shared_inputs') or len(groups) > 1
+        branches.append(branch_args)
+    return branches
+
+
+def tool_image(input_args, tool):
+    """
+    Returns the docker image of tool for the profiles of a branch, which all use the same image of it.
+
+    input_args: dict    Dictionary of input arguments
+    tool: str           Name of the tool (e.g. 'rsem')
+    """
+    return TOOL_PROFILES[input_args['profiles'][0]][tool]
+
+
+def profile_outputs(output_ids, profile):
+    """
+    Picks the outputs of one profile from output IDs that branch into dictionaries keyed by profile
+
+    output_ids: tuple   Nested tuple of output fileStore IDs and dictionaries of them, keyed by profile
+    profile: str        Tool profile
+    """
+    if isinstance(output_ids, dict):
+        return profile_outputs(output_ids[profile], profile)
+    if isinstance(output_ids, (list, tuple)):
+        return [profile_outputs(x, profile) for x in output_ids]
+    return output_ids
+
+
+def profile_suffix(input_args):
+    """
+    Returns the suffix that distinguishes a branch's outputs when several tool profiles are run
+
+    input_args: dict    Dictionary of input arguments
+    """
+    if len(input_args['tool_profiles']) == 1:
+        return ''
+    return '.' + '+'.join(input_args['profiles'])
+
+
 # Job Functions
 def program_checks(job, input_args):
     """
@@ -360,7 +546,7 @@ def download_shared_files(job, input_args):
         sample_path = input_args['input']
         uuid = os.path.splitext(os.path.basename(sample_path))[0]
         sample = (uuid, sample_path)
-        job.addFollowOnJobFn(download_sample, shared_ids, input_args, sample)
+        job.addFollowOnJobFn(download_sample, sample, shared_ids, input_args)
 
 
 def parse_config_file(job, ids, input_args):
@@ -377,17 +563,27 @@ def parse_config_file(job, ids, input_args):
             if not line.isspace():
                 sample = line.strip().split(',')
                 samples.append(sample)
-    for sample in samples:
-        job.addChildJobFn(download_sample, ids, input_args, sample)
+    # Samples are started as many at a time as the disk budget allows (all at once if there is none)
+    budget = disk_budget(input_args['disk_budget'], expansion=6.0, max_concurrent=input_args['max_concurrent_samples'])
+    job.addChildJobFn(budgeted_map_job, download_sample, samples, budget, sample_urls, ids, input_args)
 
 
-def download_sample(job, ids, input_args, sample):
+def sample_urls(sample):
+    """
+    Returns the input URLs of a sample
+
+    sample: list        Contains uuid and sample_url, or uuid and the URLs of both fastqs
+    """
+    return sample[1:]
+
+
+def download_sample(job, sample, ids, input_args):
     """
     Defines variables unique to a sample that are used in the rest of the pipelines
 
+    sample: tuple       Contains uuid and sample_url
     ids: dict           Dictionary of fileStore IDS
     input_args: dict    Dictionary of input arguments
-    sample: tuple       Contains uuid and sample_url
     """
     if len(sample) == 2:
         uuid, sample_location = sample
@@ -425,8 +621,10 @@ def static_dag_launchpoint(job, job_vars):
     """
     input_args, ids = job_vars
     if input_args['config_fastq']:
-        cores = input_args['cpu_count']
-        a = job.wrapJobFn(mapsplice, job_vars, cores=cores, disk='130G').encapsulate()
+        a = job.wrapJobFn(align_reads, job_vars, '130G').encapsulate()
+    elif input_args['stream_fastqs']:
+        # Reads are decompressed into named pipes by the mapsplice job itself, so merge_fastqs is skipped
+        a = job.wrapJobFn(align_reads, job_vars, '80G').encapsulate()
     else:
         a = job.wrapJobFn(merge_fastqs, job_vars, disk='70 G').encapsulate()
     b = job.wrapJobFn(consolidate_output, job_vars, a.rv())
@@ -473,49 +671,187 @@ def merge_fastqs(job, job_vars):
         ids['R2.fastq'] = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'R2.fastq'))
     job.fileStore.deleteGlobalFile(ids['sample.tar'])
     # Spawn child job
-    return job.addChildJobFn(mapsplice, job_vars, cores=cores, disk='130 G').rv()
+    return align_reads(job, job_vars, '130 G')
 
 
-def mapsplice(job, job_vars):
+def align_reads(job, job_vars, disk):
     """
-    Maps RNA-Seq reads to a reference genome.
+    Spawns alignment of the sample's reads, once for every distinct MapSplice image among the tool profiles
 
     job_vars: tuple     Tuple of dictionaries: input_args and ids
+    disk: str           Disk requirement of a MapSplice job that aligns all of the reads
+
+    Returns: dict       Promised output IDs of the rest of the pipeline, keyed by profile
+    """
+    input_args, ids = job_vars
+    cores = input_args['cpu_count']
+    if input_args['mapsplice_chunks'] > 1:
+        # Only the chunks land on disk, which are no larger than the merged reads merge_fastqs fits into 70G
+        return job.addChildJobFn(split_fastqs, job_vars, disk='70 G').rv()
+    output_ids = {}
+    branches = branch_profiles(input_args, 'mapsplice')
+    for branch_args in branches:
+        branch_ids = job.addChildJobFn(mapsplice, (branch_args, ids), cores=cores, disk=disk).rv()
+        output_ids.update((profile, branch_ids) for profile in branch_args['profiles'])
+    if len(branches) > 1:
+        # No branch deletes the reads they share, so they are deleted once every branch is done
+        job.addFollowOnJobFn(delete_global_files, [ids[x] for x in mapsplice_inputs(input_args)])
+    return output_ids
+
+
+def split_fastqs(job, job_vars, reads_per_block=1000000):
+    """
+    Splits R1.fastq (and R2.fastq) into synchronized chunks of reads and aligns each chunk in its own job.
+
+    The reads are streamed from the FileStore into split (see fastq_splitting), so only the chunks are written to
+    disk. Blocks of reads are dealt out to the chunks round-robin, so every chunk receives about the same number of
+    reads without counting them first, and read N of a chunk's R1 is always the mate of read N of its R2.
+
+    job_vars: tuple         Tuple of dictionaries: input_args and ids
+    reads_per_block: int    Number of consecutive reads written to a chunk before moving on to the next
     """
-    # Unpack variables
     input_args, ids = job_vars
     work_dir = job.fileStore.getLocalTempDir()
     cores = input_args['cpu_count']
+    num_chunks = input_args['mapsplice_chunks']
+    reads = ['R1.fastq'] if input_args['single_end_reads'] else ['R1.fastq', 'R2.fastq']
+    # I/O
+    chunk_paths = []
+    for name in reads:
+        with job.fileStore.readGlobalFileStream(ids[name]) as f_in:
+            chunk_paths.append(split_fastq(f_in, work_dir, name, num_chunks, reads_per_block))
+    chunk_paths = zip(*chunk_paths)
+    for paths in chunk_paths:
+        if len(set(count_lines(x) for x in paths)) > 1:
+            raise RuntimeError('{} do not contain the same number of reads'.format(' and '.join(reads)))
+    for name in reads:
+        job.fileStore.deleteGlobalFile(ids[name])
+    chunk_ids = []
+    for paths in chunk_paths:
+        if not os.path.exists(paths[0]):
+            continue
+        chunk_ids.append(dict(ids))
+        for name, path in zip(reads, paths):
+            chunk_ids[-1][name] = job.fileStore.writeGlobalFile(path)
+    # Align each chunk, once for every distinct MapSplice image
+    chunk_disk = '{}G'.format(max(130 // num_chunks, 20))
+    output_ids = {}
+    branches = branch_profiles(input_args, 'mapsplice')
+    for branch_args in branches:
+        bam_ids = [job.addChildJobFn(mapsplice_chunk, (branch_args, x), cores=cores, disk=chunk_disk).rv()
+                   for x in chunk_ids]
+        branch_ids = job.addFollowOnJobFn(merge_alignments, (branch_args, ids), bam_ids, disk='60 G').rv()
+        output_ids.update((profile, branch_ids) for profile in branch_args['profiles'])
+    if len(branches) > 1:
+        # Follow-ons start once every chunk of every branch has been aligned
+        job.addFollowOnJobFn(delete_global_files, [x[name] for x in chunk_ids for name in reads])
+    return output_ids
+
+
+def run_mapsplice(job, work_dir, input_args, ids):
+    """
+    Runs MapSplice on the R1.fastq (and R2.fastq) in ids, producing alignments.bam and stats.txt in work_dir
+
+    work_dir: str       Current working directory
+    input_args: dict    Dictionary of input arguments
+    ids: dict           Dictionary of fileStore IDs
+    """
+    cores = input_args['cpu_count']
     sudo = input_args['sudo']
     single_end_reads = input_args['single_end_reads']
-    files_to_delete = ['R1.fastq']
     # I/O
-    return_input_paths(job, work_dir, ids, 'ebwt.zip', 'chromosomes.zip')
-    if single_end_reads:
+    feeds = []
+    if streams_fastqs(input_args):
+        feeds = stream_sample_fastqs(job, work_dir, input_args, ids)
+    elif single_end_reads:
         return_input_paths(job, work_dir, ids, 'R1.fastq')
     else:
         return_input_paths(job, work_dir, ids, 'R1.fastq', 'R2.fastq')
-        files_to_delete.extend(['R2.fastq'])
-    for fname in ['chromosomes.zip', 'ebwt.zip']:
-        subprocess.check_call(['unzip', '-o', os.path.join(work_dir, fname), '-d', work_dir])
+    ebwt_dir = shared_reference(job, work_dir, input_args, ids, 'ebwt.zip')
+    chromosomes_dir = shared_reference(job, work_dir, input_args, ids, 'chromosomes.zip')
+    mounts = {'/refs/ebwt': ebwt_dir, '/refs/chromosomes': chromosomes_dir}
     # Command and call
     parameters = ['-p', str(cores),
                   '-s', '25',
                   '--bam',
                   '--min-map-len', '50',
-                  '-x', '/data/ebwt',
-                  '-c', '/data/chromosomes',
+                  '-x', '/refs/ebwt/ebwt',
+                  '-c', '/refs/chromosomes/chromosomes',
                   '-1', '/data/R1.fastq',
                   '-o', '/data']
     if not single_end_reads:
         parameters.extend(['-2', '/data/R2.fastq'])
-    docker_call(tool='quay.io/ucsc_cgl/mapsplice:2.1.8--dd5ac549b95eb3e5d166a5e310417ef13651994e',
-                tool_parameters=parameters, work_dir=work_dir, sudo=sudo)
+    try:
+        docker_call(tool=tool_image(input_args, 'mapsplice'),
+                    tool_parameters=parameters, work_dir=work_dir, sudo=sudo, mounts=mounts)
+        for feed in feeds:
+            feed.wait()
+    finally:
+        for feed in feeds:
+            feed.close()
+
+
+def streams_fastqs(input_args):
+    """
+    Returns True if the mapsplice job reads sample.tar directly, decompressing its reads into named pipes.
+
+    input_args: dict    Dictionary of input arguments
+    """
+    return input_args['stream_fastqs'] and not input_args['config_fastq']
+
+
+def mapsplice_inputs(input_args):
+    """
+    Returns the names of the FileStore files the mapsplice job reads the sample's reads from
+
+    input_args: dict    Dictionary of input arguments
+    """
+    if streams_fastqs(input_args):
+        return ['sample.tar']
+    return ['R1.fastq'] if input_args['single_end_reads'] else ['R1.fastq', 'R2.fastq']
+
+
+def stream_sample_fastqs(job, work_dir, input_args, ids):
+    """
+    Unpacks sample.tar and creates R1.fastq (and R2.fastq) in work_dir as named pipes fed by zcat, in place of
+    the concatenated files merge_fastqs would have written.
+
+    work_dir: str       Current working directory
+    input_args: dict    Dictionary of input arguments
+    ids: dict           Dictionary of fileStore IDs
+    """
+    sample_dir = os.path.join(work_dir, 'sample')
+    os.mkdir(sample_dir)
+    sample = return_input_paths(job, work_dir, ids, 'sample.tar')
+    subprocess.check_call(['tar', '-xf', sample, '-C', sample_dir])
+    os.remove(sample)
+    if input_args['single_end_reads']:
+        groups = {'R1.fastq': sorted(glob.glob(os.path.join(sample_dir, '*')))}
+    else:
+        groups = {'R1.fastq': sorted(glob.glob(os.path.join(sample_dir, '*R1*'))),
+                  'R2.fastq': sorted(glob.glob(os.path.join(sample_dir, '*R2*')))}
+    for name, files in sorted(groups.iteritems()):
+        assert files, 'No fastq files for {} found in sample.tar'.format(name)
+    return [FifoFeed(decompress_command(files), os.path.join(work_dir, name))
+            for name, files in sorted(groups.iteritems())]
+
+
+def mapsplice(job, job_vars):
+    """
+    Maps RNA-Seq reads to a reference genome.
+
+    job_vars: tuple     Tuple of dictionaries: input_args and ids
+    """
+    # Unpack variables
+    input_args, ids = job_vars
+    work_dir = job.fileStore.getLocalTempDir()
+    run_mapsplice(job, work_dir, input_args, ids)
     # Write to FileStore
     for fname in ['alignments.bam', 'stats.txt']:
         ids[fname] = job.fileStore.writeGlobalFile(os.path.join(work_dir, fname))
-    for fname in files_to_delete:
-        job.fileStore.deleteGlobalFile(ids[fname])
+    if not input_args.get('shared_inputs'):
+        for fname in mapsplice_inputs(input_args):
+            job.fileStore.deleteGlobalFile(ids[fname])
     # Run child job
     # map_id = job.addChildJobFn(mapping_stats, job_vars).rv()
     if input_args['upload_bam_to_s3'] and input_args['s3_dir']:
@@ -524,6 +860,54 @@ def mapsplice(job, job_vars):
     return output_ids
 
 
+def mapsplice_chunk(job, job_vars):
+    """
+    Maps one chunk of a sample's reads to a reference genome.
+
+    job_vars: tuple     Tuple of dictionaries: input_args and ids (with the chunk's R1.fastq and R2.fastq)
+    """
+    input_args, ids = job_vars
+    work_dir = job.fileStore.getLocalTempDir()
+    files_to_delete = ['R1.fastq'] if input_args['single_end_reads'] else ['R1.fastq', 'R2.fastq']
+    run_mapsplice(job, work_dir, input_args, ids)
+    if not input_args.get('shared_inputs'):
+        for fname in files_to_delete:
+            job.fileStore.deleteGlobalFile(ids[fname])
+    return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'alignments.bam'))
+
+
+def merge_alignments(job, job_vars, bam_ids):
+    """
+    Concatenates the alignments of every chunk of a sample into a single alignments.bam
+
+    job_vars: tuple     Tuple of dictionaries: input_args and ids
+    bam_ids: list       FileStoreIDs of the chunk alignments, produced by mapsplice_chunk
+    """
+    input_args, ids = job_vars
+    work_dir = job.fileStore.getLocalTempDir()
+    sudo = input_args['sudo']
+    # I/O
+    bams = []
+    for i, bam_id in enumerate(bam_ids):
+        bams.append(job.fileStore.readGlobalFile(bam_id, os.path.join(work_dir, 'chunk{}.bam'.format(i))))
+    output = os.path.join(work_dir, 'alignments.bam')
+    # Every chunk was aligned against the same reference, so the header of the first chunk describes them all
+    if len(bams) == 1:
+        os.rename(bams[0], output)
+    else:
+        parameters = ['cat', '-o', docker_path(output)] + [docker_path(x) for x in bams]
+        docker_call(tool='quay.io/ucsc_cgl/samtools:0.1.19--dd5ac549b95eb3e5d166a5e310417ef13651994e',
+                    tool_parameters=parameters, work_dir=work_dir, sudo=sudo)
+    # Write to FileStore
+    ids['alignments.bam'] = job.fileStore.writeGlobalFile(output)
+    for bam_id in bam_ids:
+        job.fileStore.deleteGlobalFile(bam_id)
+    # Run child job
+    if input_args['upload_bam_to_s3'] and input_args['s3_dir']:
+        job.addChildJobFn(upload_bam_to_s3, job_vars)
+    return job.addChildJobFn(add_read_groups, job_vars, disk='30 G').rv()
+
+
 def mapping_stats(job, job_vars):
     """
     This function is not currently in use.
@@ -572,6 +956,8 @@ def add_read_groups(job, job_vars):
     # Write to FileStore
     ids['rg_alignments.bam'] = job.fileStore.writeGlobalFile(output)
     # Run child job
+    if input_args['dual_sort']:
+        return job.addChildJobFn(dual_sort_and_index, job_vars, disk='80 G', memory='10 G').rv()
     return job.addChildJobFn(bamsort_and_index, job_vars, disk='30 G').rv()
 
 
@@ -604,6 +990,33 @@ def bamsort_and_index(job, job_vars):
     return rseq_id, output_ids
 
 
+def dual_sort_and_index(job, job_vars):
+    """
+    Produces sorted.bam (with index) and sort_by_ref.bam from a single read of the read-grouped alignments,
+    in place of bamsort_and_index followed by sort_bam_by_reference
+
+    job_vars: tuple     Tuple of dictionaries: input_args and ids
+    """
+    input_args, ids = job_vars
+    work_dir = job.fileStore.getLocalTempDir()
+    # I/O
+    rg_alignments = return_input_paths(job, work_dir, ids, 'rg_alignments.bam')
+    output = os.path.join(work_dir, 'sorted.bam')
+    sort_by_ref = os.path.join(work_dir, 'sort_by_ref.bam')
+    # Call: Samtools
+    dual_sort(rg_alignments, os.path.join(work_dir, 'sorted'), sort_by_ref, work_dir, sort_memory=2000000000)
+    os.remove(rg_alignments)
+    subprocess.check_call(['samtools', 'index', output])
+    # Write to FileStore
+    ids['sorted.bam'] = job.fileStore.writeGlobalFile(output)
+    ids['sorted.bam.bai'] = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'sorted.bam.bai'))
+    ids['sort_by_ref.bam'] = job.fileStore.writeGlobalFile(sort_by_ref)
+    # Run child jobs
+    output_ids = quantify(job, job_vars)
+    rseq_id = job.addChildJobFn(rseq_qc, job_vars, disk='20 G').rv()
+    return rseq_id, output_ids
+
+
 def rseq_qc(job, job_vars):
     """
     QC module: contains QC metrics and information about the BAM post alignment
@@ -615,16 +1028,65 @@ def rseq_qc(job, job_vars):
     uuid = input_args['uuid']
     sudo = input_args['sudo']
     # I/O
-    return_input_paths(job, work_dir, ids, 'sorted.bam', 'sorted.bam.bai')
+    sorted_bam, _ = return_input_paths(job, work_dir, ids, 'sorted.bam', 'sorted.bam.bai')
+    qc_bam = sorted_bam
+    if input_args['qc_sample_reads']:
+        qc_bam = subsample_bam(work_dir, sorted_bam, input_args['qc_sample_reads'], input_args['qc_seed'])
     # Command
-    docker_call(tool='jvivian/qc', tool_parameters=['/opt/cgl-docker-lib/RseqQC_v2.sh', '/data/sorted.bam', uuid],
+    docker_call(tool='jvivian/qc', tool_parameters=['/opt/cgl-docker-lib/RseqQC_v2.sh', docker_path(qc_bam), uuid],
                 work_dir=work_dir, sudo=sudo)
     # Write to FileStore
-    output_files = [f for f in glob.glob(os.path.join(work_dir, '*')) if 'sorted.bam' not in f]
+    output_files = [f for f in glob.glob(os.path.join(work_dir, '*'))
+                    if 'sorted.bam' not in f and 'subsampled.bam' not in f]
     tarball_files(work_dir, tar_name='qc.tar.gz', uuid=None, files=output_files)
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'qc.tar.gz'))
 
 
+def subsample_bam(work_dir, sorted_bam, num_reads, seed):
+    """
+    Draws a deterministic subsample of about num_reads mapped reads from an indexed, coordinate-sorted bam, taking
+    the same fraction of every contig. Mates are kept or dropped together. The fraction is recorded in subsample.txt.
+
+    work_dir: str       Current working directory
+    sorted_bam: str     Path to the coordinate-sorted bam, with its index alongside
+    num_reads: int      Approximate number of reads to keep
+    seed: int           Seed of the subsample
+
+    Returns: str        Path to the subsampled, indexed bam (or sorted_bam if it has no more than num_reads reads)
+    """
+    # Per-contig read counts come straight from the index
+    counts = []
+    for line in subprocess.check_output(['samtools', 'idxstats', sorted_bam]).splitlines():
+        contig, _, mapped, _ = line.split('\t')
+        if contig != '*' and int(mapped):
+            counts.append((contig, int(mapped)))
+    total = sum(mapped for _, mapped in counts)
+    fraction = min(1.0, float(num_reads) / total) if total else 1.0
+    with open(os.path.join(work_dir, 'subsample.txt'), 'w') as f:
+        f.write('mapped_reads\t{}\nrequested_reads\t{}\nfraction\t{:.6f}\nseed\t{}\n'.format(
+            total, num_reads, fraction, seed))
+    if fraction >= 1.0:
+        return sorted_bam
+    # samtools takes the seed as the integer part of the fraction
+    sample_arg = '{}.{:06d}'.format(seed, max(1, int(round(fraction * 1000000))))
+    contig_bams = []
+    for i, (contig, _) in enumerate(counts):
+        contig_bam = os.path.join(work_dir, 'subsampled.bam.{}'.format(i))
+        with open(contig_bam, 'w') as f:
+            subprocess.check_call(['samtools', 'view', '-b', '-s', sample_arg, sorted_bam, contig], stdout=f)
+        contig_bams.append(contig_bam)
+    output = os.path.join(work_dir, 'subsampled.bam')
+    # idxstats lists contigs in header order, so the concatenation is still coordinate sorted
+    if len(contig_bams) == 1:
+        os.rename(contig_bams[0], output)
+    else:
+        subprocess.check_call(['samtools', 'cat', '-o', output] + contig_bams)
+        for contig_bam in contig_bams:
+            os.remove(contig_bam)
+    subprocess.check_call(['samtools', 'index', output])
+    return output
+
+
 def sort_bam_by_reference(job, job_vars):
     """
     Sorts the bam by reference
@@ -658,9 +1120,23 @@ def sort_bam_by_reference(job, job_vars):
     subprocess.check_call(cmd)
     # Write to FileStore
     ids['sort_by_ref.bam'] = job.fileStore.writeGlobalFile(output)
-    rsem_id = job.addChildJobFn(transcriptome, job_vars, disk='30 G', memory='30 G').rv()
+    return quantify(job, job_vars)
+
+
+def quantify(job, job_vars):
+    """
+    Spawns exon and transcript quantification of sort_by_ref.bam as children of job
+
+    job_vars: tuple     Tuple of dictionaries: input_args and ids
+    """
+    input_args, ids = job_vars
+    stage = transcriptome_and_filter if input_args['fuse_transcriptome_filter'] else transcriptome
+    rsem_ids = {}
+    for branch_args in branch_profiles(input_args, 'ubu'):
+        rsem_id = job.addChildJobFn(stage, (branch_args, ids), disk='30 G', memory='30 G').rv()
+        rsem_ids.update((profile, rsem_id) for profile in branch_args['profiles'])
     exon_id = job.addChildJobFn(exon_count, job_vars, disk='30 G').rv()
-    return exon_id, rsem_id
+    return exon_id, rsem_ids
 
 
 def exon_count(job, job_vars):
@@ -726,7 +1202,7 @@ def transcriptome(job, job_vars):
                   '--out', docker_path(output),
                   '--xgtag',
                   '--reverse']
-    docker_call(tool='quay.io/ucsc_cgl/ubu:1.2--02806964cdf74bf5c39411b236b4c4e36d026843',
+    docker_call(tool=tool_image(input_args, 'ubu'),
                 tool_parameters=parameters, work_dir=work_dir, java_opts='-Xmx30g', sudo=sudo)
     # Write to FileStore
     ids['transcriptome.bam'] = job.fileStore.writeGlobalFile(output)
@@ -754,12 +1230,84 @@ def filter_bam(job, job_vars):
                   '--mapq', '1',
                   '--in', docker_path(transcriptome_bam),
                   '--out', docker_path(output)]
-    docker_call(tool='quay.io/ucsc_cgl/ubu:1.2--02806964cdf74bf5c39411b236b4c4e36d026843',
+    docker_call(tool=tool_image(input_args, 'ubu'),
                 tool_parameters=parameters, work_dir=os.path.dirname(output), java_opts='-Xmx30g', sudo=sudo)
     # Write to FileStore
     ids['filtered.bam'] = job.fileStore.writeGlobalFile(output)
     # Run child job
-    return job.addChildJobFn(rsem, job_vars, cores=cores, disk='30 G').rv()
+    return spawn_rsem(job, job_vars)
+
+
+def transcriptome_and_filter(job, job_vars):
+    """
+    Creates the filtered transcriptome bam in a single pass: sam-xlate writes into a named pipe that sam-filter
+    reads from, so the unfiltered transcriptome bam is never written out.
+
+    job_vars: tuple     Tuple of dictionaries: input_args and ids
+    """
+    input_args, ids = job_vars
+    work_dir = job.fileStore.getLocalTempDir()
+    cores = input_args['cpu_count']
+    sudo = input_args['sudo']
+    tool = tool_image(input_args, 'ubu')
+    # I/O
+    sort_by_ref, bed, hg19_fa = return_input_paths(job, work_dir, ids, 'sort_by_ref.bam',
+                                                   'unc.bed', 'hg19.transcripts.fa')
+    pipe = os.path.join(work_dir, 'transcriptome.bam')
+    output = os.path.join(work_dir, 'filtered.bam')
+    os.mkfifo(pipe)
+    os.chmod(pipe, 0666)
+    # Command
+    xlate_parameters = ['sam-xlate',
+                        '--bed', docker_path(bed),
+                        '--in', docker_path(sort_by_ref),
+                        '--order', docker_path(hg19_fa),
+                        '--out', docker_path(pipe),
+                        '--xgtag',
+                        '--reverse']
+    filter_parameters = ['sam-filter',
+                         '--strip-indels',
+                         '--max-insert', '1000',
+                         '--mapq', '1',
+                         '--in', docker_path(pipe),
+                         '--out', docker_path(output)]
+    # sam-xlate keeps the heap it has in transcriptome(). sam-filter only looks at one read pair at a time, so its
+    # small heap comes on top of that.
+    xlate = subprocess.Popen(docker_command(work_dir, '-Xmx30g', sudo) + [tool] + xlate_parameters)
+    sam_filter = subprocess.Popen(docker_command(work_dir, '-Xmx2g', sudo) + [tool] + filter_parameters)
+    while xlate.poll() is None or sam_filter.poll() is None:
+        # If one side dies, open its end of the pipe so the other is not left blocked on it forever
+        for failed, running, flags in [(xlate, sam_filter, os.O_WRONLY), (sam_filter, xlate, os.O_RDONLY)]:
+            if failed.poll() not in (None, 0) and running.poll() is None:
+                try:
+                    os.close(os.open(pipe, flags | os.O_NONBLOCK))
+                except OSError:
+                    pass
+        time.sleep(1)
+    for name, process in [('sam-xlate', xlate), ('sam-filter', sam_filter)]:
+        if process.returncode != 0:
+            raise RuntimeError('{} returned a non-zero exit status. Check error logs.'.format(name))
+    # Write to FileStore
+    ids['filtered.bam'] = job.fileStore.writeGlobalFile(output)
+    # Run child job
+    return spawn_rsem(job, job_vars)
+
+
+def spawn_rsem(job, job_vars):
+    """
+    Spawns RSEM on filtered.bam, once for every distinct RSEM image among the branch's tool profiles
+
+    job_vars: tuple     Tuple of dictionaries: input_args and ids
+
+    Returns: dict       Promised RSEM output IDs, keyed by profile
+    """
+    input_args, ids = job_vars
+    cores = input_args['cpu_count']
+    rsem_ids = {}
+    for branch_args in branch_profiles(input_args, 'rsem'):
+        rsem_id = job.addChildJobFn(rsem, (branch_args, ids), cores=cores, disk='30 G').rv()
+        rsem_ids.update((profile, rsem_id) for profile in branch_args['profiles'])
+    return rsem_ids
 
 
 def rsem(job, job_vars):
@@ -774,8 +1322,8 @@ def rsem(job, job_vars):
     sudo = input_args['sudo']
     single_end_reads = input_args['single_end_reads']
     # I/O
-    filtered_bam, rsem_ref = return_input_paths(job, work_dir, ids, 'filtered.bam', 'rsem_ref.zip')
-    subprocess.check_call(['unzip', '-o', os.path.join(work_dir, 'rsem_ref.zip'), '-d', work_dir])
+    filtered_bam = return_input_paths(job, work_dir, ids, 'filtered.bam')
+    rsem_ref_dir = shared_reference(job, work_dir, input_args, ids, 'rsem_ref.zip')
     output_prefix = 'rsem'
     # Make tool call to Docker
     parameters = ['--quiet',
@@ -787,10 +1335,10 @@ def rsem(job, job_vars):
                   '--bam', docker_path(filtered_bam)]
     if not single_end_reads:
         parameters.extend(['--paired-end'])
-    parameters.extend(['/data/rsem_ref/hg19_M_rCRS_ref', output_prefix])
+    parameters.extend(['/refs/rsem_ref/rsem_ref/hg19_M_rCRS_ref', output_prefix])
 
-    docker_call(tool='quay.io/ucsc_cgl/rsem:1.2.25--4e8d1b31d4028f464b3409c6558fb9dfcad73f88',
-                tool_parameters=parameters, work_dir=work_dir, sudo=sudo)
+    docker_call(tool=tool_image(input_args, 'rsem'),
+                tool_parameters=parameters, work_dir=work_dir, sudo=sudo, mounts={'/refs/rsem_ref': rsem_ref_dir})
     os.rename(os.path.join(work_dir, output_prefix + '.genes.results'), os.path.join(work_dir, 'rsem_gene.tab'))
     os.rename(os.path.join(work_dir, output_prefix + '.isoforms.results'), os.path.join(work_dir, 'rsem_isoform.tab'))
     # Write to FileStore
@@ -825,107 +1373,108 @@ def rsem_postprocess(job, job_vars):
 
 def consolidate_output(job, job_vars, output_ids):
     """
-    Combine the contents of separate zipped outputs into one via streaming
+    Combine the contents of separate zipped outputs into one via streaming, for every tool profile
 
     job_vars: tuple     Tuple of dictionaries: input_args and ids
-    output_ids: tuple   Nested tuple of all the output fileStore IDs
+    output_ids: dict    Nested tuple of all the output fileStore IDs, keyed by profile where profiles diverge
     """
     input_args, ids = job_vars
     work_dir = job.fileStore.getLocalTempDir()
     uuid = input_args['uuid']
-    # Retrieve IDs
-    rseq_id, exon_id, rsem_id = flatten(output_ids)
-    # Retrieve output file paths to consolidate
-    # map_tar = job.fileStore.readGlobalFile(map_id, os.path.join(work_dir, 'map.tar.gz'))
-    qc_tar = job.fileStore.readGlobalFile(rseq_id, os.path.join(work_dir, 'qc.tar.gz'))
-    exon_tar = job.fileStore.readGlobalFile(exon_id, os.path.join(work_dir, 'exon.tar.gz'))
-    rsem_tar = job.fileStore.readGlobalFile(rsem_id, os.path.join(work_dir, 'rsem.tar.gz'))
-    # I/O
-    out_tar = os.path.join(work_dir, uuid + '.tar.gz')
-    # Consolidate separate tarballs
-    with tarfile.open(os.path.join(work_dir, out_tar), 'w:gz') as f_out:
-        for tar in [rsem_tar, exon_tar, qc_tar]:
-            with tarfile.open(tar, 'r') as f_in:
-                for tarinfo in f_in:
-                    with closing(f_in.extractfile(tarinfo)) as f_in_file:
-                        if tar == qc_tar:
-                            tarinfo.name = os.path.join(uuid, 'rseq_qc', os.path.basename(tarinfo.name))
-                        else:
-                            tarinfo.name = os.path.join(uuid, os.path.basename(tarinfo.name))
-                        f_out.addfile(tarinfo, fileobj=f_in_file)
-    # Move to output directory of selected
-    if input_args['output_dir']:
-        output_dir = input_args['output_dir']
-        mkdir_p(output_dir)
-        copy_to_output_dir(work_dir, output_dir, uuid=None, files=[uuid + '.tar.gz'])
-    # Write output file to fileStore
-    ids['uuid.tar.gz'] = job.fileStore.writeGlobalFile(out_tar)
-    # If S3 bucket argument specified, upload to S3
-    if input_args['s3_dir']:
-        job.addChildJobFn(upload_output_to_s3, job_vars)
-
-
-def upload_output_to_s3(job, job_vars):
+    for profile in input_args['tool_profiles']:
+        profile_dir = os.path.join(work_dir, profile)
+        mkdir_p(profile_dir)
+        # Retrieve IDs
+        rseq_id, exon_id, rsem_id = flatten(profile_outputs(output_ids, profile))
+        # Retrieve output file paths to consolidate
+        # map_tar = job.fileStore.readGlobalFile(map_id, os.path.join(work_dir, 'map.tar.gz'))
+        qc_tar = job.fileStore.readGlobalFile(rseq_id, os.path.join(profile_dir, 'qc.tar.gz'))
+        exon_tar = job.fileStore.readGlobalFile(exon_id, os.path.join(profile_dir, 'exon.tar.gz'))
+        rsem_tar = job.fileStore.readGlobalFile(rsem_id, os.path.join(profile_dir, 'rsem.tar.gz'))
+        # I/O -- written straight into the output directory if one was selected
+        tar_name = uuid + '.tar.gz' if len(input_args['tool_profiles']) == 1 else '{}.{}.tar.gz'.format(uuid, profile)
+        if input_args['output_dir']:
+            mkdir_p(input_args['output_dir'])
+            out_tar = os.path.join(input_args['output_dir'], tar_name)
+        else:
+            out_tar = os.path.join(profile_dir, tar_name)
+        # Consolidate separate tarballs
+        consolidate_tarballs(out_tar, [(rsem_tar, uuid), (exon_tar, uuid), (qc_tar, os.path.join(uuid, 'rseq_qc'))],
+                             threads=input_args['cpu_count'])
+        # Write output file to fileStore
+        ids[tar_name] = job.fileStore.writeGlobalFile(out_tar)
+        # If S3 bucket argument specified, upload to S3
+        if input_args['s3_dir']:
+            job.addChildJobFn(upload_output_to_s3, job_vars, tar_name)
+
+
+def upload_output_to_s3(job, job_vars, tar_name):
     """
     If s3_dir is specified in arguments, file will be uploaded to S3 using boto.
     WARNING: ~/.boto credentials are necessary for this to succeed!
 
     job_vars: tuple     Tuple of dictionaries: input_args and ids
+    tar_name: str       Name of the consolidated output tarball
     """
-    import boto
-    from boto.s3.key import Key
-
     input_args, ids = job_vars
     work_dir = job.fileStore.getLocalTempDir()
-    uuid = input_args['uuid']
-    # Parse s3_dir
-    s3_dir = input_args['s3_dir']
-    bucket_name = s3_dir.split('/')[0]
-    bucket_dir = '/'.join(s3_dir.split('/')[1:])
     # I/O
-    uuid_tar = return_input_paths(job, work_dir, ids, 'uuid.tar.gz')
-    # Upload to S3 via boto
-    conn = boto.connect_s3()
-    bucket = conn.get_bucket(bucket_name)
-    k = Key(bucket)
-    k.key = os.path.join(bucket_dir, uuid + '.tar.gz')
-    k.set_contents_from_filename(uuid_tar)
+    uuid_tar = return_input_paths(job, work_dir, ids, tar_name)
+    upload_file_to_s3(input_args, uuid_tar, tar_name)
 
 
 def upload_bam_to_s3(job, job_vars):
     """
-    Upload bam to S3. Requires S3AM and a ~/.boto config file.
+    Upload bam to S3. Requires a ~/.boto config file.
     """
     input_args, ids = job_vars
     work_dir = job.fileStore.getLocalTempDir()
     uuid = input_args['uuid']
     # I/O
-    job.fileStore.readGlobalFile(ids['alignments.bam'], os.path.join(work_dir, 'alignments.bam'))
-    bam_path = os.path.join(work_dir, 'alignments.bam')
-    sample_name = uuid + '.bam'
-    # Parse s3_dir to get bucket and s3 path
+    bam_path = job.fileStore.readGlobalFile(ids['alignments.bam'], os.path.join(work_dir, 'alignments.bam'))
+    upload_file_to_s3(input_args, bam_path, os.path.join('bam_files', uuid + profile_suffix(input_args) + '.bam'))
+
+
+def upload_file_to_s3(input_args, file_path, name):
+    """
+    Uploads a file into s3_dir as a multipart upload, encrypted with SSE-C if an output key was given
+
+    input_args: dict    Dictionary of input arguments
+    file_path: str      Local file to upload
+    name: str           Name of the file relative to s3_dir
+    """
+    # Parse s3_dir
     s3_dir = input_args['s3_dir']
     bucket_name = s3_dir.split('/')[0]
-    bucket_dir = os.path.join('/'.join(s3_dir.split('/')[1:]), 'bam_files')
-    # Upload to S3 via S3AM
-    s3am_command = ['s3am',
-                    'upload',
-                    'file://{}'.format(bam_path),
-                    os.path.join('s3://', bucket_name, bucket_dir, sample_name)]
-    subprocess.check_call(s3am_command)
+    key_name = os.path.join('/'.join(s3_dir.split('/')[1:]), name)
+    headers = None
+    if input_args['output_ssec']:
+        key = generate_unique_key(input_args['output_ssec'], 's3://{}/{}'.format(bucket_name, key_name))
+        headers = sse_c_headers(key)
+    uploader = S3Uploader(s3_connection_factory(input_args['s3_endpoint']),
+                          num_connections=max(input_args['cpu_count'] or 1, 4))
+    uploader.upload(file_path, bucket_name, key_name, headers=headers)
 
 
-def main():
+def main(default_profiles='current'):
     """
     This is a Toil pipeline for the UNC best practice RNA-Seq analysis.
     RNA-seq fastqs are combined, aligned, sorted, filtered, and quantified.
 
     Please read the README.md located in the same directory.
+
+    default_profiles: str   Tool profiles run unless --tool_profiles is given
     """
     # Define Parser object and add to toil
-    parser = build_parser()
+    parser = build_parser(default_profiles)
     Job.Runner.addToilOptions(parser)
     args = parser.parse_args()
+    if args.stream_fastqs and args.mapsplice_chunks > 1:
+        parser.error('--stream_fastqs cannot be combined with --mapsplice_chunks')
+    profiles = [x.strip() for x in args.tool_profiles.split(',') if x.strip()]
+    for profile in profiles:
+        if profile not in TOOL_PROFILES:
+            parser.error('Unknown tool profile "{}". Choose from: {}'.format(profile, ', '.join(sorted(TOOL_PROFILES))))
     # Store inputs from argparse
     inputs = {'config': args.config,
               'config_fastq': args.config_fastq,
@@ -943,6 +1492,20 @@ def main():
               'sudo': args.sudo,
               'single_end_reads': args.single_end_reads,
               'upload_bam_to_s3': args.upload_bam_to_s3,
+              'ref_cache_dir': args.ref_cache_dir,
+              'download_cache_dir': args.download_cache_dir,
+              'mapsplice_chunks': args.mapsplice_chunks,
+              'stream_fastqs': args.stream_fastqs,
+              'fuse_transcriptome_filter': args.fuse_transcriptome_filter,
+              'dual_sort': args.dual_sort,
+              'qc_sample_reads': args.qc_sample_reads,
+              'qc_seed': args.qc_seed,
+              'tool_profiles': profiles,
+              'profiles': profiles,
+              's3_endpoint': args.s3_endpoint,
+              'output_ssec': args.output_ssec,
+              'disk_budget': args.disk_budget,
+              'max_concurrent_samples': args.max_concurrent_samples,
               'uuid': None,
               'sample.tar': None,
               'cpu_count': None}
@@ -0,0 +1,201 @@
+#!/usr/bin/env python2.7
+"""
+In-process, multipart uploads of pipeline outputs to S3.
+
+S3Uploader splits a file into parts that are uploaded concurrently, each over a connection borrowed from a
+shared pool, with at most one part per connection held in memory. Multipart uploads left behind by an interrupted
+attempt are found again by key name and resumed: parts S3 already holds with a matching checksum are skipped.
+SSE-C headers are sent with every request that carries data. Connections come from a factory, so uploads can be
+pointed at an S3-compatible endpoint.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+from Queue import Queue, Empty
+from StringIO import StringIO
+from contextlib import contextmanager
+from urlparse import urlparse
+
+log = logging.getLogger(__name__)
+
+
+def s3_connection_factory(endpoint=None):
+    """
+    Returns a function that opens boto S3 connections
+
+    :param str endpoint: Optional URL of an S3-compatible service, e.g. http://localhost:9000
+    :rtype: function
+    """
+    def connect():
+        import boto
+        from boto.s3.connection import OrdinaryCallingFormat, S3Connection
+        if not endpoint:
+            return boto.connect_s3()
+        parsed = urlparse(endpoint)
+        return S3Connection(host=parsed.hostname, port=parsed.port, is_secure=parsed.scheme == 'https',
+                            calling_format=OrdinaryCallingFormat())
+    return connect
+
+
+class ConnectionPool(object):
+    """
+    Hands out up to `size` connections, reusing those that are returned.
+    """
+
+    def __init__(self, factory, size):
+        self.factory = factory
+        self.size = size
+        self.idle = Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        except:
+            # A connection that saw an error may be in an unknown state, so it is replaced rather than reused
+            with self.lock:
+                self.created -= 1
+            raise
+        else:
+            self.idle.put(conn)
+
+    def _acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except Empty:
+            pass
+        with self.lock:
+            create = self.created < self.size
+            if create:
+                self.created += 1
+        if create:
+            try:
+                return self.factory()
+            except:
+                with self.lock:
+                    self.created -= 1
+                raise
+        return self.idle.get()
+
+
+class S3Uploader(object):
+    """
+    Uploads files to S3, as multipart uploads with concurrent parts when they are larger than one part.
+    """
+
+    def __init__(self, connection_factory, num_connections=8, part_size=64 * 1024 * 1024, retries=5):
+        """
+        :param function connection_factory: Returns a new boto S3 connection, see s3_connection_factory()
+        :param int num_connections: Size of the connection pool, and the number of parts in flight (and in memory)
+        :param int part_size: Size of each part in bytes, at least 5 MiB for S3
+        :param int retries: Number of times a failed part is retried
+        """
+        self.pool = ConnectionPool(connection_factory, num_connections)
+        self.num_connections = num_connections
+        self.part_size = part_size
+        self.retries = retries
+
+    def upload(self, file_path, bucket_name, key_name, headers=None):
+        """
+        Uploads file_path to s3://bucket_name/key_name
+
+        :param str file_path: Local file to upload
+        :param str bucket_name: Destination bucket
+        :param str key_name: Destination key
+        :param dict headers: Extra headers sent with every request that carries data (e.g. SSE-C headers)
+        """
+        headers = dict(headers or {})
+        size = os.path.getsize(file_path)
+        if size <= self.part_size:
+            with self.pool.connection() as conn:
+                bucket = conn.get_bucket(bucket_name, validate=False)
+                bucket.new_key(key_name).set_contents_from_filename(file_path, headers=headers)
+            return
+        num_parts = (size + self.part_size - 1) // self.part_size
+        upload_id, uploaded = self._start(bucket_name, key_name, headers, num_parts)
+        queue = Queue()
+        for part_num in xrange(1, num_parts + 1):
+            queue.put(part_num)
+        errors = []
+
+        def worker():
+            while not errors:
+                try:
+                    part_num = queue.get_nowait()
+                except Empty:
+                    return
+                try:
+                    self._upload_part(file_path, bucket_name, key_name, upload_id, part_num, uploaded, headers)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker) for _ in xrange(min(self.num_connections, num_parts))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            # The upload is left in place so that the next attempt can resume it
+            raise RuntimeError('Failed to upload {} to s3://{}/{}: {}'.format(file_path, bucket_name, key_name,
+                                                                              errors[0]))
+        with self.pool.connection() as conn:
+            self.multipart_upload(conn.get_bucket(bucket_name, validate=False), key_name, upload_id).complete_upload()
+
+    def _start(self, bucket_name, key_name, headers, num_parts):
+        """
+        Returns the ID of an unfinished multipart upload to key_name, and the ETags and sizes of its parts by part
+        number, or starts a new upload if there is none
+        """
+        with self.pool.connection() as conn:
+            bucket = conn.get_bucket(bucket_name, validate=False)
+            for upload in bucket.get_all_multipart_uploads(prefix=key_name):
+                if upload.key_name != key_name:
+                    continue
+                uploaded = dict((part.part_number, (part.etag.strip('"'), part.size)) for part in upload)
+                # Parts past the end of the file would be completed into the object, so such an upload is dropped
+                if uploaded and max(uploaded) > num_parts:
+                    upload.cancel_upload()
+                    continue
+                log.info('Resuming upload %s to s3://%s/%s with %d parts already uploaded.',
+                         upload.id, bucket_name, key_name, len(uploaded))
+                return upload.id, uploaded
+            return bucket.initiate_multipart_upload(key_name, headers=headers).id, {}
+
+    def _upload_part(self, file_path, bucket_name, key_name, upload_id, part_num, uploaded, headers):
+        with open(file_path, 'rb') as f:
+            f.seek((part_num - 1) * self.part_size)
+            data = f.read(self.part_size)
+        # Parts of SSE-C objects do not have MD5 ETags, so those are always uploaded again
+        md5 = hashlib.md5(data).hexdigest()
+        if uploaded.get(part_num) == (md5, len(data)):
+            return
+        attempt = 0
+        while True:
+            try:
+                with self.pool.connection() as conn:
+                    upload = self.multipart_upload(conn.get_bucket(bucket_name, validate=False), key_name, upload_id)
+                    upload.upload_part_from_file(StringIO(data), part_num, headers=headers)
+                return
+            except Exception as e:
+                attempt += 1
+                if attempt > self.retries:
+                    raise
+                log.warn('Retrying part %d of %s (attempt %d): %s', part_num, key_name, attempt, e)
+                time.sleep(min(2 ** attempt, 30))
+
+    @staticmethod
+    def multipart_upload(bucket, key_name, upload_id):
+        """
+        Returns a handle on an existing multipart upload, bound to the connection of bucket
+        """
+        from boto.s3.multipart import MultiPartUpload
+        upload = MultiPartUpload(bucket)
+        upload.key_name = key_name
+        upload.id = upload_id
+        return upload
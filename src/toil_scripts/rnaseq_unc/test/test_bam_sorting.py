@@ -0,0 +1,62 @@
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+from distutils.spawn import find_executable
+from unittest import TestCase, skipUnless
+
+from toil_scripts.rnaseq_unc.bam_sorting import dual_sort
+
+
+@skipUnless(find_executable('samtools'), 'samtools is not installed')
+class DualSortTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def records(self, bam):
+        """
+        Returns (name, contig, position) of the records of a BAM
+        """
+        out = subprocess.check_output(['samtools', 'view', bam])
+        return [(x[0], x[2], int(x[3])) for x in (line.split('\t') for line in out.splitlines())]
+
+    def test_dual_sort(self):
+        random.seed(1)
+        # Contigs in a header order that is not alphabetical
+        contigs = ['chr2', 'chr10', 'chr1']
+        records = [('r{}'.format(random.randint(1, 9)), random.choice(contigs), random.randint(1, 900))
+                   for _ in xrange(200)]
+        records += [('r{}'.format(i), '*', 0) for i in xrange(1, 4)]
+        sam = os.path.join(self.work_dir, 'input.sam')
+        with open(sam, 'w') as f:
+            f.write('@HD\tVN:1.3\tSO:unsorted\n')
+            for contig in contigs:
+                f.write('@SQ\tSN:{}\tLN:1000\n'.format(contig))
+            for name, contig, position in records:
+                if contig == '*':
+                    f.write('{}\t4\t*\t0\t0\t*\t*\t0\t0\tACGTACGTAC\t*\n'.format(name))
+                else:
+                    f.write('{}\t0\t{}\t{}\t60\t10M\t*\t0\t0\tACGTACGTAC\t*\n'.format(name, contig, position))
+        bam = os.path.join(self.work_dir, 'input.bam')
+        with open(bam, 'w') as f:
+            subprocess.check_call(['samtools', 'view', '-Sb', sam], stdout=f)
+
+        name_sorted = os.path.join(self.work_dir, 'sort_by_ref.bam')
+        dual_sort(bam, os.path.join(self.work_dir, 'sorted'), name_sorted, self.work_dir, sort_memory=100000000)
+
+        placed = [x for x in records if x[1] != '*']
+        coord = self.records(os.path.join(self.work_dir, 'sorted.bam'))
+        self.assertEqual(sorted(coord), sorted(records))
+        self.assertEqual([x[1:] for x in coord if x[1] != '*'],
+                         sorted([x[1:] for x in placed], key=lambda x: (contigs.index(x[0]), x[1])))
+        by_name = self.records(name_sorted)
+        self.assertEqual([(contig, name) for name, contig, _ in by_name],
+                         sorted([(x[1], x[0]) for x in placed], key=lambda x: (contigs.index(x[0]), x[1])))
+        self.assertEqual(sorted(by_name), sorted(placed))
+        self.assertEqual(os.listdir(self.work_dir).count('sorted.bam'), 1)
+        self.assertFalse([x for x in os.listdir(self.work_dir) if x.startswith('dual_sort')])
@@ -0,0 +1,48 @@
+import os
+import shutil
+import tempfile
+from StringIO import StringIO
+from unittest import TestCase
+
+from toil_scripts.rnaseq_unc.fastq_splitting import count_lines, split_fastq
+
+
+class SplitFastqTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def reads(self, mate, indices):
+        return ''.join('@r{0}/{1}\nACGT\n+\nIIII\n'.format(i, mate) for i in indices)
+
+    def test_round_robin(self):
+        path = os.path.join(self.work_dir, 'R1.fastq')
+        with open(path, 'w') as f:
+            f.write(self.reads(1, xrange(10)))
+        with open(path) as f:
+            r1 = split_fastq(f, self.work_dir, 'R1.fastq', 4, reads_per_block=2)
+        # A stream that is not a file, like the ones the FileStore hands out
+        r2 = split_fastq(StringIO(self.reads(2, xrange(10))), self.work_dir, 'R2.fastq', 4, reads_per_block=2)
+        self.assertEqual([os.path.basename(x) for x in r1], ['chunk{}.R1.fastq'.format(i) for i in xrange(4)])
+        expected = [[0, 1, 8, 9], [2, 3], [4, 5], [6, 7]]
+        for mate, paths in ((1, r1), (2, r2)):
+            for path, indices in zip(paths, expected):
+                with open(path) as f:
+                    self.assertEqual(f.read(), self.reads(mate, indices))
+        self.assertEqual([count_lines(x) for x in r1], [16, 8, 8, 8])
+        self.assertFalse([x for x in os.listdir(self.work_dir) if x.startswith('block')])
+
+    def test_empty_chunks(self):
+        chunks = split_fastq(StringIO(self.reads(1, xrange(3))), self.work_dir, 'R1.fastq', 3, reads_per_block=2)
+        self.assertEqual([count_lines(x) for x in chunks], [8, 4, 0])
+        self.assertFalse(os.path.exists(chunks[2]))
+
+    def test_many_blocks(self):
+        # Block numbers beyond the ones sh could mistake for octal
+        chunks = split_fastq(StringIO(self.reads(1, xrange(100))), self.work_dir, 'R1.fastq', 7, reads_per_block=1)
+        for i, path in enumerate(chunks):
+            with open(path) as f:
+                self.assertEqual(f.read(), self.reads(1, xrange(i, 100, 7)))
@@ -0,0 +1,144 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from unittest import TestCase
+
+from toil_scripts.node_cache import cache_key
+from toil_scripts.rnaseq_unc.ranged_download import ranged_download
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serves the server's payload, honouring single byte-range requests. Can be told to cut a response short.
+    """
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        data = server.payload
+        match = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range', ''))
+        if match and server.ranges and int(match.group(1)) >= len(data):
+            self.send_response(416)
+            self.send_header('Content-Range', 'bytes */{}'.format(len(data)))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if match and server.ranges:
+            start, end = int(match.group(1)), min(int(match.group(2)), len(data) - 1)
+            server.ranges_served.append((start, end))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, len(data)))
+        else:
+            start, end = 0, len(data) - 1
+            self.send_response(200)
+        body = data[start:end + 1]
+        if server.content_length:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if server.drops and end - start > 1:
+            server.drops -= 1
+            body = body[:len(body) // 2]
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class RangedDownloadTest(TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.server = HTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.payload = os.urandom(1000 * 1000 + 17)
+        self.server.ranges = True
+        self.server.drops = 0
+        self.server.content_length = True
+        self.server.requests = []
+        self.server.ranges_served = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}/sample.tar'.format(self.server.server_port)
+        self.path = os.path.join(self.workdir, 'sample.tar')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.workdir)
+
+    def _read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+    def test_parallel_parts(self):
+        ranged_download(self.url, self.path, num_threads=4, part_size=100 * 1000)
+        self.assertEqual(self._read(), self.server.payload)
+        # One probe plus eleven parts
+        self.assertEqual(len(self.server.ranges_served), 12)
+        self.assertFalse(os.path.exists(self.path + '.parts'))
+
+    def test_resumes_dropped_connection(self):
+        self.server.drops = 2
+        ranged_download(self.url, self.path, num_threads=2, part_size=300 * 1000, retries=3)
+        self.assertEqual(self._read(), self.server.payload)
+
+    def test_resumes_from_checkpoint(self):
+        part_size = 250 * 1000
+        with open(self.path, 'wb') as f:
+            f.write(self.server.payload[:part_size])
+            f.truncate(len(self.server.payload))
+        with open(self.path + '.parts', 'w') as f:
+            json.dump({'length': len(self.server.payload), 'etag': None, 'done': [0]}, f)
+        ranged_download(self.url, self.path, part_size=part_size)
+        self.assertEqual(self._read(), self.server.payload)
+        self.assertNotIn(0, [start for start, end in self.server.ranges_served[1:]])
+
+    def test_headers_are_forwarded(self):
+        headers = {'x-amz-server-side-encryption-customer-algorithm': 'AES256'}
+        ranged_download(self.url, self.path, headers=headers, part_size=500 * 1000)
+        for request in self.server.requests:
+            self.assertEqual(request['x-amz-server-side-encryption-customer-algorithm'], 'AES256')
+
+    def test_checksum(self):
+        md5 = hashlib.md5(self.server.payload).hexdigest()
+        ranged_download(self.url, self.path, md5=md5)
+        self.assertRaises(RuntimeError, ranged_download, self.url, self.path, md5='0' * 32)
+
+    def test_server_without_range_support(self):
+        self.server.ranges = False
+        ranged_download(self.url, self.path)
+        self.assertEqual(self._read(), self.server.payload)
+
+    def test_server_without_content_length(self):
+        self.server.ranges = False
+        self.server.content_length = False
+        # Without a length the response ends when the server closes the connection
+        ranged_download(self.url, self.path)
+        self.assertEqual(self._read(), self.server.payload)
+
+    def test_empty_object(self):
+        self.server.payload = ''
+        ranged_download(self.url, self.path)
+        self.assertEqual(self._read(), '')
+
+    def test_resumes_from_cache_dir(self):
+        part_size = 250 * 1000
+        cache_dir = os.path.join(self.workdir, 'cache')
+        os.mkdir(cache_dir)
+        partial = os.path.join(cache_dir, cache_key(self.url))
+        # A previous attempt, whose work directory is gone, fetched the first part
+        with open(partial, 'wb') as f:
+            f.write(self.server.payload[:part_size])
+            f.truncate(len(self.server.payload))
+        with open(partial + '.parts', 'w') as f:
+            json.dump({'length': len(self.server.payload), 'etag': None, 'done': [0]}, f)
+        ranged_download(self.url, self.path, part_size=part_size, cache_dir=cache_dir)
+        self.assertEqual(self._read(), self.server.payload)
+        self.assertNotIn(0, [start for start, end in self.server.ranges_served[1:]])
+        self.assertFalse(os.path.exists(partial))
+        self.assertFalse(os.path.exists(partial + '.parts'))
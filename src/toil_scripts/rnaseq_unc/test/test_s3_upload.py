@@ -0,0 +1,155 @@
+import hashlib
+import itertools
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from toil_scripts.rnaseq_unc.s3_upload import S3Uploader
+
+MB = 1024 * 1024
+
+
+class FakePart(object):
+
+    def __init__(self, part_number, data):
+        self.part_number = part_number
+        self.etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+        self.size = len(data)
+        self.data = data
+
+
+class FakeUpload(object):
+
+    def __init__(self, store, key_name, upload_id, headers):
+        self.store = store
+        self.key_name = key_name
+        self.id = upload_id
+        self.headers = headers
+        self.parts = {}
+
+    def __iter__(self):
+        return iter(sorted(self.parts.values(), key=lambda x: x.part_number))
+
+    def upload_part_from_file(self, fp, part_num, headers=None):
+        self.store.requests.append(('part', part_num, headers))
+        if self.store.failures:
+            self.store.failures -= 1
+            raise IOError('Connection reset by peer')
+        self.parts[part_num] = FakePart(part_num, fp.read())
+
+    def complete_upload(self):
+        self.store.objects[self.key_name] = ''.join(x.data for x in self)
+        del self.store.uploads[self.id]
+
+    def cancel_upload(self):
+        del self.store.uploads[self.id]
+
+
+class FakeKey(object):
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+
+    def set_contents_from_filename(self, path, headers=None):
+        self.store.requests.append(('put', self.name, headers))
+        with open(path, 'rb') as f:
+            self.store.objects[self.name] = f.read()
+
+
+class FakeBucket(object):
+
+    def __init__(self, store):
+        self.store = store
+
+    def new_key(self, name):
+        return FakeKey(self.store, name)
+
+    def get_all_multipart_uploads(self, prefix=''):
+        return [x for x in self.store.uploads.values() if x.key_name.startswith(prefix)]
+
+    def initiate_multipart_upload(self, key_name, headers=None):
+        upload = FakeUpload(self.store, key_name, str(next(self.store.ids)), headers)
+        self.store.uploads[upload.id] = upload
+        return upload
+
+
+class FakeS3(object):
+    """
+    Stand-in for the parts of a boto S3 connection used by S3Uploader
+    """
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        self.requests = []
+        self.failures = 0
+        self.ids = itertools.count()
+        self.connections = 0
+
+    def connect(self):
+        self.connections += 1
+        return self
+
+    def get_bucket(self, name, validate=True):
+        return FakeBucket(self)
+
+
+class FakeS3Uploader(S3Uploader):
+
+    @staticmethod
+    def multipart_upload(bucket, key_name, upload_id):
+        return bucket.store.uploads[upload_id]
+
+
+class S3UploadTest(TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.workdir, 'sample.tar.gz')
+        self.data = os.urandom(5 * MB + 123)
+        with open(self.path, 'wb') as f:
+            f.write(self.data)
+        self.s3 = FakeS3()
+        self.uploader = FakeS3Uploader(self.s3.connect, num_connections=3, part_size=MB, retries=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def test_multipart_upload(self):
+        self.uploader.upload(self.path, 'bucket', 'dir/sample.tar.gz')
+        self.assertEqual(self.s3.objects['dir/sample.tar.gz'], self.data)
+        self.assertEqual(len([x for x in self.s3.requests if x[0] == 'part']), 6)
+        self.assertLessEqual(self.s3.connections, 3)
+        self.assertFalse(self.s3.uploads)
+
+    def test_small_file_is_a_single_put(self):
+        uploader = FakeS3Uploader(self.s3.connect, part_size=10 * MB)
+        uploader.upload(self.path, 'bucket', 'sample.tar.gz', headers={'x-test': '1'})
+        self.assertEqual(self.s3.requests, [('put', 'sample.tar.gz', {'x-test': '1'})])
+
+    def test_resumes_unfinished_upload(self):
+        upload = FakeBucket(self.s3).initiate_multipart_upload('sample.tar.gz')
+        for part_num in (1, 2, 3):
+            upload.parts[part_num] = FakePart(part_num, self.data[(part_num - 1) * MB:part_num * MB])
+        # A stale part that no longer matches the file
+        upload.parts[4] = FakePart(4, 'x' * MB)
+        self.uploader.upload(self.path, 'bucket', 'sample.tar.gz')
+        self.assertEqual(self.s3.objects['sample.tar.gz'], self.data)
+        self.assertEqual(sorted(x[1] for x in self.s3.requests), [4, 5, 6])
+
+    def test_retries_and_headers(self):
+        self.s3.failures = 2
+        headers = {'x-amz-server-side-encryption-customer-algorithm': 'AES256'}
+        self.uploader.upload(self.path, 'bucket', 'sample.tar.gz', headers=headers)
+        self.assertEqual(self.s3.objects['sample.tar.gz'], self.data)
+        self.assertTrue(all(x[2] == headers for x in self.s3.requests))
+
+    def test_failed_upload_can_be_resumed(self):
+        self.s3.failures = 100
+        self.assertRaises(RuntimeError, self.uploader.upload, self.path, 'bucket', 'sample.tar.gz')
+        self.assertEqual(len(self.s3.uploads), 1)
+        self.s3.failures = 0
+        self.uploader.upload(self.path, 'bucket', 'sample.tar.gz')
+        self.assertEqual(self.s3.objects['sample.tar.gz'], self.data)
@@ -0,0 +1,163 @@
+#!/usr/bin/env python2.7
+"""
+Streaming re-synchronization of paired FASTQs.
+
+cutadapt refuses read files whose names stop pairing up ("improperly paired"), which it only notices after having
+trimmed everything before the offending read. sync_pairs() makes one streaming pass over R1 and R2 ahead of it and
+writes out only records whose mate is present, in their original order. Reads whose mate is missing (orphans) are
+dropped. To find the mate of a read after a gap, unmatched reads of each file are held back, up to `window` per file;
+beyond that the oldest is given up on as an orphan, which bounds memory use.
+
+Run as a script, it writes the synchronized reads to two paths (typically named pipes read by cutadapt) and the
+counts as JSON.
+"""
+import argparse
+import json
+import sys
+from collections import OrderedDict
+
+
+def read_name(header):
+    """
+    Returns the read name of a FASTQ header line, without the '@', comment or /1 and /2 mate suffixes
+
+    :param str header: First line of a FASTQ record
+    :rtype: str
+    """
+    name = header[1:].split(None, 1)[0] if len(header) > 1 else ''
+    if name.endswith(('/1', '/2')):
+        name = name[:-2]
+    return name
+
+
+def fastq_records(f):
+    """
+    Yields (read name, record) for every four-line record of a FASTQ file
+
+    :param file f: Open FASTQ file
+    """
+    while True:
+        header = f.readline()
+        if not header:
+            return
+        record = header + f.readline() + f.readline() + f.readline()
+        if not header.startswith('@') or record.count('\n') != 4:
+            raise RuntimeError('Malformed or truncated FASTQ record in {}: {!r}'.format(f.name, header))
+        yield read_name(header), record
+
+
+class _Side(object):
+    """
+    Unmatched reads of one of the two files, oldest first
+    """
+
+    def __init__(self, records):
+        self.records = records
+        self.pending = OrderedDict()
+        self.orphans = 0
+
+    def next(self):
+        return next(self.records, None)
+
+    def drop_until(self, name):
+        """
+        Drops pending reads older than `name`, which is pending itself, and returns its record
+        """
+        while True:
+            pending_name, record = self.pending.popitem(last=False)
+            if pending_name == name:
+                return record
+            self.orphans += 1
+
+    def drop_all(self):
+        self.orphans += len(self.pending)
+        self.pending.clear()
+
+
+def sync_pairs(r1_in, r2_in, r1_out, r2_out, window=100000):
+    """
+    Copies the records of r1_in and r2_in whose mate is present in the other file, dropping orphans.
+
+    Both files are expected to list mates in the same order, possibly with reads missing from either one.
+
+    :param file r1_in: Read 1 FASTQ
+    :param file r2_in: Read 2 FASTQ
+    :param file r1_out: Destination of paired read 1 records
+    :param file r2_out: Destination of paired read 2 records
+    :param int window: Maximum number of unmatched reads held back per file while looking for their mates
+    :return: Counts of written pairs and of dropped read 1 and read 2 orphans
+    :rtype: dict
+    """
+    sides = [_Side(fastq_records(r1_in)), _Side(fastq_records(r2_in))]
+    pairs = 0
+    while True:
+        reads = [side.next() for side in sides]
+        if reads == [None, None]:
+            break
+        if not sides[0].pending and not sides[1].pending and reads[0] and reads[1] and reads[0][0] == reads[1][0]:
+            # In sync, the common case
+            r1_out.write(reads[0][1])
+            r2_out.write(reads[1][1])
+            pairs += 1
+            continue
+        for i, read in enumerate(reads):
+            if read is None:
+                continue
+            name, record = read
+            this, other = sides[i], sides[1 - i]
+            if name in other.pending:
+                # Reads older than a matched pair cannot be matched any more, as mates appear in the same order
+                mate = other.drop_until(name)
+                this.drop_all()
+                r1_out.write(record if i == 0 else mate)
+                r2_out.write(mate if i == 0 else record)
+                pairs += 1
+            else:
+                this.pending[name] = record
+                if len(this.pending) > window:
+                    this.pending.popitem(last=False)
+                    this.orphans += 1
+    for side in sides:
+        side.drop_all()
+    return {'pairs': pairs, 'r1_orphans': sides[0].orphans, 'r2_orphans': sides[1].orphans}
+
+
+def sync_command(r1_in, r2_in, r1_out, r2_out, counts, window=100000):
+    """
+    Returns the command that runs sync_pairs() on the given paths in a process of its own (see main)
+
+    :param str r1_in: Read 1 FASTQ
+    :param str r2_in: Read 2 FASTQ
+    :param str r1_out: Destination of paired read 1 records
+    :param str r2_out: Destination of paired read 2 records
+    :param str counts: Path of the JSON file that receives the counts
+    :param int window: Maximum number of unmatched reads held back per file while looking for their mates
+    :rtype: list
+    """
+    return [sys.executable, '-m', 'toil_scripts.spladder_pipeline.fastq_pairs', '--window', str(window),
+            '--counts', counts, r1_in, r2_in, r1_out, r2_out]
+
+
+def main():
+    """
+    Writes the reads of two FASTQs that have a mate to two output paths, and the counts to a JSON file
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('r1_in')
+    parser.add_argument('r2_in')
+    parser.add_argument('r1_out')
+    parser.add_argument('r2_out')
+    parser.add_argument('--window', type=int, default=100000,
+                        help='Maximum number of unmatched reads held back per file while looking for their mates')
+    parser.add_argument('--counts', required=True, help='Path of the JSON file that receives the counts')
+    args = parser.parse_args()
+    with open(args.r1_in) as r1_in, open(args.r2_in) as r2_in:
+        # Opened in order, as cutadapt does, in case the outputs are named pipes
+        with open(args.r1_out, 'w') as r1_out, open(args.r2_out, 'w') as r2_out:
+            counts = sync_pairs(r1_in, r2_in, r1_out, r2_out, window=args.window)
+    with open(args.counts, 'w') as f:
+        json.dump(counts, f)
+
+
+if __name__ == '__main__':
+    main()
@@ -18,27 +18,51 @@ Structure of Spladder Pipeline (per sample)
 3   -   Alternative Splice Calling
 4   -   Consolidate Output
 5   -   Upload results to S3
+
+With --cohort, the splice graph of every sample from 3 is also merged into a cohort graph. Samples are admitted in
+the lanes of --disk-budget (see admission.py), and each lane merges the graphs of its samples as they finish. The
+graphs of the lanes are then merged into that of the cohort:
+
+    Lane 1: Sample 1 --> Sample 3 --> ...
+               |            |
+               v            v
+            Merge 1 ---> Merge 3 ---> ... --+
+                                            +--> Merge lanes --> Quantify (per sample) --> Collect events
+    Lane 2: Sample 2 --> ...                |
+               |                            |
+               v                            |
+            Merge 2 ---> ... ---------------+
 """
 import argparse
 import fnmatch
+import gzip
+import json
 import multiprocessing
 import os
 import shutil
 import subprocess
-import tarfile
+import time
+from collections import OrderedDict
 from contextlib import closing
 from glob import glob
+from multiprocessing.pool import ThreadPool
+from uuid import uuid4
 
 from bd2k.util.files import mkdir_p
 from bd2k.util.processes import which
 from toil.job import Job
 from toil_lib.files import tarball_files
-from toil_lib.jobs import map_job
 from toil_lib.programs import docker_call
 from toil_lib.urls import download_url
 from toil_lib.urls import download_url_job
 from toil_lib.urls import s3am_upload_job
 
+from toil_scripts.admission import budgeted_map_job, disk_budget, lpt_lanes, num_lanes, sample_footprints
+from toil_scripts.consolidation import ParallelGzipWriter, consolidate_tarballs
+from toil_scripts.named_pipes import FifoFeed, decompress_command
+from toil_scripts.node_cache import cache_key, extract_once, untar
+from toil_scripts.spladder_pipeline.fastq_pairs import sync_command
+
 
 def parse_input_samples(job, inputs):
     """
@@ -57,16 +81,40 @@ def parse_input_samples(job, inputs):
                     sample = line.strip().split(',')
                     assert len(sample) == 2, 'Error: Config file is inappropriately formatted.'
                     samples.append(sample)
-    job.addChildJobFn(map_job, download_sample, samples, inputs)
+    # Inputs shared by every sample are downloaded once into the jobStore
+    shared_files = [(inputs.genome, 'genome.fa'), (inputs.genome_index, 'genome.fa.fai'),
+                    (inputs.positions, 'positions.tsv'), (inputs.gtf, 'annotation.gtf'),
+                    (inputs.gtf_m53, 'annotation.m53'), (inputs.gtf_pickle, 'annotation.gtf.pickle')]
+    shared_ids = {}
+    for url, fname in shared_files:
+        shared_ids[fname] = job.addChildJobFn(download_url_job, url, disk='10G').rv()
+    budget = disk_budget(inputs.disk_budget, expansion=8.0, max_concurrent=inputs.max_concurrent_samples)
+    if inputs.cohort:
+        job.addFollowOnJobFn(cohort_dag, samples, budget, inputs, shared_ids)
+    else:
+        job.addFollowOnJobFn(budgeted_map_job, download_sample, samples, budget, sample_urls, inputs, shared_ids)
+
+
+def sample_urls(sample):
+    """
+    Returns the URL of a sample tarball
 
+    :param tuple sample: Tuple containing (UUID,URL) of a sample
+    :rtype: list[str]
+    """
+    return [sample[1]]
 
-def download_sample(job, sample, inputs):
+
+def download_sample(job, sample, inputs, shared_ids):
     """
     Download the input sample
 
     :param JobFunctionWrappingJob job: passed by Toil automatically
     :param tuple sample: Tuple containing (UUID,URL) of a sample
     :param Namespace inputs: Stores input arguments (see main)
+    :param dict shared_ids: FileStore IDs of the inputs shared by all samples, by file name
+    :return: Sample outputs used by the cohort, see star()
+    :rtype: dict
     """
     uuid, url = sample
     job.fileStore.logToMaster('Downloading sample: {}'.format(uuid))
@@ -76,8 +124,11 @@ def download_sample(job, sample, inputs):
     sample_inputs = argparse.Namespace(**vars(inputs))
     sample_inputs.uuid = uuid
     sample_inputs.cores = multiprocessing.cpu_count()
+    sample_inputs.shared_ids = shared_ids
     # Call children and follow-on jobs
-    job.addFollowOnJobFn(process_sample, sample_inputs, tar_id, cores=2, disk='60G')
+    if inputs.stream_fastqs:
+        return job.addFollowOnJobFn(cutadapt, sample_inputs, tar_id=tar_id, disk='60G').rv()
+    return job.addFollowOnJobFn(process_sample, sample_inputs, tar_id, cores=2, disk='60G').rv()
 
 
 def process_sample(job, inputs, tar_id):
@@ -96,9 +147,32 @@ def process_sample(job, inputs, tar_id):
     # Untar File and concat
     subprocess.check_call(['tar', '-xvf', tar_path, '-C', work_dir])
     os.remove(os.path.join(work_dir, 'sample.tar'))
-    # Grab files from tarball
+    r1, r2 = _locate_read_pairs(work_dir)
+    command = 'zcat' if r1[0].endswith('gz') and r2[0].endswith('gz') else 'cat'
+    with open(os.path.join(work_dir, 'R1.fastq'), 'w') as f1:
+        p1 = subprocess.Popen([command] + r1, stdout=f1)
+    with open(os.path.join(work_dir, 'R2.fastq'), 'w') as f2:
+        p2 = subprocess.Popen([command] + r2, stdout=f2)
+    p1.wait()
+    p2.wait()
+    # Write to fileStore
+    r1_id = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'R1.fastq'))
+    r2_id = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'R2.fastq'))
+    job.fileStore.deleteGlobalFile(tar_id)
+    # Start cutadapt step
+    return job.addChildJobFn(cutadapt, inputs, r1_id, r2_id, disk='60G').rv()
+
+
+def _locate_read_pairs(sample_dir):
+    """
+    Finds the read 1 and read 2 fastq(.gz) files of an unpacked sample tarball.
+
+    :param str sample_dir: Directory the sample tarball was unpacked into
+    :return: Sorted paths of the read 1 and read 2 files
+    :rtype: tuple(list, list)
+    """
     fastqs = []
-    for root, subdir, files in os.walk(work_dir):
+    for root, subdir, files in os.walk(sample_dir):
         fastqs.extend([os.path.join(root, x) for x in files])
     # Check for read 1 and read 2 files
     r1 = sorted([x for x in fastqs if 'R1' in x])
@@ -114,70 +188,125 @@ def process_sample(job, inputs, tar_id):
         r2 = [x for x in r2 if x not in r1]
     # Flag if data is single-ended
     assert r1 and r2, 'This pipeline does not support single-ended data. R1: {}\nR2:{}'.format(r1, r2)
-    command = 'zcat' if r1[0].endswith('gz') and r2[0].endswith('gz') else 'cat'
-    with open(os.path.join(work_dir, 'R1.fastq'), 'w') as f1:
-        p1 = subprocess.Popen([command] + r1, stdout=f1)
-    with open(os.path.join(work_dir, 'R2.fastq'), 'w') as f2:
-        p2 = subprocess.Popen([command] + r2, stdout=f2)
-    p1.wait()
-    p2.wait()
-    # Write to fileStore
-    r1_id = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'R1.fastq'))
-    r2_id = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'R2.fastq'))
-    job.fileStore.deleteGlobalFile(tar_id)
-    # Start cutadapt step
-    job.addChildJobFn(cutadapt, inputs, r1_id, r2_id, disk='60G').rv()
+    return r1, r2
 
 
-def cutadapt(job, inputs, r1_id, r2_id):
+def cutadapt(job, inputs, r1_id=None, r2_id=None, tar_id=None):
     """
     Filters out adapters that may be left in the RNA-seq files
 
+    cutadapt reads the fastqs through named pipes fed by fastq_pairs, which drops reads whose mate is missing so
+    that cutadapt does not fail on improperly paired files. If given the sample tarball instead of the read fastqs,
+    the tarball is unpacked here and the decompressed, concatenated reads are piped in as well (see --stream-fastqs).
+
     :param JobFunctionWrappingJob job: passed by Toil automatically
     :param Namespace inputs: Stores input arguments (see main)
     :param str r1_id: FileStore ID of read 1 fastq
     :param str r2_id: FileStore ID of read 2 fastq
+    :param str tar_id: FileStore ID of sample tar, used in place of r1_id and r2_id
     """
     job.fileStore.logToMaster('Running CutAdapt: {}'.format(inputs.uuid))
     work_dir = job.fileStore.getLocalTempDir()
-    inputs.improper_pair = None
     # Retrieve files
-    job.fileStore.readGlobalFile(r1_id, os.path.join(work_dir, 'R1.fastq'))
-    job.fileStore.readGlobalFile(r2_id, os.path.join(work_dir, 'R2.fastq'))
+    feeds = []
+    if tar_id:
+        sample_dir = os.path.join(work_dir, 'sample')
+        mkdir_p(sample_dir)
+        tar_path = job.fileStore.readGlobalFile(tar_id, os.path.join(work_dir, 'sample.tar'))
+        subprocess.check_call(['tar', '-xf', tar_path, '-C', sample_dir])
+        os.remove(tar_path)
+        r1, r2 = _locate_read_pairs(sample_dir)
+        feeds = [FifoFeed(decompress_command(r1), os.path.join(work_dir, 'R1.fastq')),
+                 FifoFeed(decompress_command(r2), os.path.join(work_dir, 'R2.fastq'))]
+    else:
+        job.fileStore.readGlobalFile(r1_id, os.path.join(work_dir, 'R1.fastq'))
+        job.fileStore.readGlobalFile(r2_id, os.path.join(work_dir, 'R2.fastq'))
+    # Drop orphaned reads on the way into cutadapt
+    synced = [os.path.join(work_dir, 'R1.synced.fastq'), os.path.join(work_dir, 'R2.synced.fastq')]
+    for path in synced:
+        os.mkfifo(path)
+        os.chmod(path, 0666)
+    counts_path = os.path.join(work_dir, 'pairing.json')
+    sync = subprocess.Popen(sync_command(os.path.join(work_dir, 'R1.fastq'), os.path.join(work_dir, 'R2.fastq'),
+                                         synced[0], synced[1], counts_path, window=inputs.pair_window))
     # Cutadapt parameters
     parameters = ['-a', inputs.fwd_3pr_adapter,
                   '-m', '35',
                   '-A', inputs.rev_3pr_adapter,
                   '-o', '/data/R1_cutadapt.fastq',
                   '-p', '/data/R2_cutadapt.fastq',
-                  '/data/R1.fastq', '/data/R2.fastq']
+                  '/data/R1.synced.fastq', '/data/R2.synced.fastq']
     # Call: CutAdapt
-    base_docker_call = 'docker run --log-driver=none --rm -v {}:/data'.format(work_dir).split()
-    if inputs.sudo:
-        base_docker_call = ['sudo'] + base_docker_call
+    name = 'cutadapt-{}'.format(uuid4())
+    sudo = ['sudo'] if inputs.sudo else []
+    base_docker_call = sudo + 'docker run --log-driver=none --rm --name {} -v {}:/data'.format(name, work_dir).split()
     tool = 'quay.io/ucsc_cgl/cutadapt:1.9--6bd44edd2b8f8f17e25c5a268fedaab65fa851d2'
-    p = subprocess.Popen(base_docker_call + [tool] + parameters, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    stdout, stderr = p.communicate()
+    stderr_path = os.path.join(work_dir, 'cutadapt.stderr')
+    try:
+        with open(os.path.join(work_dir, 'cutadapt.stdout'), 'w') as stdout, open(stderr_path, 'w') as stderr:
+            p = subprocess.Popen(base_docker_call + [tool] + parameters, stderr=stderr, stdout=stdout)
+        # cutadapt blocks on the pipes if sync fails before it has written all reads, so it is stopped then
+        while p.poll() is None:
+            time.sleep(1)
+            if sync.poll() not in (None, 0):
+                subprocess.call(sudo + ['docker', 'kill', name])
+                p.wait()
+        if p.returncode == 0:
+            for feed in feeds:
+                feed.wait()
+    finally:
+        if sync.poll() is None:
+            sync.kill()
+            sync.wait()
+        for path in synced:
+            os.remove(path)
+        for feed in feeds:
+            feed.close()
+    # A failed re-synchronization ends the reads early, which cutadapt cannot tell apart from success
+    if sync.returncode != 0:
+        raise RuntimeError('Re-synchronizing the read pairs of {} failed'.format(inputs.uuid))
     if p.returncode != 0:
-        if 'improperly paired' in stderr:
-            inputs.improper_pair = True
-            shutil.move(os.path.join(work_dir, 'R1.fastq'), os.path.join(work_dir, 'R1_cutadapt.fastq'))
-            shutil.move(os.path.join(work_dir, 'R2.fastq'), os.path.join(work_dir, 'R2_cutadapt.fastq'))
+        with open(stderr_path) as f:
+            raise RuntimeError('CutAdapt failed on {}: {}'.format(inputs.uuid, f.read()))
+    with open(counts_path) as f:
+        counts = json.load(f)
+    job.fileStore.logToMaster('Read pairs of {}: {pairs} kept, {r1_orphans} R1 and {r2_orphans} R2 orphans '
+                              'dropped'.format(inputs.uuid, **counts))
+    tarball_files('pairing.tar.gz', file_paths=[counts_path], output_dir=work_dir)
     # Write to fileStore
-    if inputs.improper_pair:
-        r1_cutadapt = r1_id
-        r2_cutadapt = r2_id
-    else:
-        r1_cutadapt = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'R1_cutadapt.fastq'))
-        r2_cutadapt = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'R2_cutadapt.fastq'))
-        job.fileStore.deleteGlobalFile(r1_id)
-        job.fileStore.deleteGlobalFile(r2_id)
+    r1_cutadapt = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'R1_cutadapt.fastq'))
+    r2_cutadapt = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'R2_cutadapt.fastq'))
+    pairing_id = job.fileStore.writeGlobalFile(os.path.join(work_dir, 'pairing.tar.gz'))
+    for file_id in [tar_id] if tar_id else [r1_id, r2_id]:
+        job.fileStore.deleteGlobalFile(file_id)
     # start STAR
     cores = min(inputs.cores, 16)
-    job.addChildJobFn(star, inputs, r1_cutadapt, r2_cutadapt, cores=cores, disk='100G', memory='40G').rv()
+    if inputs.star_shared_memory:
+        # The genome lives in shared memory outside of the job, so only STAR's buffers and BAM sorting are reserved
+        return job.addChildJobFn(star, inputs, r1_cutadapt, r2_cutadapt, pairing_id, cores=cores, disk='70G',
+                                 memory=inputs.star_sort_memory + 4 * 1024 ** 3).rv()
+    return job.addChildJobFn(star, inputs, r1_cutadapt, r2_cutadapt, pairing_id, cores=cores, disk='100G',
+                             memory='40G').rv()
+
+
+def star_index_dir(job, inputs):
+    """
+    Returns the directory of the STAR index extracted in the node's reference cache, extracting it if this is the
+    first job on the node to use it
+
+    :param JobFunctionWrappingJob job: passed by Toil automatically
+    :param Namespace inputs: Stores input arguments (see main)
+    :return: Path to the directory containing the starIndex directory
+    :rtype: str
+    """
+    def fetch(scratch_dir):
+        download_url(job=job, url=inputs.star_index, work_dir=scratch_dir, name='starIndex.tar.gz')
+        return os.path.join(scratch_dir, 'starIndex.tar.gz')
 
+    return extract_once(inputs.ref_cache_dir, cache_key('starIndex.tar.gz', inputs.star_index), fetch, untar)
 
-def star(job, inputs, r1_cutadapt, r2_cutadapt):
+
+def star(job, inputs, r1_cutadapt, r2_cutadapt, pairing_id):
     """
     Performs alignment of fastqs to BAM via STAR
 
@@ -185,6 +314,9 @@ def star(job, inputs, r1_cutadapt, r2_cutadapt):
     :param Namespace inputs: Stores input arguments (see main)
     :param str r1_cutadapt: FileStore ID of read 1 fastq
     :param str r2_cutadapt: FileStore ID of read 2 fastq
+    :param str pairing_id: FileStore ID of the tarball of the read pairing counts
+    :return: UUID, and FileStore IDs of the splice graph, bam and bam index of the sample
+    :rtype: dict
     """
     job.fileStore.logToMaster('Aligning with STAR: {}'.format(inputs.uuid))
     work_dir = job.fileStore.getLocalTempDir()
@@ -193,11 +325,16 @@ def star(job, inputs, r1_cutadapt, r2_cutadapt):
     job.fileStore.readGlobalFile(r1_cutadapt, os.path.join(work_dir, 'R1_cutadapt.fastq'))
     job.fileStore.readGlobalFile(r2_cutadapt, os.path.join(work_dir, 'R2_cutadapt.fastq'))
     # Get starIndex
-    download_url(job=job, url=inputs.star_index, work_dir=work_dir, name='starIndex.tar.gz')
-    subprocess.check_call(['tar', '-xvf', os.path.join(work_dir, 'starIndex.tar.gz'), '-C', work_dir])
+    if inputs.star_shared_memory:
+        index_dir = star_index_dir(job, inputs)
+        genome_dir = '/refs/starIndex'
+    else:
+        download_url(job=job, url=inputs.star_index, work_dir=work_dir, name='starIndex.tar.gz')
+        subprocess.check_call(['tar', '-xvf', os.path.join(work_dir, 'starIndex.tar.gz'), '-C', work_dir])
+        genome_dir = '/data/starIndex'
     # Parameters
     parameters = ['--runThreadN', str(cores),
-                  '--genomeDir', '/data/starIndex',
+                  '--genomeDir', genome_dir,
                   '--outFileNamePrefix', 'rna',
                   '--outSAMtype', 'BAM', 'SortedByCoordinate',
                   '--outSAMunmapped', 'Within',
@@ -214,9 +351,15 @@ def star(job, inputs, r1_cutadapt, r2_cutadapt):
                   '--alignSJDBoverhangMin', '1',
                   '--sjdbScore', '1',
                   '--readFilesIn', '/data/R1_cutadapt.fastq', '/data/R2_cutadapt.fastq']
+    docker_parameters = None
+    if inputs.star_shared_memory:
+        # The first STAR on a node loads the genome into a shared memory segment that later runs attach to (or
+        # wait on while it is being loaded). Containers share the segment through the host's IPC namespace.
+        parameters += ['--genomeLoad', 'LoadAndKeep', '--limitBAMsortRAM', str(inputs.star_sort_memory)]
+        docker_parameters = ['--ipc=host', '-v', '{}:/refs:ro'.format(index_dir)]
     # Call: STAR Map
     docker_call(job=job, tool='quay.io/ucsc_cgl/star:2.4.2a--bcbd5122b69ff6ac4ef61958e47bde94001cfe80',
-                work_dir=work_dir, parameters=parameters)
+                work_dir=work_dir, parameters=parameters, docker_parameters=docker_parameters)
     # Call Samtools Index
     index_command = ['index', '/data/rnaAligned.sortedByCoord.out.bam']
     docker_call(job=job, work_dir=work_dir, parameters=index_command,
@@ -227,15 +370,83 @@ def star(job, inputs, r1_cutadapt, r2_cutadapt):
     job.fileStore.deleteGlobalFile(r1_cutadapt)
     job.fileStore.deleteGlobalFile(r2_cutadapt)
     # Launch children and follow-on
-    vcqc_id = job.addChildJobFn(variant_calling_and_qc, inputs, bam_id, bai_id, cores=2, disk='30G').rv()
-    spladder_id = job.addChildJobFn(spladder, inputs, bam_id, bai_id, disk='30G').rv()
-    job.addFollowOnJobFn(consolidate_output_tarballs, inputs, vcqc_id, spladder_id, disk='30G')
+    vcqc_id = job.addChildJobFn(variant_calling_and_qc, inputs, bam_id, bai_id, cores=min(inputs.cores, 8),
+                                disk='30G').rv()
+    spladder_job = job.addChildJobFn(spladder, inputs, bam_id, bai_id, disk='30G')
+    job.addFollowOnJobFn(consolidate_output_tarballs, inputs, vcqc_id, spladder_job.rv(0), pairing_id, disk='30G')
+    return {'uuid': inputs.uuid, 'graph': spladder_job.rv(1), 'bam': bam_id, 'bai': bai_id}
+
+
+def read_shared_files(job, inputs, work_dir, names):
+    """
+    Copies inputs shared by all samples from the jobStore into work_dir
+
+    :param JobFunctionWrappingJob job: passed by Toil automatically
+    :param Namespace inputs: Stores input arguments (see main)
+    :param str work_dir: Destination directory
+    :param list[str] names: File names of the shared inputs (keys of inputs.shared_ids)
+    """
+    for name in names:
+        job.fileStore.readGlobalFile(inputs.shared_ids[name], os.path.join(work_dir, name))
+
+
+def split_positions(positions, fai, out_dir):
+    """
+    Splits a positions file (contig and position per line) into one file per contig
+
+    :param str positions: Path to the positions file
+    :param str fai: Path to the genome index, whose order the contigs are returned in
+    :param str out_dir: Directory the per-contig files are written to
+    :return: Contig and path of the positions file of every contig with positions, in genome order. Positions on
+        contigs missing from the genome, which a whole-genome mpileup would not have called either, are left out.
+    :rtype: list[tuple(str, str)]
+    """
+    with open(fai) as f:
+        order = dict((line.split('\t', 1)[0], i) for i, line in enumerate(f))
+    files = OrderedDict()
+    try:
+        with open(positions) as f:
+            for line in f:
+                if not line.strip() or line.startswith('#'):
+                    continue
+                contig = line.split('\t', 1)[0]
+                if contig not in order:
+                    continue
+                if contig not in files:
+                    files[contig] = open(os.path.join(out_dir, '{}.tsv'.format(len(files))), 'w')
+                files[contig].write(line)
+    finally:
+        for f in files.values():
+            f.close()
+    return [(contig, files[contig].name) for contig in sorted(files, key=order.get)]
+
+
+def concatenate_vcfs(vcfs, output, threads=None):
+    """
+    Concatenates compressed VCFs of disjoint regions into one BGZF-compressed VCF, keeping the header of the first
+
+    :param list[str] vcfs: Paths to the VCFs, in output order
+    :param str output: Path of the concatenated VCF
+    :param int threads: Number of compression threads
+    """
+    with open(output, 'wb') as f_out:
+        writer = ParallelGzipWriter(f_out, threads=threads, bgzf=True)
+        try:
+            for i, vcf in enumerate(vcfs):
+                with closing(gzip.open(vcf)) as f_in:
+                    for line in f_in:
+                        if i == 0 or not line.startswith('#'):
+                            writer.write(line)
+        finally:
+            writer.close()
 
 
 def variant_calling_and_qc(job, inputs, bam_id, bai_id):
     """
     Perform variant calling with samtools nad QC with CheckBias
 
+    Variants are called by one mpileup per contig of the positions file, run concurrently alongside CheckBias.
+
     :param JobFunctionWrappingJob job: passed by Toil automatically
     :param Namespace inputs: Stores input arguments (see main)
     :param str bam_id: FileStore ID of bam
@@ -248,33 +459,52 @@ def variant_calling_and_qc(job, inputs, bam_id, bai_id):
     # Pull in alignment.bam from fileStore
     job.fileStore.readGlobalFile(bam_id, os.path.join(work_dir, 'alignment.bam'))
     job.fileStore.readGlobalFile(bai_id, os.path.join(work_dir, 'alignment.bam.bai'))
-    # Download input files
-    input_info = [(inputs.genome, 'genome.fa'), (inputs.positions, 'positions.tsv'),
-                  (inputs.genome_index, 'genome.fa.fai'), (inputs.gtf, 'annotation.gtf'),
-                  (inputs.gtf_m53, 'annotation.m53')]
-    for url, fname in input_info:
-        download_url(job=job, url=url, work_dir=work_dir, name=fname)
-
-    # Part 1: Variant Calling
-    variant_command = ['mpileup',
-                       '-f', 'genome.fa',
-                       '-l', 'positions.tsv',
-                       '-v', 'alignment.bam',
-                       '-t', 'DP,SP,INFO/AD,INFO/ADF,INFO/ADR,INFO/DPR,SP',
-                       '-o', '/data/output.vcf.gz']
-    docker_call(job=job, work_dir=work_dir, parameters=variant_command,
-                tool='quay.io/ucsc_cgl/samtools:1.3--256539928ea162949d8a65ca5c79a72ef557ce7c')
+    # Shared input files
+    read_shared_files(job, inputs, work_dir, ['genome.fa', 'positions.tsv', 'genome.fa.fai', 'annotation.gtf',
+                                              'annotation.m53'])
+    for subdir in ['positions', 'mpileup']:
+        mkdir_p(os.path.join(work_dir, subdir))
+    contigs = split_positions(os.path.join(work_dir, 'positions.tsv'), os.path.join(work_dir, 'genome.fa.fai'),
+                              os.path.join(work_dir, 'positions'))
+    assert contigs, 'No positions found for variant calling in {}'.format(inputs.positions)
+
+    # Part 1: Variant Calling, a contig at a time through the bam index
+    def mpileup(i):
+        contig, positions = contigs[i]
+        output = os.path.join('mpileup', '{}.vcf.gz'.format(i))
+        variant_command = ['mpileup',
+                           '-f', 'genome.fa',
+                           '-r', contig,
+                           '-l', os.path.relpath(positions, work_dir),
+                           '-v', 'alignment.bam',
+                           '-t', 'DP,SP,INFO/AD,INFO/ADF,INFO/ADR,INFO/DPR,SP',
+                           '-o', os.path.join('/data', output)]
+        docker_call(job=job, work_dir=work_dir, parameters=variant_command,
+                    tool='quay.io/ucsc_cgl/samtools:1.3--256539928ea162949d8a65ca5c79a72ef557ce7c')
+        return os.path.join(work_dir, output)
 
     # Part 2: QC
-    qc_command = ['-o', 'qc',
-                  '-n', 'alignment.bam',
-                  '-a', 'annotation.gtf',
-                  '-m', 'annotation.m53']
-    docker_call(job=job, work_dir=work_dir, parameters=qc_command,
-                tool='jvivian/checkbias:612f129--b08a1fb6526a620bbb0304b08356f2ae7c3c0ec3')
+    def qc():
+        qc_command = ['-o', 'qc',
+                      '-n', 'alignment.bam',
+                      '-a', 'annotation.gtf',
+                      '-m', 'annotation.m53']
+        docker_call(job=job, work_dir=work_dir, parameters=qc_command,
+                    tool='jvivian/checkbias:612f129--b08a1fb6526a620bbb0304b08356f2ae7c3c0ec3')
+
+    cores = max(int(job.cores), 1)
+    pool = ThreadPool(cores)
+    try:
+        qc_result = pool.apply_async(qc)
+        vcfs = pool.map(mpileup, range(len(contigs)), chunksize=1)
+        qc_result.get()
+    finally:
+        pool.close()
+        pool.join()
+    output_vcf = os.path.join(work_dir, 'output.vcf.gz')
+    concatenate_vcfs(vcfs, output_vcf, threads=cores)
     # Write output to fileStore and return ids
     output_tsv = glob(os.path.join(work_dir, '*counts.tsv*'))[0]
-    output_vcf = os.path.join(work_dir, 'output.vcf.gz')
     tarball_files('vcqc.tar.gz', file_paths=[output_tsv, output_vcf], output_dir=work_dir)
     return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'vcqc.tar.gz'))
 
@@ -287,17 +517,16 @@ def spladder(job, inputs, bam_id, bai_id):
     :param Namespace inputs: Stores input arguments (see main)
     :param str bam_id: FileStore ID of bam
     :param str bai_id: FileStore ID of bam index file
-    :return: FileStore ID of SplAdder tarball
-    :rtype: str
+    :return: FileStore IDs of the SplAdder tarball and of the splice graph
+    :rtype: tuple(str, str)
     """
     job.fileStore.logToMaster('SplAdder: {}'.format(inputs.uuid))
     work_dir = job.fileStore.getLocalTempDir()
     # Pull in alignment.bam from fileStore
     job.fileStore.readGlobalFile(bam_id, os.path.join(work_dir, 'alignment.bam'))
     job.fileStore.readGlobalFile(bai_id, os.path.join(work_dir, 'alignment.bam.bai'))
-    # Download input file
-    download_url(job=job, url=inputs.gtf, work_dir=work_dir, name='annotation.gtf')
-    download_url(job=job, url=inputs.gtf_pickle, work_dir=work_dir, name='annotation.gtf.pickle')
+    # Shared input files
+    read_shared_files(job, inputs, work_dir, ['annotation.gtf', 'annotation.gtf.pickle'])
     # Call Spladder
     command = ['--insert_ir=y',
                '--insert_es=y',
@@ -331,10 +560,11 @@ def spladder(job, inputs, bam_id, bai_id):
     output = os.path.join(work_dir, 'alignment.hdf5')
     print os.listdir(work_dir)
     tarball_files('spladder.tar.gz', file_paths=[output_pickle, output_filt, output], output_dir=work_dir)
-    return job.fileStore.writeGlobalFile(os.path.join(work_dir, 'spladder.tar.gz'))
+    return (job.fileStore.writeGlobalFile(os.path.join(work_dir, 'spladder.tar.gz')),
+            job.fileStore.writeGlobalFile(output_pickle))
 
 
-def consolidate_output_tarballs(job, inputs, vcqc_id, spladder_id):
+def consolidate_output_tarballs(job, inputs, vcqc_id, spladder_id, pairing_id):
     """
     Combine the contents of separate tarballs into one.
 
@@ -342,6 +572,7 @@ def consolidate_output_tarballs(job, inputs, vcqc_id, spladder_id):
     :param Namespace inputs: Stores input arguments (see main)
     :param str vcqc_id: FileStore ID of variant calling and QC tarball
     :param str spladder_id: FileStore ID of spladder tarball
+    :param str pairing_id: FileStore ID of the tarball of the read pairing counts
     """
     job.fileStore.logToMaster('Consolidating files and uploading: {}'.format(inputs.uuid))
     work_dir = job.fileStore.getLocalTempDir()
@@ -351,24 +582,18 @@ def consolidate_output_tarballs(job, inputs, vcqc_id, spladder_id):
     # Retrieve output file paths to consolidate
     vcqc_tar = job.fileStore.readGlobalFile(vcqc_id, os.path.join(work_dir, 'vcqc.tar.gz'))
     spladder_tar = job.fileStore.readGlobalFile(spladder_id, os.path.join(work_dir, 'spladder.tar.gz'))
-    # I/O
-    fname = uuid + '.tar.gz' if not inputs.improper_pair else 'IMPROPER_PAIR' + uuid + '.tar.gz'
-    out_tar = os.path.join(work_dir, fname)
-    # Consolidate separate tarballs into one
-    with tarfile.open(os.path.join(work_dir, out_tar), 'w:gz') as f_out:
-        for tar in [vcqc_tar, spladder_tar]:
-            with tarfile.open(tar, 'r') as f_in:
-                for tarinfo in f_in:
-                    with closing(f_in.extractfile(tarinfo)) as f_in_file:
-                        if tar == vcqc_tar:
-                            tarinfo.name = os.path.join(uuid, 'variants_and_qc', os.path.basename(tarinfo.name))
-                        else:
-                            tarinfo.name = os.path.join(uuid, 'spladder', os.path.basename(tarinfo.name))
-                        f_out.addfile(tarinfo, fileobj=f_in_file)
-    # Move to output directory
+    pairing_tar = job.fileStore.readGlobalFile(pairing_id, os.path.join(work_dir, 'pairing.tar.gz'))
+    # I/O -- written straight into the output directory if one was given
+    fname = uuid + '.tar.gz'
     if inputs.output_dir:
         mkdir_p(inputs.output_dir)
-        shutil.copy(out_tar, os.path.join(inputs.output_dir, os.path.basename(out_tar)))
+        out_tar = os.path.join(inputs.output_dir, fname)
+    else:
+        out_tar = os.path.join(work_dir, fname)
+    # Consolidate separate tarballs into one
+    consolidate_tarballs(out_tar, [(vcqc_tar, os.path.join(uuid, 'variants_and_qc')),
+                                   (pairing_tar, os.path.join(uuid, 'variants_and_qc')),
+                                   (spladder_tar, os.path.join(uuid, 'spladder'))], threads=inputs.cores)
     # Upload to S3
     if inputs.output_s3_dir:
         out_id = job.fileStore.writeGlobalFile(out_tar)
@@ -376,6 +601,214 @@ def consolidate_output_tarballs(job, inputs, vcqc_id, spladder_id):
                           file_name=fname, key_path=inputs.ssec, cores=inputs.cores)
 
 
+def cohort_dag(job, samples, budget, inputs, shared_ids):
+    """
+    Runs every sample and merges their splice graphs into a cohort graph
+
+    Samples are admitted in the lanes budgeted_map_job would use. Each lane merges the graph of every sample into a
+    graph of its own as soon as the sample has finished, while its next sample runs, and the graphs of the lanes are
+    merged once all lanes are done.
+
+    :param JobFunctionWrappingJob job: passed by Toil automatically
+    :param list samples: Tuples containing (UUID,URL) of samples
+    :param DiskBudget budget: Disk budget, or None to run all samples at once
+    :param Namespace inputs: Stores input arguments (see main)
+    :param dict shared_ids: FileStore IDs of the inputs shared by all samples, by file name
+    """
+    if not samples:
+        return
+    cohort_inputs = argparse.Namespace(**vars(inputs))
+    cohort_inputs.shared_ids = shared_ids
+    cohort_inputs.cores = multiprocessing.cpu_count()
+    if budget is None:
+        lanes = [[sample] for sample in samples]
+    else:
+        footprints = sample_footprints(samples, sample_urls, budget)
+        lanes = lpt_lanes(samples, footprints, num_lanes(footprints, budget))
+        job.fileStore.logToMaster('Admitting {} samples in {} lanes (disk budget: {} bytes, estimated total: {} bytes)'
+                                  .format(len(samples), len(lanes), budget.total, sum(footprints)))
+    lane_merges = []
+    for lane in lanes:
+        sample_job, merge, cohort = None, None, None
+        for sample in lane:
+            next_sample_job = Job.wrapJobFn(download_sample, sample, inputs, shared_ids).encapsulate()
+            # Children of an encapsulated job wait for all of its descendants, so a lane runs one sample at a time
+            (sample_job or job).addChild(next_sample_job)
+            sample_job = next_sample_job
+            # Each merge waits for its own sample and the previous merge only, so merging overlaps the next sample
+            next_merge = Job.wrapJobFn(merge_splice_graphs, cohort_inputs, cohort, sample_job.rv(), disk='30G')
+            sample_job.addChild(next_merge)
+            if merge:
+                merge.addChild(next_merge)
+            merge, cohort = next_merge, next_merge.rv()
+        lane_merges.append((merge, cohort))
+    merge, cohort = lane_merges[0]
+    for lane_merge, lane_cohort in lane_merges[1:]:
+        next_merge = Job.wrapJobFn(merge_splice_graphs, cohort_inputs, cohort, lane_cohort, disk='30G')
+        merge.addChild(next_merge)
+        lane_merge.addChild(next_merge)
+        merge, cohort = next_merge, next_merge.rv()
+    merge.addFollowOnJobFn(quantify_cohort, cohort_inputs, cohort)
+
+
+def _spladder_sample_dir(work_dir, names):
+    """
+    Creates empty stand-ins for the BAMs of samples, as SplAdder names each sample's files after its BAM but does not
+    open those it has no work for (e.g. when the splice graph already exists)
+
+    :param str work_dir: Directory SplAdder runs in
+    :param list[str] names: Sample names
+    :return: Comma-separated BAM paths for SplAdder's -b argument
+    :rtype: str
+    """
+    for name in names:
+        path = os.path.join(work_dir, name + '.bam')
+        if not os.path.exists(path):
+            open(path, 'w').close()
+    return ','.join('/data/{}.bam'.format(x) for x in names)
+
+
+def merge_splice_graphs(job, inputs, cohort, other):
+    """
+    Merges the splice graph of a sample, or that of another part of the cohort, into the cohort graph
+
+    :param JobFunctionWrappingJob job: passed by Toil automatically
+    :param Namespace inputs: Stores input arguments (see main)
+    :param dict cohort: FileStore ID of the cohort graph and the samples merged into it, None for the first sample
+    :param dict other: Sample outputs (see star()), or a cohort as returned by this function
+    :return: Updated cohort
+    :rtype: dict
+    """
+    if 'samples' not in other:
+        other = {'graph': other['graph'], 'samples': [other]}
+    if cohort is None:
+        return other
+    job.fileStore.logToMaster('Merging splice graph of {} into the cohort'.format(
+        ', '.join(x['uuid'] for x in other['samples'])))
+    work_dir = job.fileStore.getLocalTempDir()
+    graph_dir = os.path.join(work_dir, 'spladder')
+    mkdir_p(graph_dir)
+    read_shared_files(job, inputs, work_dir, ['annotation.gtf'])
+    # Both graphs are merged as if they were the graphs of samples
+    names = [inputs.cohort_name, other['samples'][0]['uuid']]
+    for name, graph_id in zip(names, [cohort['graph'], other['graph']]):
+        job.fileStore.readGlobalFile(graph_id, os.path.join(graph_dir, 'genes_graph_conf3.{}.pickle'.format(name)))
+    command = ['-b', _spladder_sample_dir(work_dir, names),
+               '-o', '/data',
+               '-a', 'annotation.gtf',
+               '-c', '3',
+               '-M', 'merge_graphs',
+               '-T', 'n',
+               '--quantify_graph', 'n',
+               '-n', '50',
+               '-P', 'y',
+               '-p', 'n']
+    docker_call(job=job, work_dir=work_dir, parameters=command, sudo=inputs.sudo, tool='jvivian/spladder:1.0')
+    graph_id = job.fileStore.writeGlobalFile(os.path.join(graph_dir, 'genes_graph_conf3.merge_graphs.pickle'))
+    # Graphs of single samples are kept in their sample's output
+    for graph_id_to_delete in [cohort['graph'], other['graph']]:
+        job.fileStore.deleteGlobalFile(graph_id_to_delete)
+    return {'graph': graph_id, 'samples': cohort['samples'] + other['samples']}
+
+
+def quantify_cohort(job, inputs, cohort):
+    """
+    Quantifies the cohort graph in every sample in parallel, then collects the quantifications and extracts events
+
+    :param JobFunctionWrappingJob job: passed by Toil automatically
+    :param Namespace inputs: Stores input arguments (see main)
+    :param dict cohort: FileStore ID of the cohort graph and the samples merged into it
+    """
+    count_ids = [job.addChildJobFn(quantify_sample, inputs, cohort['graph'], sample, disk='30G').rv()
+                 for sample in cohort['samples']]
+    job.addFollowOnJobFn(collect_cohort_events, inputs, cohort, count_ids, disk='30G')
+
+
+def quantify_sample(job, inputs, graph_id, sample):
+    """
+    Quantifies the cohort graph in the alignments of one sample
+
+    :param JobFunctionWrappingJob job: passed by Toil automatically
+    :param Namespace inputs: Stores input arguments (see main)
+    :param str graph_id: FileStore ID of the cohort graph
+    :param dict sample: Sample outputs, see star()
+    :return: FileStore ID of the sample's counts
+    :rtype: str
+    """
+    uuid = sample['uuid']
+    job.fileStore.logToMaster('Quantifying cohort splice graph in {}'.format(uuid))
+    work_dir = job.fileStore.getLocalTempDir()
+    graph_dir = os.path.join(work_dir, 'spladder')
+    mkdir_p(graph_dir)
+    read_shared_files(job, inputs, work_dir, ['annotation.gtf'])
+    job.fileStore.readGlobalFile(graph_id, os.path.join(graph_dir, 'genes_graph_conf3.merge_graphs.pickle'))
+    job.fileStore.readGlobalFile(sample['bam'], os.path.join(work_dir, uuid + '.bam'))
+    job.fileStore.readGlobalFile(sample['bai'], os.path.join(work_dir, uuid + '.bam.bai'))
+    command = ['-b', '/data/{}.bam'.format(uuid),
+               '-o', '/data',
+               '-a', 'annotation.gtf',
+               '-c', '3',
+               '-M', 'merge_graphs',
+               '-T', 'n',
+               '--qmode', 'single',
+               '-n', '50',
+               '-P', 'y',
+               '-p', 'n',
+               '--sparse_bam', 'y']
+    docker_call(job=job, work_dir=work_dir, parameters=command, sudo=inputs.sudo, tool='jvivian/spladder:1.0')
+    return job.fileStore.writeGlobalFile(
+        os.path.join(graph_dir, 'genes_graph_conf3.merge_graphs.{}.count.hdf5'.format(uuid)))
+
+
+def collect_cohort_events(job, inputs, cohort, count_ids):
+    """
+    Collects the per-sample quantifications of the cohort graph and extracts alternative splicing events
+
+    :param JobFunctionWrappingJob job: passed by Toil automatically
+    :param Namespace inputs: Stores input arguments (see main)
+    :param dict cohort: FileStore ID of the cohort graph and the samples merged into it
+    :param list[str] count_ids: FileStore IDs of the per-sample counts, in the order of cohort['samples']
+    """
+    job.fileStore.logToMaster('Extracting events of cohort: {}'.format(inputs.cohort_name))
+    work_dir = job.fileStore.getLocalTempDir()
+    graph_dir = os.path.join(work_dir, 'spladder')
+    mkdir_p(graph_dir)
+    read_shared_files(job, inputs, work_dir, ['annotation.gtf'])
+    job.fileStore.readGlobalFile(cohort['graph'], os.path.join(graph_dir, 'genes_graph_conf3.merge_graphs.pickle'))
+    names = [x['uuid'] for x in cohort['samples']]
+    for name, count_id in zip(names, count_ids):
+        job.fileStore.readGlobalFile(
+            count_id, os.path.join(graph_dir, 'genes_graph_conf3.merge_graphs.{}.count.hdf5'.format(name)))
+    command = ['-b', _spladder_sample_dir(work_dir, names),
+               '-o', '/data',
+               '-a', 'annotation.gtf',
+               '-c', '3',
+               '-M', 'merge_graphs',
+               '-T', 'y',
+               '--qmode', 'collect',
+               '-n', '50',
+               '-P', 'y',
+               '-p', 'n']
+    docker_call(job=job, work_dir=work_dir, parameters=command, sudo=inputs.sudo, tool='jvivian/spladder:1.0')
+    # Cohort graph, collected counts and event files
+    outputs = [os.path.join(graph_dir, x) for x in os.listdir(graph_dir)
+               if x.startswith('merge_graphs_') or x in ['genes_graph_conf3.merge_graphs.pickle',
+                                                         'genes_graph_conf3.merge_graphs.count.hdf5']]
+    fname = inputs.cohort_name + '.tar.gz'
+    tarball_files(fname, file_paths=outputs, output_dir=work_dir)
+    out_tar = os.path.join(work_dir, fname)
+    if inputs.output_dir:
+        mkdir_p(inputs.output_dir)
+        shutil.copy(out_tar, os.path.join(inputs.output_dir, fname))
+    if inputs.output_s3_dir:
+        out_id = job.fileStore.writeGlobalFile(out_tar)
+        job.addChildJobFn(s3am_upload_job, file_id=out_id, s3_dir=inputs.output_s3_dir,
+                          file_name=fname, key_path=inputs.ssec)
+    for sample in cohort['samples']:
+        for name in ['bam', 'bai']:
+            job.fileStore.deleteGlobalFile(sample[name])
+
+
 def main():
     """
     This Toil pipeline aligns reads and performs alternative splicing analysis.
@@ -409,6 +842,31 @@ def main():
                         default=url_prefix + 'rnaseq_cgl/starIndex_hg38_no_alt.tar.gz')
     parser.add_argument('--fwd-3pr-adapter', help="Sequence for the FWD 3' Read Adapter.", default='AGATCGGAAGAG')
     parser.add_argument('--rev-3pr-adapter', help="Sequence for the REV 3' Read Adapter.", default='AGATCGGAAGAG')
+    parser.add_argument('--stream-fastqs', action='store_true', default=False,
+                        help='Unpack each sample in the CutAdapt job and feed it the decompressed reads through '
+                             'named pipes, instead of storing uncompressed R1/R2 fastqs in between.')
+    parser.add_argument('--pair-window', type=int, default=100000,
+                        help='Maximum number of unmatched reads per fastq held back while looking for their mates, '
+                             'before they are dropped as orphans ahead of CutAdapt.')
+    parser.add_argument('--disk-budget', default=None,
+                        help='Total scratch space samples in flight may use together, e.g. 2T. Samples are then '
+                             'started, largest first, as earlier ones finish. By default all samples start at once.')
+    parser.add_argument('--max-concurrent-samples', type=int, default=None,
+                        help='Maximum number of samples in flight at once.')
+    parser.add_argument('--cohort', action='store_true', default=False,
+                        help='Also merge the splice graphs of all samples into a cohort graph, as samples finish, '
+                             'and quantify its events in every sample. Written to COHORT-NAME.tar.gz.')
+    parser.add_argument('--cohort-name', default='cohort', help='Name of the cohort output with --cohort.')
+    parser.add_argument('--star-shared-memory', action='store_true', default=False,
+                        help='Extract the STAR index once per node into --ref-cache-dir and keep the genome loaded '
+                             'in shared memory (--genomeLoad LoadAndKeep), so alignments on a node share one copy '
+                             'and reserve only --star-sort-memory plus buffers. Requires a kernel.shmmax larger '
+                             'than the genome. The genome stays loaded after the run; see the README for removal.')
+    parser.add_argument('--ref-cache-dir', default='/var/tmp/toil-scripts/references',
+                        help='Node-local directory where reference archives are extracted once per node. '
+                             'Archives unused for a week are evicted.')
+    parser.add_argument('--star-sort-memory', type=int, default=10 * 1024 ** 3,
+                        help='Bytes of memory STAR may use to sort the BAM when --star-shared-memory is set.')
     Job.Runner.addToilOptions(parser)
     args = parser.parse_args()
     # Sanity Checks
@@ -0,0 +1,44 @@
+from StringIO import StringIO
+from unittest import TestCase
+
+from toil_scripts.spladder_pipeline.fastq_pairs import read_name, sync_pairs
+
+
+def fastq(names, mate):
+    f = StringIO(''.join('@{}/{} comment\nACGT\n+\nIIII\n'.format(x, mate) for x in names))
+    f.name = 'R{}.fastq'.format(mate)
+    return f
+
+
+def names(f):
+    return [read_name(x) for x in f.getvalue().splitlines()[::4]]
+
+
+class SyncPairsTest(TestCase):
+
+    def _sync(self, r1_names, r2_names, window=100):
+        r1_out, r2_out = StringIO(), StringIO()
+        counts = sync_pairs(fastq(r1_names, 1), fastq(r2_names, 2), r1_out, r2_out, window=window)
+        self.assertEqual(names(r1_out), names(r2_out))
+        return names(r1_out), counts
+
+    def test_in_sync(self):
+        reads = ['read{}'.format(i) for i in xrange(10)]
+        self.assertEqual(self._sync(reads, reads), (reads, {'pairs': 10, 'r1_orphans': 0, 'r2_orphans': 0}))
+
+    def test_drops_orphans(self):
+        r1 = ['a', 'b', 'x', 'c', 'd', 'e', 'y', 'z']
+        r2 = ['a', 'w', 'b', 'c', 'e', 'f']
+        self.assertEqual(self._sync(r1, r2), (['a', 'b', 'c', 'e'], {'pairs': 4, 'r1_orphans': 4, 'r2_orphans': 2}))
+
+    def test_window_bounds_search(self):
+        r1 = ['a', 'b', 'c', 'd', 'e', 'f']
+        r2 = ['x', 'y', 'z', 'u', 'v', 'f']
+        self.assertEqual(self._sync(r1, r2, window=10)[0], ['f'])
+        # With a smaller window than the gap, the mate of f is given up on before it shows up
+        self.assertEqual(self._sync(['a', 'f', 'b', 'c'], ['x', 'y', 'z', 'f'], window=1)[0], [])
+
+    def test_truncated_record(self):
+        truncated = StringIO('@a/1\nACGT\n+\n')
+        truncated.name = 'R1.fastq'
+        self.assertRaises(RuntimeError, sync_pairs, truncated, fastq(['a'], 2), StringIO(), StringIO())
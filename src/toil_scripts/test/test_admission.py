@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from toil_scripts.admission import DiskBudget, _run_lane, budgeted_map_job, lpt_lanes, num_lanes, sample_footprints
+
+
+class AdmissionTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def sample(self, size):
+        """
+        Returns the path of a file of the given size, or of a missing file if size is None
+        """
+        path = os.path.join(self.work_dir, str(len(os.listdir(self.work_dir))))
+        if size is not None:
+            with open(path, 'w') as f:
+                f.write('x' * size)
+        else:
+            path += '.missing'
+        return path
+
+    def test_num_lanes(self):
+        footprints = [10, 40, 20, 30]
+        self.assertEqual(num_lanes(footprints, DiskBudget(total=100)), 4)
+        # Room for the largest samples running together
+        self.assertEqual(num_lanes(footprints, DiskBudget(total=80)), 2)
+        # A budget smaller than the largest sample still runs one sample at a time
+        self.assertEqual(num_lanes(footprints, DiskBudget(total=30)), 1)
+        self.assertEqual(num_lanes(footprints, DiskBudget(total=100, max_concurrent=3)), 3)
+        self.assertEqual(num_lanes(footprints, DiskBudget(total=80, max_concurrent=3)), 2)
+        self.assertEqual(num_lanes(footprints, DiskBudget(total=None, max_concurrent=2)), 2)
+
+    def test_lpt_lanes(self):
+        items = ['a', 'b', 'c', 'd', 'e', 'f']
+        sizes = [5, 9, 1, 7, 3, 4]
+        lanes = lpt_lanes(items, sizes, 2)
+        self.assertEqual(lanes, [['b', 'f', 'c'], ['d', 'a', 'e']])
+        totals = [sum(sizes[items.index(x)] for x in lane) for lane in lanes]
+        self.assertLessEqual(max(totals) - min(totals), max(sizes))
+        # No more lanes than items, and at least one
+        self.assertEqual(lpt_lanes(items[:2], sizes[:2], 5), [['b'], ['a']])
+        self.assertEqual(lpt_lanes([], [], 3), [[]])
+        # Samples of unknown size, e.g. under a maximum number of samples only, are dealt out evenly
+        self.assertEqual(lpt_lanes(items, [0] * 6, 2), [['a', 'c', 'e'], ['b', 'd', 'f']])
+
+    def test_unknown_size(self):
+        budget = DiskBudget(total=1000, expansion=2.0)
+        samples = [[self.sample(10)], [self.sample(30)], [self.sample(20)], [self.sample(None)]]
+        # Unknown sizes default to the median of the known ones
+        self.assertEqual(sample_footprints(samples, lambda x: x, budget), [20, 60, 40, 40])
+        self.assertEqual(sample_footprints(samples, lambda x: x, budget._replace(unknown_size=50)), [20, 60, 40, 100])
+        # Without any known size, a sample takes the whole budget
+        unknown = [[self.sample(None)], [self.sample(None)]]
+        footprints = sample_footprints(unknown, lambda x: x, budget)
+        self.assertEqual(footprints, [1000, 1000])
+        self.assertEqual(num_lanes(footprints, budget), 1)
+
+    def test_lanes_are_chains(self):
+        job = FakeJob()
+        budget = DiskBudget(total=100, expansion=1.0)
+        samples = [[self.sample(60)], [self.sample(30)], [self.sample(20)]]
+        budgeted_map_job(job, 'func', samples, budget, lambda x: x, 'arg')
+        lanes = job.run()
+        # 60 and 30 fit together, so two lanes: the largest sample alone, then the two others
+        self.assertEqual(len(lanes), 2)
+        first, second = lanes
+        self.assertEqual(first.children, [('func', (samples[0], 'arg'))])
+        self.assertEqual(first.follow_ons, [])
+        # The third sample is a follow-on of the lane's job for the second one: it only starts if that one succeeds
+        self.assertEqual(second.children, [('func', (samples[1], 'arg'))])
+        self.assertEqual(len(second.follow_ons), 1)
+        last = second.run_follow_on()
+        self.assertEqual(last.children, [('func', (samples[2], 'arg'))])
+        self.assertEqual(last.follow_ons, [])
+
+
+class FakeJob(object):
+    """
+    Records the jobs added by a job function, and runs those that are _run_lane
+    """
+
+    class FileStore(object):
+        def logToMaster(self, message):
+            pass
+
+    def __init__(self):
+        self.fileStore = self.FileStore()
+        self.children = []
+        self.follow_ons = []
+
+    def addChildJobFn(self, func, *args):
+        self.children.append((func, args))
+
+    def addFollowOnJobFn(self, func, *args):
+        self.follow_ons.append((func, args))
+
+    def run(self):
+        """
+        Runs the lanes added as children, returning the job of each
+        """
+        lanes = []
+        for func, args in self.children:
+            self.assertLane(func)
+            lane = FakeJob()
+            func(lane, *args)
+            lanes.append(lane)
+        return lanes
+
+    def run_follow_on(self):
+        func, args = self.follow_ons[0]
+        self.assertLane(func)
+        job = FakeJob()
+        func(job, *args)
+        return job
+
+    @staticmethod
+    def assertLane(func):
+        assert func is _run_lane, func
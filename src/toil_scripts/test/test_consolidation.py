@@ -0,0 +1,94 @@
+import gzip
+import os
+import random
+import shutil
+import struct
+import tarfile
+import tempfile
+import zlib
+from StringIO import StringIO
+from unittest import TestCase
+
+from toil_scripts.consolidation import BGZF_BLOCK_SIZE, BGZF_EOF, ParallelGzipWriter, consolidate_tarballs
+
+
+class ConsolidationTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        random.seed(1)
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def tarball(self, name, members):
+        """
+        Returns the path of a tarball holding the given {name: contents} members under a directory
+        """
+        path = os.path.join(self.work_dir, name)
+        with tarfile.open(path, 'w') as f:
+            for member, contents in sorted(members.iteritems()):
+                tarinfo = tarfile.TarInfo(os.path.join('out', member))
+                tarinfo.size = len(contents)
+                f.addfile(tarinfo, StringIO(contents))
+        return path
+
+    def test_round_trip(self):
+        noise = ''.join(chr(random.randint(0, 255)) for _ in xrange(300000))
+        rsem = {'rsem.genes.results': 'gene\tcount\n' * 50000, 'empty.txt': '', 'odd.txt': 'x' * 513}
+        variants = {'calls.vcf.gz': noise, 'reads.bam': noise[:1000]}
+        sources = [(self.tarball('rsem.tar', rsem), 'RSEM'), (self.tarball('variants.tar', variants), 'Variants')]
+        output = consolidate_tarballs(os.path.join(self.work_dir, 'sample.tar.gz'), sources, threads=3)
+        with tarfile.open(output, 'r:gz') as f:
+            members = {x.name: f.extractfile(x).read() for x in f}
+        expected = {os.path.join(arc_dir, name): contents
+                    for arc_dir, tar in (('RSEM', rsem), ('Variants', variants)) for name, contents in tar.iteritems()}
+        self.assertEqual(members, expected)
+        self.assertFalse(os.path.exists(output + '.partial'))
+        # Whole records, like tarfile writes them
+        with gzip.open(output, 'rb') as f:
+            self.assertEqual(len(f.read()) % tarfile.RECORDSIZE, 0)
+
+    def test_compressed_members_are_stored(self):
+        contents = 'A' * 500000
+        stored = consolidate_tarballs(os.path.join(self.work_dir, 'stored.tar.gz'),
+                                      [(self.tarball('a.tar', {'calls.vcf.gz': contents}), 'a')])
+        compressed = consolidate_tarballs(os.path.join(self.work_dir, 'compressed.tar.gz'),
+                                          [(self.tarball('b.tar', {'calls.vcf': contents}), 'b')])
+        self.assertGreater(os.path.getsize(stored), len(contents))
+        self.assertLess(os.path.getsize(compressed), len(contents) / 100)
+
+    def test_bgzf_layout(self):
+        data = ''.join(chr(random.randint(0, 255)) for _ in xrange(3 * BGZF_BLOCK_SIZE + 17))
+        out = StringIO()
+        writer = ParallelGzipWriter(out, threads=2, bgzf=True)
+        for i in xrange(0, len(data), 10000):
+            writer.write(data[i:i + 10000], compress=i < len(data) / 2)
+        writer.close()
+        stream = out.getvalue()
+        self.assertTrue(stream.endswith(BGZF_EOF))
+        blocks, offset = [], 0
+        while offset < len(stream):
+            magic, xlen, si1, si2, slen, bsize = struct.unpack('<4s6xH2BHH', stream[offset:offset + 18])
+            self.assertEqual((magic, xlen, si1, si2, slen), ('\x1f\x8b\x08\x04', 6, ord('B'), ord('C'), 2))
+            block = stream[offset:offset + bsize + 1]
+            self.assertLessEqual(len(block), 0x10000)
+            size = struct.unpack('<I', block[-4:])[0]
+            self.assertLessEqual(size, BGZF_BLOCK_SIZE)
+            decompressed = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(block)
+            self.assertEqual(len(decompressed), size)
+            blocks.append(decompressed)
+            offset += bsize + 1
+        self.assertEqual(offset, len(stream))
+        self.assertEqual(blocks[-1], '')
+        self.assertEqual(''.join(blocks), data)
+
+    def test_partial_renamed_on_success_only(self):
+        output = os.path.join(self.work_dir, 'sample.tar.gz')
+        sources = [(self.tarball('a.tar', {'a.txt': 'a'}), 'a'), (os.path.join(self.work_dir, 'missing.tar'), 'b')]
+        self.assertRaises(IOError, consolidate_tarballs, output, sources)
+        self.assertFalse(os.path.exists(output))
+        self.assertFalse(os.path.exists(output + '.partial'))
+        consolidate_tarballs(output, sources[:1])
+        self.assertTrue(os.path.exists(output))
+        self.assertFalse(os.path.exists(output + '.partial'))
@@ -0,0 +1,47 @@
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+from toil_scripts.named_pipes import FifoFeed, decompress_command
+
+
+class FifoFeedTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_mixed_inputs(self):
+        plain = os.path.join(self.work_dir, 'a_R1.fastq')
+        with open(plain, 'w') as f:
+            f.write('@a\nACGT\n+\nIIII\n')
+        compressed = os.path.join(self.work_dir, 'b_R1.fastq.gz')
+        with gzip.open(compressed, 'w') as f:
+            f.write('@b\nTTTT\n+\nIIII\n')
+        feed = FifoFeed(decompress_command([plain, compressed]), os.path.join(self.work_dir, 'R1.fastq'))
+        try:
+            with open(feed.path) as f:
+                self.assertEqual(f.read(), '@a\nACGT\n+\nIIII\n@b\nTTTT\n+\nIIII\n')
+            feed.wait()
+        finally:
+            feed.close()
+
+    def test_single_open(self):
+        feed = FifoFeed(['echo', 'reads'], os.path.join(self.work_dir, 'R1.fastq'))
+        try:
+            with open(feed.path) as f:
+                self.assertEqual(f.read(), 'reads\n')
+            feed.wait()
+            # A second open fails instead of blocking on a pipe without a writer
+            self.assertRaises(IOError, open, feed.path)
+        finally:
+            feed.close()
+
+    def test_close_unopened(self):
+        feed = FifoFeed(['echo', 'reads'], os.path.join(self.work_dir, 'R1.fastq'))
+        feed.close()
+        self.assertFalse(os.path.exists(feed.path))
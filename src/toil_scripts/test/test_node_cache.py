@@ -0,0 +1,69 @@
+import os
+import shutil
+import stat
+import tarfile
+import tempfile
+import time
+from unittest import TestCase
+
+from toil_scripts.node_cache import cache_key, evict_stale, extract_once, untar
+
+
+class NodeCacheTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.work_dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def fetch(self, scratch_dir):
+        """
+        Writes an archive with a private file in a private directory and an executable, as an index might contain
+        """
+        source = os.path.join(self.work_dir, 'source')
+        os.makedirs(os.path.join(source, 'index'))
+        with open(os.path.join(source, 'index', 'genome'), 'w') as f:
+            f.write('ACGT')
+        os.chmod(os.path.join(source, 'index', 'genome'), 0600)
+        with open(os.path.join(source, 'index', 'run'), 'w') as f:
+            f.write('#!/bin/sh\n')
+        os.chmod(os.path.join(source, 'index', 'run'), 0700)
+        os.chmod(os.path.join(source, 'index'), 0700)
+        archive = os.path.join(scratch_dir, 'index.tar')
+        with tarfile.open(archive, 'w') as f:
+            f.add(os.path.join(source, 'index'), arcname='index')
+        shutil.rmtree(source)
+        return archive
+
+    def mode(self, *path):
+        return stat.S_IMODE(os.stat(os.path.join(*path)).st_mode)
+
+    def test_extract_once(self):
+        key = cache_key('index.tar', 'id')
+        dest = extract_once(self.cache_dir, key, self.fetch, untar)
+        self.assertEqual(dest, os.path.join(self.cache_dir, key))
+        # Readable by other users all the way down
+        self.assertEqual(self.mode(dest), 0755)
+        self.assertEqual(self.mode(dest, 'index'), 0755)
+        self.assertEqual(self.mode(dest, 'index', 'genome'), 0644)
+        self.assertEqual(self.mode(dest, 'index', 'run'), 0755)
+        # Later calls reuse the extracted copy
+        self.assertEqual(extract_once(self.cache_dir, key, None, None), dest)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), [key, key + '.lock'])
+
+    def test_evict_stale(self):
+        old, new = cache_key('old'), cache_key('new')
+        extract_once(self.cache_dir, old, self.fetch, untar)
+        extract_once(self.cache_dir, new, self.fetch, untar)
+        abandoned = tempfile.mkdtemp(prefix=old + '.', dir=self.cache_dir)
+        day = 24 * 60 * 60
+        for path in (os.path.join(self.cache_dir, old), abandoned):
+            os.utime(path, (time.time() - 2 * day, time.time() - 2 * day))
+        evict_stale(self.cache_dir, max_age=day)
+        self.assertEqual(sorted(os.listdir(self.cache_dir)), sorted([new, new + '.lock', old + '.lock']))
+        # Using an archive refreshes it
+        os.utime(os.path.join(self.cache_dir, new), (time.time() - 2 * day, time.time() - 2 * day))
+        extract_once(self.cache_dir, new, None, None, max_age=day)
+        self.assertTrue(os.path.isdir(os.path.join(self.cache_dir, new)))
@@ -15,9 +15,10 @@ import os
 import shutil
 import subprocess
 from toil.job import Job
-from toil_lib.jobs import map_job
 from toil_lib.programs import docker_call
 
+from toil_scripts.admission import budgeted_map_job, disk_budget
+
 
 def build_parser():
     parser = argparse.ArgumentParser(description=main.__doc__, formatter_class=argparse.RawTextHelpFormatter)
@@ -28,6 +29,13 @@ def build_parser():
                              'be thrown if "-g" is set but not this argument.')
     parser.add_argument('--s3_dir', default=None, required=True, help='S3 Bucket. e.g. tcga-data')
     parser.add_argument('--ssec', default=None, required=True, help='Path to Key File for SSE-C Encryption')
+    parser.add_argument('--disk_budget', default=None,
+                        help='Total scratch space samples in flight may use together, e.g. 2T. By default all '
+                             'samples are transferred at once.')
+    parser.add_argument('--sample_size', default='100G',
+                        help='Size assumed for every sample under --disk_budget, as CGHub sizes are not queried.')
+    parser.add_argument('--max_concurrent_samples', default=None, type=int,
+                        help='Maximum number of samples transferred at once.')
     return parser
 
 
@@ -61,6 +69,13 @@ def parse_genetorrent(path_to_config):
     return samples
 
 
+def sample_urls(sample):
+    """
+    Samples are CGHub analysis IDs, whose sizes are not known up front
+    """
+    return []
+
+
 # Job Functions
 def download_and_transfer_sample(job, sample, inputs):
 
@@ -132,9 +147,12 @@ def main():
         assert os.path.isfile(args.genetorrent_key)
     samples = parse_genetorrent(args.genetorrent)
     # Start pipeline
-    # map_job accepts a function, an iterable, and *args. The function is launched as a child
-    # process with one element from the iterable and *args, which in turn spawns a tree of child jobs.
-    Job.Runner.startToil(Job.wrapJobFn(map_job, download_and_transfer_sample, samples, inputs), args)
+    # budgeted_map_job accepts a function, an iterable, a disk budget, and *args. The function is launched as a child
+    # process with one element from the iterable and *args, which in turn spawns a tree of child jobs. Only as many
+    # samples as fit in the budget are in flight at once.
+    budget = disk_budget(args.disk_budget, unknown_size=args.sample_size, max_concurrent=args.max_concurrent_samples)
+    Job.Runner.startToil(Job.wrapJobFn(budgeted_map_job, download_and_transfer_sample, samples, budget,
+                                       sample_urls, inputs), args)
 
 
 if __name__ == '__main__':